@@ -0,0 +1,188 @@
+"""
+Batched, vectorized Mann–Whitney U tests of responders vs non-responders
+for every stratum (treatment x condition x sample type x timepoint x
+population) at once, with Benjamini–Hochberg correction.
+
+    python batch_stats.py            # significant strata at q < 0.05
+    python batch_stats.py --all      # every tested stratum
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+from scipy.special import ndtr
+
+from instrumentation import add_profile_argument, configure, instrument, staged
+from queries import GRID_FREQUENCIES_SQL
+from storage import open_storage, read_frame
+
+# Columns of GRID_FREQUENCIES_SQL that define a stratum, besides population
+STRATA = ("treatment", "condition", "sample_type", "timepoint")
+
+# Same minimum group size as data_analysis.statistical_tests
+MIN_GROUP_SIZE = 3
+
+
+def mann_whitney_grid(strata, responders, values, n_strata=None):
+    """
+    Two-sided Mann–Whitney U tests for many strata with one sort.
+
+    strata: int array, stratum code (0..n_strata-1) per observation
+    responders: bool array, True for the responder group
+    values: float array, observations (NaNs are dropped)
+    n_strata: number of strata (default: largest code + 1)
+
+    Ranks are computed within each stratum after a single lexsort on
+    (stratum, value), with ties getting their average rank. p-values use
+    the tie-corrected normal approximation with continuity correction,
+    i.e. scipy.stats.mannwhitneyu(..., method="asymptotic").
+
+    Returns a dict of arrays indexed by stratum code: "n_yes", "n_no",
+    "u" (the responders' U statistic) and "p" (NaN for empty strata).
+    """
+    strata = np.asarray(strata, dtype=np.intp)
+    responders = np.asarray(responders, dtype=bool)
+    values = np.asarray(values, dtype=np.float64)
+
+    if n_strata is None:
+        n_strata = int(strata.max()) + 1 if strata.size else 0
+    k = n_strata
+
+    keep = ~np.isnan(values)
+    strata, responders, values = strata[keep], responders[keep], values[keep]
+
+    order = np.lexsort((values, strata))
+    strata, responders, values = strata[order], responders[order], values[order]
+    n = strata.size
+
+    # 1-based position of each observation within its stratum
+    sizes = np.bincount(strata, minlength=k)
+    starts = np.cumsum(sizes) - sizes
+    positions = np.arange(n) - starts[strata] + 1
+
+    # Runs of tied values within a stratum share their average rank
+    new_run = np.ones(n, dtype=bool)
+    new_run[1:] = (strata[1:] != strata[:-1]) | (values[1:] != values[:-1])
+    run_starts = np.flatnonzero(new_run)
+    run_lengths = np.diff(np.append(run_starts, n))
+    run_ranks = positions[run_starts] + (run_lengths - 1) / 2.0
+    ranks = np.repeat(run_ranks, run_lengths)
+
+    n_yes = np.bincount(strata, weights=responders, minlength=k)
+    n_no = sizes - n_yes
+    rank_sums = np.bincount(strata, weights=ranks * responders, minlength=k)
+    ties = np.bincount(
+        strata[run_starts],
+        weights=run_lengths.astype(np.float64) ** 3 - run_lengths,
+        minlength=k
+    )
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        u_yes = rank_sums - n_yes * (n_yes + 1) / 2.0
+        u_max = np.maximum(u_yes, n_yes * n_no - u_yes)
+        total = n_yes + n_no
+        mean = n_yes * n_no / 2.0
+        variance = n_yes * n_no / 12.0 * (
+            (total + 1) - ties / (total * (total - 1))
+        )
+        z = (u_max - mean - 0.5) / np.sqrt(variance)
+        p = np.clip(2.0 * ndtr(-z), 0.0, 1.0)
+
+    return {
+        "n_yes": n_yes.astype(np.int64),
+        "n_no": n_no.astype(np.int64),
+        "u": u_yes,
+        "p": p,
+    }
+
+
+def benjamini_hochberg(p_values):
+    """
+    Benjamini–Hochberg adjusted p-values (q-values); NaNs are ignored and
+    stay NaN.
+    """
+    p_values = np.asarray(p_values, dtype=np.float64)
+    q_values = np.full_like(p_values, np.nan)
+
+    tested = np.flatnonzero(~np.isnan(p_values))
+    m = tested.size
+    if m == 0:
+        return q_values
+
+    order = tested[np.argsort(p_values[tested])]
+    scaled = p_values[order] * m / np.arange(1, m + 1)
+    q_values[order] = np.minimum(
+        np.minimum.accumulate(scaled[::-1])[::-1], 1.0
+    )
+    return q_values
+
+
+@staged("batch_stats.fetch_grid_data", rows=len)
+def fetch_grid_data(conn):
+    """
+    Every responder/non-responder frequency with its stratum columns.
+    """
+    return read_frame(conn, GRID_FREQUENCIES_SQL)
+
+
+@staged("batch_stats.grid_tests", rows=len)
+def grid_tests(frame, by=STRATA, min_group_size=MIN_GROUP_SIZE):
+    """
+    Runs mann_whitney_grid over every (by..., population) stratum of a
+    frame shaped like fetch_grid_data and adds BH q-values across all
+    strata with at least min_group_size samples in both groups.
+
+    Returns one row per tested stratum: the by columns, population,
+    n_yes, n_no, u, p and q.
+    """
+    keys = list(by) + ["population"]
+    grouped = frame.groupby(keys, sort=True, dropna=False)
+    codes = grouped.ngroup().to_numpy()
+
+    result = mann_whitney_grid(
+        codes,
+        (frame["response"] == "yes").to_numpy(),
+        frame["percentage"].to_numpy(dtype=np.float64),
+        n_strata=grouped.ngroups
+    )
+
+    # ngroup codes follow the sorted group order of size()
+    tests = grouped.size().index.to_frame(index=False)
+    for column, values in result.items():
+        tests[column] = values
+
+    tests = tests[
+        (tests["n_yes"] >= min_group_size) & (tests["n_no"] >= min_group_size)
+    ].reset_index(drop=True)
+    tests["q"] = benjamini_hochberg(tests["p"].to_numpy())
+
+    return tests
+
+
+def response_grid_tests(conn, by=STRATA, min_group_size=MIN_GROUP_SIZE):
+    return grid_tests(fetch_grid_data(conn), by, min_group_size)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--all",
+        action="store_true",
+        help="print every tested stratum, not only those with q < 0.05"
+    )
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    configure(args.profile)
+
+    with instrument(open_storage().connect()) as conn:
+        tests = response_grid_tests(conn)
+
+    if not args.all:
+        tests = tests[tests["q"] < 0.05]
+
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(tests.to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,450 @@
+"""
+Benchmarks for the database build and analysis pipeline.
+
+    python benchmark.py frequencies --sizes 10000 1000000 10000000
+    python benchmark.py stats --samples 1000000
+    python benchmark.py pipeline --subjects 100000 --projects 10
+
+The pipeline benchmark writes a synthetic CSV shaped like cell-count.csv
+for each project, then times every stage from ingest to dashboard
+callbacks on them and appends the timings, with the current commit, to a
+JSON Lines file.
+"""
+import argparse
+import csv
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import subprocess
+import tempfile
+import time
+from contextlib import ExitStack, contextmanager
+
+import numpy as np
+
+import database_setup
+from instrumentation import add_profile_argument, configure, instrument
+
+RESULTS_FILE = "benchmark_results.jsonl"
+
+# Synthetic cohort makeup, following cell-count.csv: healthy subjects are
+# untreated and have no response
+CONDITION_TREATMENTS = {
+    "melanoma": ("miraclib", "phauximab"),
+    "carcinoma": ("miraclib", "phauximab"),
+    "healthy": ("none",),
+}
+SAMPLE_TYPES = ("PBMC", "WB")
+TIMEPOINTS = (0, 7, 14)
+POPULATION_COLUMNS = database_setup.CSV_COLUMNS[10:]
+
+
+def generate_csvs(directory, n_subjects, n_projects=3, samples_per_subject=3,
+                  timepoints=TIMEPOINTS, seed=0, chunk_subjects=100_000):
+    """
+    Writes random CSV exports with the columns of cell-count.csv, one per
+    project (prj1.csv, prj2.csv, ... in directory): n_subjects subjects
+    spread evenly over n_projects projects, each with samples_per_subject
+    samples of one sample type taken at the timepoints in turn.
+
+    Returns the number of samples written and the paths of the files.
+    """
+    rng = np.random.default_rng(seed)
+    conditions = list(CONDITION_TREATMENTS)
+    n_samples = 0
+    paths = [
+        os.path.join(directory, f"prj{project + 1}.csv")
+        for project in range(n_projects)
+    ]
+
+    with ExitStack() as files:
+        writers = []
+        for path in paths:
+            writer = csv.writer(
+                files.enter_context(open(path, "w", newline=""))
+            )
+            writer.writerow(database_setup.CSV_COLUMNS)
+            writers.append(writer)
+
+        for first in range(0, n_subjects, chunk_subjects):
+            size = min(chunk_subjects, n_subjects - first)
+            condition = rng.integers(0, len(conditions), size)
+            treatment = rng.integers(0, 2, size)
+            age = rng.integers(20, 90, size)
+            sex = rng.choice(["M", "F"], size)
+            response = rng.choice(["yes", "no"], size)
+            sample_type = rng.choice(SAMPLE_TYPES, size, p=[0.7, 0.3])
+            counts = rng.integers(
+                1_000, 40_000,
+                (size, samples_per_subject, len(POPULATION_COLUMNS))
+            )
+
+            rows = [[] for _ in writers]
+            for i in range(size):
+                subject = first + i
+                condition_name = conditions[condition[i]]
+                treatments = CONDITION_TREATMENTS[condition_name]
+                healthy = len(treatments) == 1
+
+                for k in range(samples_per_subject):
+                    rows[subject % n_projects].append((
+                        f"prj{subject % n_projects + 1}",
+                        f"sbj{subject:06d}",
+                        condition_name,
+                        age[i],
+                        sex[i],
+                        treatments[0 if healthy else treatment[i]],
+                        "" if healthy else response[i],
+                        f"sample{n_samples:08d}",
+                        sample_type[i],
+                        timepoints[k % len(timepoints)],
+                        *counts[i, k],
+                    ))
+                    n_samples += 1
+
+            for writer, project_rows in zip(writers, rows):
+                writer.writerows(project_rows)
+
+    return n_samples, paths
+
+
+def build_synthetic_db(conn, n_samples, seed=0, n_treatments=1,
+                       n_conditions=1):
+    """
+    Fills the normalized tables and cell_counts_csv with n_samples random
+    samples (three timepoints per subject) without going through a CSV.
+    Subjects are spread round-robin over every combination of
+    n_treatments treatments and n_conditions conditions.
+    """
+    rng = random.Random(seed)
+    n_subjects = (n_samples + 2) // 3
+
+    database_setup.initialize_db(conn)
+
+    with database_setup.bulk_load_pragmas(conn):
+        conn.execute("INSERT INTO projects (id, name) VALUES (1, 'prj1')")
+        conn.executemany(
+            "INSERT INTO treatments (id, name) VALUES (?, ?)",
+            ((t, f"treatment{t}") for t in range(1, n_treatments + 1))
+        )
+        conn.executemany("""
+            INSERT INTO subjects
+            (id, project_id, subject_code, condition, age, sex)
+            VALUES (?, 1, ?, ?, ?, ?)
+        """, (
+            (i, f"sbj{i:08d}", f"condition{(i - 1) // n_treatments % n_conditions}",
+             rng.randint(20, 90), rng.choice("MF"))
+            for i in range(1, n_subjects + 1)
+        ))
+        conn.executemany("""
+            INSERT INTO samples
+            (id, subject_id, treatment_id, response, sample_code,
+             sample_type, time_from_treatment_start)
+            VALUES (?, ?, ?, ?, ?, 'PBMC', ?)
+        """, (
+            (i, (i - 1) // 3 + 1, (i - 1) // 3 % n_treatments + 1,
+             rng.choice(("yes", "no")), f"sample{i:09d}",
+             float((i - 1) % 3 * 7))
+            for i in range(1, n_samples + 1)
+        ))
+        conn.executemany("""
+            INSERT INTO cell_counts
+            (sample_id, b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, (
+            (i, *(float(rng.randint(1_000, 40_000)) for _ in range(5)))
+            for i in range(1, n_samples + 1)
+        ))
+
+    database_setup.wide_table(conn)
+
+
+def benchmark_frequencies(sizes, engines=("sql", "numpy")):
+    """
+    Times relative_cell_pops for each engine on synthetic databases of
+    the given numbers of samples.
+    """
+    results = []
+
+    with tempfile.TemporaryDirectory() as tmp:
+        for n_samples in sizes:
+            db_file = os.path.join(tmp, f"bench_{n_samples}.db")
+
+            with sqlite3.connect(db_file) as conn:
+                build_synthetic_db(conn, n_samples)
+
+                for engine in engines:
+                    start = time.perf_counter()
+                    database_setup.relative_cell_pops(conn, engine)
+                    elapsed = time.perf_counter() - start
+                    results.append((n_samples, engine, elapsed))
+                    print(f"{n_samples:>12,} samples  {engine:<6} {elapsed:8.2f} s")
+
+            os.remove(db_file)
+
+    return results
+
+
+def benchmark_stats(n_samples, n_treatments=20, n_conditions=10):
+    """
+    Times batch_stats.grid_tests against a per-stratum mannwhitneyu loop
+    over the same (treatment x condition x timepoint x population) grid.
+    """
+    from scipy.stats import mannwhitneyu
+
+    import batch_stats
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "bench_stats.db")
+
+        with sqlite3.connect(db_file) as conn:
+            build_synthetic_db(
+                conn, n_samples,
+                n_treatments=n_treatments, n_conditions=n_conditions
+            )
+            database_setup.relative_cell_pops(conn)
+            frame = batch_stats.fetch_grid_data(conn)
+
+    start = time.perf_counter()
+    tests = batch_stats.grid_tests(frame)
+    batched = time.perf_counter() - start
+
+    start = time.perf_counter()
+    keys = list(batch_stats.STRATA) + ["population"]
+    looped = {}
+    for key, group in frame.groupby(keys):
+        responders = group["percentage"][group["response"] == "yes"]
+        non_responders = group["percentage"][group["response"] == "no"]
+        if min(len(responders), len(non_responders)) < batch_stats.MIN_GROUP_SIZE:
+            continue
+        looped[key] = mannwhitneyu(
+            responders, non_responders, method="asymptotic"
+        ).pvalue
+    loop = time.perf_counter() - start
+
+    max_difference = float(np.max(np.abs(
+        tests["p"].to_numpy()
+        - np.array([looped[tuple(row)] for row in tests[keys].itertuples(index=False)])
+    )))
+
+    print(f"{len(tests):,} tests over {len(frame):,} frequencies")
+    print(f"  batched  {batched:8.3f} s")
+    print(f"  loop     {loop:8.3f} s")
+    print(f"  max |p difference| {max_difference:.2e}")
+
+    return {
+        "tests": len(tests),
+        "batched_seconds": batched,
+        "loop_seconds": loop,
+        "max_p_difference": max_difference,
+    }
+
+
+@contextmanager
+def timed(timings, name):
+    start = time.perf_counter()
+    yield
+    timings[name] = time.perf_counter() - start
+    print(f"  {name:<40} {timings[name]:9.3f} s")
+
+
+def current_commit():
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"],
+            capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def benchmark_pipeline(n_subjects, n_projects=3, samples_per_subject=3,
+                       timepoints=TIMEPOINTS, seed=0, workers=1,
+                       users=8, n_requests=25):
+    """
+    Times, on synthetic CSVs (one per project, so ingest parses them in
+    parallel): generating them, ingest (parse, load, derive, index),
+    re-deriving the frequencies with each engine, every shipped query
+    (queries.shipped_queries), the statistical tests, and dashboard
+    callback latency under `users` concurrent simulated users.
+
+    Returns the timings (seconds) and load test results as a dict.
+    """
+    import batch_stats
+    import data_analysis
+    import dashboard
+    import load_test
+    import longitudinal
+    from data_provider import DataProvider
+    from queries import RESPONSE_COHORT, shipped_queries
+
+    timings = {}
+    result = {
+        "commit": current_commit(),
+        "timestamp": datetime.datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "config": {
+            "subjects": n_subjects,
+            "projects": n_projects,
+            "samples_per_subject": samples_per_subject,
+            "timepoints": list(timepoints),
+            "seed": seed,
+            "workers": workers,
+            "users": users,
+            "requests_per_user": n_requests,
+        },
+        "timings": timings,
+    }
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_file = os.path.join(tmp, "synthetic.db")
+
+        with timed(timings, "generate_csv"):
+            result["samples"], csv_files = generate_csvs(
+                tmp, n_subjects, n_projects, samples_per_subject,
+                timepoints, seed
+            )
+        result["csv_bytes"] = sum(map(os.path.getsize, csv_files))
+        print(f"{result['samples']:,} samples, "
+              f"{result['csv_bytes'] / 1e6:,.1f} MB of CSV "
+              f"in {len(csv_files)} files")
+
+        with instrument(sqlite3.connect(db_file, timeout=30)) as conn:
+            with timed(timings, "ingest"):
+                database_setup.ingest(conn, csv_files, workers=workers)
+
+            for engine in sorted(database_setup.FREQUENCY_ENGINES):
+                with timed(timings, f"frequencies.{engine}"):
+                    database_setup.relative_cell_pops(conn, engine)
+            database_setup.create_indexes(conn)
+
+            for name, (sql, params) in shipped_queries().items():
+                with timed(timings, f"query.{name}"):
+                    conn.execute(sql, params).fetchall()
+            # Undoes summaries_group_delete
+            conn.rollback()
+
+            with timed(timings, "stats.fetch_response_data"):
+                data = data_analysis.fetch_response_data(conn)
+            with timed(timings, "stats.mann_whitney"):
+                data_analysis.mann_whitney_results(data)
+            with timed(timings, "stats.grid_tests"):
+                batch_stats.response_grid_tests(conn)
+            with timed(timings, "stats.longitudinal"):
+                longitudinal.compare_trajectories(
+                    longitudinal.fetch_trajectories(conn, **RESPONSE_COHORT)
+                )
+
+            with timed(timings, "dashboard.warm_cache"):
+                dashboard.warm_analysis_cache(conn)
+
+        # The callbacks read through dashboard.provider, so pointing it
+        # at the synthetic database is all the app needs
+        dashboard.provider = DataProvider(db_file)
+        with timed(timings, "dashboard.load_test"):
+            result["dashboard"] = load_test.load_test(
+                load_test.in_process_sender(dashboard.app.server),
+                users, n_requests, seed
+            )
+        load_test.print_results(result["dashboard"])
+
+    return result
+
+
+def record_result(result, path=RESULTS_FILE):
+    """
+    Appends one benchmark run to a JSON Lines file, one run per line.
+    """
+    with open(path, "a") as f:
+        f.write(json.dumps(result, sort_keys=True) + "\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    frequencies = commands.add_parser(
+        "frequencies",
+        help="compare the SQL and NumPy cell_population_frequencies engines"
+    )
+    frequencies.add_argument(
+        "--sizes",
+        type=int,
+        nargs="+",
+        default=[10_000, 1_000_000, 10_000_000],
+        help="numbers of samples to benchmark (default: %(default)s)"
+    )
+    frequencies.add_argument(
+        "--engines",
+        nargs="+",
+        choices=sorted(database_setup.FREQUENCY_ENGINES),
+        default=["sql", "numpy"]
+    )
+
+    stats = commands.add_parser(
+        "stats",
+        help="compare batched Mann-Whitney tests with a per-test loop"
+    )
+    stats.add_argument("--samples", type=int, default=300_000)
+    stats.add_argument("--treatments", type=int, default=20)
+    stats.add_argument("--conditions", type=int, default=10)
+
+    pipeline = commands.add_parser(
+        "pipeline",
+        help="time ingest, analysis and dashboard on a synthetic CSV"
+    )
+    pipeline.add_argument("--subjects", type=int, default=3_500)
+    pipeline.add_argument("--projects", type=int, default=3)
+    pipeline.add_argument("--samples-per-subject", type=int, default=3)
+    pipeline.add_argument(
+        "--timepoints",
+        type=int,
+        nargs="+",
+        default=list(TIMEPOINTS),
+        help="time_from_treatment_start values cycled through by each "
+             "subject's samples (default: %(default)s)"
+    )
+    pipeline.add_argument("--seed", type=int, default=0)
+    pipeline.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="ingest processes (default: %(default)s)"
+    )
+    pipeline.add_argument("--users", type=int, default=8)
+    pipeline.add_argument("--requests", type=int, default=25)
+    pipeline.add_argument(
+        "--output",
+        default=RESULTS_FILE,
+        help="JSON Lines file the run is appended to (default: %(default)s)"
+    )
+
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    configure(args.profile)
+
+    if args.command == "pipeline":
+        result = benchmark_pipeline(
+            args.subjects,
+            n_projects=args.projects,
+            samples_per_subject=args.samples_per_subject,
+            timepoints=args.timepoints,
+            seed=args.seed,
+            workers=args.workers,
+            users=args.users,
+            n_requests=args.requests
+        )
+        record_result(result, args.output)
+        print(f"\nResults appended to {args.output}")
+    elif args.command == "frequencies":
+        benchmark_frequencies(args.sizes, args.engines)
+    elif args.command == "stats":
+        benchmark_stats(args.samples, args.treatments, args.conditions)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,391 @@
+"""
+Ad-hoc cohort queries from the command line.
+
+A query is a list of terms: filters on cell_counts_csv columns, optional
+aggregations and grouping, and a row limit.
+
+    python cohort_query.py condition=melanoma sex=M response=yes t=0 \\
+        "agg=mean(b_cell)"
+    python cohort_query.py treatment=miraclib "agg=count(*),mean(cd4_t_cell)" \\
+        by=response,sex --format json
+    python cohort_query.py project=prj1 "age>=60" limit=20
+
+Filters are name=value (several values as name=a,b), name!=value or a
+comparison (<, <=, >, >=); names are cell_counts_csv columns or the
+cohort filter names of queries.py, with t for timepoint. Aggregations are
+count, sum, mean, min and max of a column, or count(*). Without agg= the
+matching samples are listed, in load order when limit= is given.
+
+Each query is compiled to a single parameterized statement. Compiled
+statements are cached by the query's shape (its terms without their
+values), so queries differing only in values share the same SQL text and
+the driver reuses the prepared statement (SQLite's per-connection
+statement cache, psycopg's automatic prepare). Counts, sums and means of
+cell counts filtered and grouped on the cohort summary columns are read
+from cohort_summaries (see summaries.py), which answers them in time
+independent of the number of samples; everything else reads
+cell_counts_csv through its indexes. Results are streamed as CSV or JSON.
+
+Without query terms, one query per line is read from stdin.
+"""
+import argparse
+import csv
+import functools
+import json
+import re
+import shlex
+import sqlite3
+import sys
+
+from database_setup import CSV_COLUMNS
+from instrumentation import add_profile_argument, configure, instrument, staged
+from queries import COHORT_COLUMNS, query_plan
+from storage import open_storage, stream
+from summaries import SUMMARY_COLUMNS, available as summaries_available
+
+# Compiled statements kept, by query shape
+STATEMENT_CACHE_SIZE = 256
+
+POPULATIONS = CSV_COLUMNS[10:]
+
+NUMERIC_COLUMNS = ("age", "time_from_treatment_start") + POPULATIONS
+
+# Filter name -> cell_counts_csv column
+COLUMNS = {
+    **{column: column for column in CSV_COLUMNS},
+    **COHORT_COLUMNS,
+    "t": "time_from_treatment_start",
+}
+
+# Aggregation -> SQL function
+AGGREGATES = {
+    "count": "COUNT",
+    "sum": "SUM",
+    "mean": "AVG",
+    "avg": "AVG",
+    "min": "MIN",
+    "max": "MAX",
+}
+
+# Aggregations cohort_summaries can answer, from (count_n, count_sum)
+SUMMARY_AGGREGATES = ("count", "sum", "mean", "avg")
+
+TERM = re.compile(r"^(?P<name>\w+)\s*(?P<operator>!=|<=|>=|=|<|>)\s*(?P<value>.*)$")
+
+AGGREGATION = re.compile(r"^(?P<function>\w+)\((?P<column>\*|\w*)\)$")
+
+
+# -------------------------
+# Parsing
+# -------------------------
+
+def _column(name):
+    if name not in COLUMNS:
+        raise ValueError(f"Unknown column: {name}")
+    return COLUMNS[name]
+
+
+def _value(column, text):
+    if column not in NUMERIC_COLUMNS:
+        return text
+    try:
+        return float(text)
+    except ValueError:
+        raise ValueError(f"{column} needs a number, not {text!r}") from None
+
+
+def _aggregations(text):
+    aggregations = []
+    for part in filter(None, (part.strip() for part in text.split(","))):
+        match = AGGREGATION.match(part)
+        if not match or match["function"] not in AGGREGATES:
+            raise ValueError(f"Unsupported aggregation: {part}")
+        function, column = match["function"], match["column"]
+        if column in ("", "*"):
+            if function != "count":
+                raise ValueError(f"{function}() needs a column")
+            column = "*"
+        else:
+            column = _column(column)
+        aggregations.append((function, column))
+    return aggregations
+
+
+def parse_query(terms):
+    """
+    Splits query terms into the query's shape and its parameters.
+
+    Returns (shape, params): shape is a hashable
+    (filters, aggregations, group_by, limited) with filters as
+    (column, operator, number of values) tuples; params are the filter
+    values followed by the limit.
+    """
+    filters = []
+    params = []
+    aggregations = []
+    group_by = []
+    limit = None
+
+    for term in terms:
+        match = TERM.match(term.strip())
+        if not match:
+            raise ValueError(f"Cannot parse query term: {term}")
+        name, operator, value = match["name"], match["operator"], match["value"]
+
+        if name in ("agg", "by", "limit") and operator != "=":
+            raise ValueError(f"{name} takes =, not {operator}")
+
+        if name == "agg":
+            aggregations += _aggregations(value)
+        elif name == "by":
+            group_by += [_column(part.strip())
+                         for part in value.split(",") if part.strip()]
+        elif name == "limit":
+            try:
+                limit = int(value)
+            except ValueError:
+                raise ValueError(f"limit needs an integer, not {value!r}") \
+                    from None
+        else:
+            column = _column(name)
+            values = value.split(",") if operator in ("=", "!=") else [value]
+            filters.append((column, operator, len(values)))
+            params += [_value(column, part.strip()) for part in values]
+
+    if group_by and not aggregations:
+        raise ValueError("by= needs at least one agg=")
+    if limit is not None:
+        params.append(limit)
+
+    shape = (
+        tuple(filters), tuple(aggregations), tuple(group_by),
+        limit is not None,
+    )
+    return shape, params
+
+
+# -------------------------
+# Compilation
+# -------------------------
+
+def _where(alias, filters):
+    conditions = []
+    for column, operator, n_values in filters:
+        if n_values > 1:
+            negation = "NOT " if operator == "!=" else ""
+            placeholders = ", ".join("?" * n_values)
+            conditions.append(f"{alias}{column} {negation}IN ({placeholders})")
+        else:
+            conditions.append(f"{alias}{column} {operator} ?")
+
+    if not conditions:
+        return ""
+    return "WHERE " + "\n        AND ".join(conditions)
+
+
+def _label(function, column):
+    return f"{function}({column})"
+
+
+def _answerable_from_summaries(filters, aggregations, group_by):
+    return (
+        aggregations
+        and all(column in SUMMARY_COLUMNS for column, _, _ in filters)
+        and all(column in SUMMARY_COLUMNS for column in group_by)
+        and all(function in SUMMARY_AGGREGATES and column in POPULATIONS
+                for function, column in aggregations)
+    )
+
+
+def _summary_statement(filters, aggregations, group_by, limited):
+    selects = []
+    for function, column in aggregations:
+        count_n = f"SUM(CASE WHEN p.name = '{column}' THEN s.count_n END)"
+        count_sum = f"SUM(CASE WHEN p.name = '{column}' THEN s.count_sum END)"
+        expression = {
+            "count": f"COALESCE({count_n}, 0)",
+            "sum": count_sum,
+            "mean": f"{count_sum} / NULLIF({count_n}, 0)",
+            "avg": f"{count_sum} / NULLIF({count_n}, 0)",
+        }[function]
+        selects.append(f'{expression} AS "{_label(function, column)}"')
+
+    group = ", ".join("s." + column for column in group_by)
+    return f"""
+    SELECT {", ".join([group] * bool(group) + selects)}
+    FROM cohort_summaries s
+    JOIN populations p ON p.id = s.population_id
+    {_where("s.", filters)}
+    {f"GROUP BY {group} ORDER BY {group}" if group else ""}
+    {"LIMIT ?" if limited else ""}
+    """
+
+
+def _table_statement(filters, aggregations, group_by, limited):
+    if aggregations:
+        selects = list(group_by) + [
+            f'{AGGREGATES[function]}({column}) AS "{_label(function, column)}"'
+            for function, column in aggregations
+        ]
+        group = ", ".join(group_by)
+        order = f"GROUP BY {group} ORDER BY {group}" if group else ""
+    else:
+        # Only a limited listing is sorted (to pick its first rows);
+        # otherwise the rows stream in the order the filters' index
+        # yields them instead of the whole table being walked by sample_id
+        selects = list(CSV_COLUMNS)
+        order = "ORDER BY sample_id" if limited else ""
+
+    return f"""
+    SELECT {", ".join(selects)}
+    FROM cell_counts_csv
+    {_where("", filters)}
+    {order}
+    {"LIMIT ?" if limited else ""}
+    """
+
+
+@functools.lru_cache(maxsize=STATEMENT_CACHE_SIZE)
+def compile_shape(shape, use_summaries=True):
+    """
+    The SQL statement and output column names of a query shape (see
+    parse_query), from cohort_summaries when use_summaries and the shape
+    allows it, else from cell_counts_csv.
+    """
+    filters, aggregations, group_by, limited = shape
+
+    if use_summaries and _answerable_from_summaries(
+            filters, aggregations, group_by):
+        sql = _summary_statement(filters, aggregations, group_by, limited)
+    else:
+        sql = _table_statement(filters, aggregations, group_by, limited)
+
+    if aggregations:
+        columns = list(group_by) + [_label(*a) for a in aggregations]
+    else:
+        columns = list(CSV_COLUMNS)
+    return sql, tuple(columns)
+
+
+def compile_query(terms, use_summaries=True):
+    """
+    Returns (sql, params, columns) for a list of query terms.
+    """
+    shape, params = parse_query(terms)
+    sql, columns = compile_shape(shape, use_summaries)
+    return sql, params, columns
+
+
+# -------------------------
+# Output
+# -------------------------
+
+def _write_csv(columns, chunks, out):
+    writer = csv.writer(out)
+    writer.writerow(columns)
+    n = 0
+    for rows in chunks:
+        writer.writerows(rows)
+        n += len(rows)
+    return n
+
+
+def _write_json(columns, chunks, out):
+    n = 0
+    out.write("[")
+    for rows in chunks:
+        for row in rows:
+            out.write(",\n " if n else "\n ")
+            out.write(json.dumps(dict(zip(columns, row)), default=float))
+            n += 1
+    out.write("\n]\n" if n else "]\n")
+    return n
+
+
+WRITERS = {"csv": _write_csv, "json": _write_json}
+
+
+@staged("cohort_query.run_query", rows=int)
+def run_query(conn, terms, out=sys.stdout, output_format="csv",
+              use_summaries=True):
+    """
+    Compiles a query, streams its rows to out and returns their number.
+    """
+    sql, params, columns = compile_query(
+        terms, use_summaries and summaries_available(conn)
+    )
+    return WRITERS[output_format](columns, stream(conn, sql, params), out)
+
+
+def explain(conn, terms, out=sys.stdout, use_summaries=True):
+    sql, params, _ = compile_query(
+        terms, use_summaries and summaries_available(conn)
+    )
+    out.write(sql.strip() + "\n")
+    out.write(f"params: {params}\n")
+    if isinstance(conn, sqlite3.Connection):
+        for step in query_plan(conn, sql, params):
+            out.write(f"  {step}\n")
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=__doc__.strip().splitlines()[0],
+        epilog="e.g. condition=melanoma sex=M response=yes t=0 "
+               "'agg=mean(b_cell)'"
+    )
+    parser.add_argument(
+        "terms",
+        nargs="*",
+        help="query terms; without any, one query per line is read "
+             "from stdin"
+    )
+    parser.add_argument("--format", choices=WRITERS, default="csv")
+    parser.add_argument(
+        "--no-summaries",
+        action="store_true",
+        help="always read cell_counts_csv, even where cohort_summaries "
+             "could answer the query"
+    )
+    parser.add_argument(
+        "--explain",
+        action="store_true",
+        help="print the compiled SQL, its parameters and (on SQLite) its "
+             "query plan instead of running it"
+    )
+    parser.add_argument(
+        "--database",
+        help="database URL or SQLite path (default: $CELL_COUNTS_DATABASE "
+             "or cell_counts.db)"
+    )
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    configure(args.profile)
+
+    queries = [args.terms] if args.terms else (
+        shlex.split(line) for line in sys.stdin if line.strip()
+    )
+    use_summaries = not args.no_summaries
+    failed = False
+
+    with instrument(open_storage(args.database).connect_reader()) as conn:
+        for terms in queries:
+            try:
+                if args.explain:
+                    explain(conn, terms, use_summaries=use_summaries)
+                else:
+                    run_query(conn, terms, sys.stdout, args.format,
+                              use_summaries)
+            except ValueError as error:
+                if args.terms:
+                    parser.error(str(error))
+                print(f"error: {error}", file=sys.stderr)
+                failed = True
+            sys.stdout.flush()
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
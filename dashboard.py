@@ -1,100 +1,141 @@
 import os
-import sqlite3
+from math import ceil
+
 import pandas as pd
-from dash import Dash, dcc, html, dash_table, Input, Output
+from dash import Dash, dcc, html, dash_table, Input, Output, State, no_update
+from flask import abort, send_file
 import plotly.express as px
+import plotly.graph_objects as go
+
+from data_provider import POLL_SECONDS, DataProvider
+from figures import (
+    FIGURE_DIR,
+    cached_box_statistics,
+    cached_cohort_summary,
+    load_index,
+    object_path,
+    outlier_label,
+)
+from instrumentation import configure
+from queries import (
+    FREQUENCY_TABLE_COLUMNS,
+    cohort_values,
+    frequency_count_query,
+    frequency_page_query,
+)
+from result_cache import cohort_key
+from storage import read_frame
+
+TABLE_PAGE_SIZE = 15
 
-DB_FILE = "cell_counts.db"
+RESPONSE_COLORS = {"yes": "#636EFA", "no": "#EF553B"}
+
+# Cohort dropdowns (queries.COHORT_COLUMNS names) and their initial
+# selections; an empty selection means "any"
+COHORT_FILTERS = {
+    "treatment": ["miraclib"],
+    "condition": ["melanoma"],
+    "sample_type": ["PBMC"],
+    "sex": [],
+    "project": [],
+    "timepoint": [],
+}
+
+# Every loader below reads through this, so nothing is read at import
+# and new ingests are picked up within POLL_SECONDS. The database is
+# CELL_COUNTS_DATABASE (a SQLite file or postgresql:// URL) if set.
+provider = DataProvider()
+
+# Per-load timings as JSON logs when CELL_COUNTS_PROFILE is set
+configure()
 
 # -------------------------
 # Data loading helpers
 # -------------------------
 
-def load_relative_frequencies():
-    with sqlite3.connect(DB_FILE) as conn:
-        return pd.read_sql_query(
-            "SELECT * FROM cell_population_frequencies", conn
-        )
+def load_populations():
+    return provider.get("populations", lambda conn: [
+        name for (name,)
+        in conn.execute("SELECT name FROM populations ORDER BY name")
+    ])
 
-def load_response_data():
-    with sqlite3.connect(DB_FILE) as conn:
-        return pd.read_sql_query("""
-            SELECT
-                f.sample,
-                f.population,
-                f.percentage,
-                c.response,
-                c.sex
-            FROM cell_population_frequencies f
-            JOIN cell_counts_csv c
-              ON f.sample = c.sample
-            WHERE
-                c.treatment = 'miraclib'
-                AND c.sample_type = 'PBMC'
-                AND c.response IN ('yes', 'no')
-        """, conn)
-
-def load_sex_subject_counts():
-    with sqlite3.connect(DB_FILE) as conn:
-        return pd.read_sql_query("""
-            SELECT
-                sex,
-                COUNT(DISTINCT subject) AS count
-            FROM cell_counts_csv
-            WHERE
-                condition = 'melanoma'
-                AND treatment = 'miraclib'
-                AND sample_type = 'PBMC'
-            GROUP BY sex
-        """, conn)
-
-def load_baseline_summary():
-    with sqlite3.connect(DB_FILE) as conn:
-        samples = pd.read_sql_query("""
-            SELECT project, COUNT(*) AS count
-            FROM cell_counts_csv
-            WHERE
-                condition = 'melanoma'
-                AND treatment = 'miraclib'
-                AND sample_type = 'PBMC'
-                AND time_from_treatment_start = 0
-            GROUP BY project
-        """, conn)
-
-        response = pd.read_sql_query("""
-            SELECT response, COUNT(DISTINCT subject) AS count
-            FROM cell_counts_csv
-            WHERE
-                condition = 'melanoma'
-                AND treatment = 'miraclib'
-                AND sample_type = 'PBMC'
-                AND time_from_treatment_start = 0
-            GROUP BY response
-        """, conn)
-
-        sex = pd.read_sql_query("""
-            SELECT sex, COUNT(DISTINCT subject) AS count
-            FROM cell_counts_csv
-            WHERE
-                condition = 'melanoma'
-                AND treatment = 'miraclib'
-                AND sample_type = 'PBMC'
-                AND time_from_treatment_start = 0
-            GROUP BY sex
-        """, conn)
+def _frequency_count(conn, filter_query):
+    sql, params = frequency_count_query(filter_query)
+    return conn.execute(sql, params).fetchone()[0]
 
-    return samples, response, sex
+def load_frequency_page(filter_query, sort_by, page, page_size):
+    """
+    One page of cell_population_frequencies and the number of pages for
+    the filter; only the page is ever read into memory.
+    """
+    filter_query = filter_query or ""
+    sql, params = frequency_page_query(filter_query, sort_by, page, page_size)
 
-# -------------------------
-# Load data once
-# -------------------------
+    with provider.connect() as conn:
+        page_frame = read_frame(conn, sql, params)
+
+    total = provider.get(
+        ("frequency_count", filter_query),
+        lambda conn: _frequency_count(conn, filter_query)
+    )
+    return page_frame.to_dict("records"), max(1, ceil(total / page_size))
+
+def selected_cohort(*values):
+    """
+    Cohort filters from the cohort dropdown values, in COHORT_FILTERS
+    order.
+    """
+    return {
+        name: tuple(sorted(value)) if value else None
+        for name, value in zip(COHORT_FILTERS, values)
+    }
+
+def baseline_cohort(cohort):
+    return {**cohort, "timepoint": 0}
+
+def warm_analysis_cache(conn):
+    """
+    Stores the results the initial page needs in analysis_cache through
+    a writable connection, so processes reading through the read-only
+    pool find them there instead of each computing its own.
+    """
+    cohort = selected_cohort(*COHORT_FILTERS.values())
+    cached_box_statistics(conn, cohort)
+    cached_cohort_summary(conn, cohort)
+    cached_cohort_summary(conn, baseline_cohort(cohort))
+
+def load_cohort_values(name):
+    return provider.get(
+        ("cohort_values", name), lambda conn: cohort_values(conn, name)
+    )
+
+def load_response_box_statistics(cohort):
+    return provider.get(
+        ("box_statistics", cohort_key(cohort)),
+        lambda conn: cached_box_statistics(conn, cohort)
+    )
+
+def _counts_frame(counts, key):
+    return pd.DataFrame(list(counts.items()), columns=[key, "count"])
+
+def _cohort_summary(cohort):
+    return provider.get(
+        ("cohort_summary", cohort_key(cohort)),
+        lambda conn: cached_cohort_summary(conn, cohort)
+    )
+
+def load_sex_subject_counts(cohort):
+    summary = _cohort_summary(cohort)
+    return _counts_frame(summary["sex"], "sex")
 
-df_freq = load_relative_frequencies()
-df_response = load_response_data()
-df_samples, df_response_counts, df_sex_counts = load_baseline_summary()
-df_sex_subjects = load_sex_subject_counts()
+def load_baseline_summary(cohort):
+    summary = _cohort_summary(baseline_cohort(cohort))
 
-populations = sorted(df_freq["population"].unique())
+    samples = _counts_frame(summary["project"], "project")
+    response = _counts_frame(summary["response"], "response")
+    sex = _counts_frame(summary["sex"], "sex")
+
+    return samples, response, sex
 
 # -------------------------
 # Dash app
@@ -103,123 +144,313 @@ populations = sorted(df_freq["population"].unique())
 app = Dash(__name__)
 app.title = "Miraclib Immune Response Dashboard"
 
-app.layout = html.Div(
-    style={"padding": "20px", "fontFamily": "Arial"},
-    children=[
-        html.H1("Miraclib Immune Response Dashboard"),
-        html.Hr(),
-
-        html.Label("Select immune cell population:"),
-        dcc.Dropdown(
-            id="population-dropdown",
-            options=[{"label": p, "value": p} for p in populations],
-            value=populations,
-            multi=True
-        ),
+@app.server.route("/figures/<path:name>.png")
+def exported_figure(name):
+    """
+    Serves the latest export of a figure (see figures.py) straight from
+    the figure cache; the content digest doubles as the ETag.
+    """
+    digest = load_index(FIGURE_DIR).get(name)
+    if digest is None:
+        abort(404)
+    return send_file(
+        os.path.abspath(object_path(FIGURE_DIR, digest)),
+        mimetype="image/png",
+        etag=digest
+    )
 
-        html.Br(),
-
-        # -------------------------
-        # Responders vs Non-Responders
-        # -------------------------
-        html.H2("Responders vs Non-Responders (PBMC)"),
-        dcc.Graph(id="response-boxplot"),
-
-        html.Hr(),
-
-        # -------------------------
-        # Male vs Female SUBJECT COUNTS (FIXED)
-        # -------------------------
-        html.H2("Male vs Female Subjects (PBMC)"),
-        dcc.Graph(
-            figure=px.bar(
-                df_sex_subjects,
-                x="sex",
-                y="count",
-                title="Male vs Female Subjects",
-                labels={"count": "Number of Subjects", "sex": "Sex"}
-            )
-        ),
+def _dropdown_options(name):
+    return [
+        {"label": f"{value:g}" if name == "timepoint" else value,
+         "value": value}
+        for value in load_cohort_values(name)
+    ]
 
-        html.Hr(),
-
-        # -------------------------
-        # Baseline summaries
-        # -------------------------
-        html.H2("Baseline Melanoma PBMC Summary"),
-        html.Div(
-            style={"display": "flex", "gap": "40px"},
-            children=[
-                dcc.Graph(
-                    figure=px.bar(
-                        df_samples,
-                        x="project",
-                        y="count",
-                        title="Samples per Project"
-                    )
-                ),
-                dcc.Graph(
-                    figure=px.bar(
-                        df_response_counts,
-                        x="response",
-                        y="count",
-                        title="Subjects by Response"
-                    )
-                ),
-                dcc.Graph(
-                    figure=px.bar(
-                        df_sex_counts,
-                        x="sex",
-                        y="count",
-                        title="Subjects by Sex (Baseline)"
+def serve_layout():
+    """
+    Built per page load, so the first request (not the import) reads
+    the population list and every page starts from the current data.
+    """
+    populations = load_populations()
+
+    return html.Div(
+        style={"padding": "20px", "fontFamily": "Arial"},
+        children=[
+            html.H1("Miraclib Immune Response Dashboard"),
+            dcc.Interval(id="data-poll", interval=POLL_SECONDS * 1000),
+            dcc.Store(id="data-version", data=list(provider.version())),
+            html.Hr(),
+
+            html.Div(
+                style={"display": "flex", "gap": "20px", "flexWrap": "wrap"},
+                children=[
+                    html.Div(
+                        style={"minWidth": "200px"},
+                        children=[
+                            html.Label(name.replace("_", " ").capitalize()),
+                            dcc.Dropdown(
+                                id=f"cohort-{name}",
+                                options=_dropdown_options(name),
+                                value=value,
+                                multi=True,
+                                placeholder="Any"
+                            ),
+                        ]
                     )
-                ),
-            ]
-        ),
+                    for name, value in COHORT_FILTERS.items()
+                ]
+            ),
 
-        html.Hr(),
-
-        # -------------------------
-        # Table
-        # -------------------------
-        html.H2("Relative Cell Population Frequencies"),
-        dash_table.DataTable(
-            columns=[{"name": col, "id": col} for col in df_freq.columns],
-            data=df_freq.to_dict("records"),
-            page_size=15,
-            sort_action="native",
-            filter_action="native",
-            style_table={"overflowX": "auto"},
-            style_cell={"textAlign": "left"}
-        ),
-    ]
-)
+            html.Br(),
+
+            html.Label("Select immune cell population:"),
+            dcc.Dropdown(
+                id="population-dropdown",
+                options=[{"label": p, "value": p} for p in populations],
+                value=populations,
+                multi=True
+            ),
+
+            html.Br(),
+
+            # -------------------------
+            # Responders vs Non-Responders
+            # -------------------------
+            html.H2("Responders vs Non-Responders"),
+            dcc.Graph(id="response-boxplot"),
+
+            html.Hr(),
+
+            # -------------------------
+            # Male vs Female SUBJECT COUNTS (FIXED)
+            # -------------------------
+            html.H2("Male vs Female Subjects"),
+            dcc.Graph(id="sex-subjects-bar"),
+
+            html.Hr(),
+
+            # -------------------------
+            # Baseline summaries
+            # -------------------------
+            html.H2("Baseline Summary (time 0)"),
+            html.Div(
+                style={"display": "flex", "gap": "40px"},
+                children=[
+                    dcc.Graph(id="baseline-samples-bar"),
+                    dcc.Graph(id="baseline-response-bar"),
+                    dcc.Graph(id="baseline-sex-bar"),
+                ]
+            ),
+
+            html.Hr(),
+
+            # -------------------------
+            # Table
+            # -------------------------
+            html.H2("Relative Cell Population Frequencies"),
+            dash_table.DataTable(
+                id="frequency-table",
+                columns=[
+                    {"name": col, "id": col,
+                     "type": "text" if col in ("sample", "population") else "numeric"}
+                    for col in FREQUENCY_TABLE_COLUMNS
+                ],
+                page_current=0,
+                page_size=TABLE_PAGE_SIZE,
+                page_action="custom",
+                sort_action="custom",
+                sort_mode="single",
+                sort_by=[],
+                filter_action="custom",
+                filter_query="",
+                style_table={"overflowX": "auto"},
+                style_cell={"textAlign": "left"}
+            ),
+        ]
+    )
+
+app.layout = serve_layout
 
 # -------------------------
 # Callbacks
 # -------------------------
 
+@app.callback(
+    Output("data-version", "data"),
+    Input("data-poll", "n_intervals"),
+    State("data-version", "data")
+)
+def poll_data_version(n_intervals, current_version):
+    version = list(provider.poll())
+    return no_update if version == current_version else version
+
+@app.callback(
+    Output("population-dropdown", "options"),
+    *(Output(f"cohort-{name}", "options") for name in COHORT_FILTERS),
+    Input("data-version", "data")
+)
+def update_filter_options(version):
+    return (
+        [{"label": p, "value": p} for p in load_populations()],
+        *(_dropdown_options(name) for name in COHORT_FILTERS)
+    )
+
+COHORT_INPUTS = [Input(f"cohort-{name}", "value") for name in COHORT_FILTERS]
+
+@app.callback(
+    Output("sex-subjects-bar", "figure"),
+    Output("baseline-samples-bar", "figure"),
+    Output("baseline-response-bar", "figure"),
+    Output("baseline-sex-bar", "figure"),
+    *COHORT_INPUTS,
+    Input("data-version", "data")
+)
+def update_summary_figures(*values):
+    cohort = selected_cohort(*values[:-1])
+
+    # Loaded first: a loader calling provider.get would hold a second
+    # pooled connection
+    sex_subject_counts = load_sex_subject_counts(cohort)
+    baseline_summary = load_baseline_summary(cohort)
+
+    # Figures are memoized (as plain dicts) per cohort like the data they
+    # are built from, so repeated selections skip building and
+    # validating them
+    return provider.get(
+        ("summary_figures", cohort_key(cohort)),
+        lambda conn: [
+            fig.to_dict()
+            for fig in summary_figures(sex_subject_counts, baseline_summary)
+        ]
+    )
+
+def summary_figures(sex_subject_counts, baseline_summary):
+    df_samples, df_response_counts, df_sex_counts = baseline_summary
+
+    return (
+        px.bar(
+            sex_subject_counts,
+            x="sex",
+            y="count",
+            title="Male vs Female Subjects",
+            labels={"count": "Number of Subjects", "sex": "Sex"}
+        ),
+        px.bar(
+            df_samples,
+            x="project",
+            y="count",
+            title="Samples per Project"
+        ),
+        px.bar(
+            df_response_counts,
+            x="response",
+            y="count",
+            title="Subjects by Response"
+        ),
+        px.bar(
+            df_sex_counts,
+            x="sex",
+            y="count",
+            title="Subjects by Sex (Baseline)"
+        ),
+    )
+
 @app.callback(
     Output("response-boxplot", "figure"),
-    Input("population-dropdown", "value")
+    Input("population-dropdown", "value"),
+    *COHORT_INPUTS,
+    Input("data-version", "data")
 )
-def update_response_boxplot(selected_populations):
-    filtered = df_response[df_response["population"].isin(selected_populations)]
-
-    fig = px.box(
-        filtered,
-        x="population",
-        y="percentage",
-        color="response",
+def update_response_boxplot(selected_populations, *values):
+    selected = tuple(sorted(selected_populations or ()))
+    cohort = selected_cohort(*values[:-1])
+    box_stats = load_response_box_statistics(cohort)
+    return provider.get(
+        ("response_boxplot", cohort_key(cohort), selected),
+        lambda conn: response_boxplot(box_stats, selected).to_dict()
+    )
+
+def response_boxplot(box_stats, selected_populations):
+    selected = set(selected_populations)
+    fig = go.Figure()
+
+    for response, color in RESPONSE_COLORS.items():
+        boxes = [
+            box for box in box_stats
+            if box["response"] == response and box["population"] in selected
+        ]
+        if not boxes:
+            continue
+
+        fig.add_trace(go.Box(
+            name=response,
+            x=[box["population"] for box in boxes],
+            q1=[box["q1"] for box in boxes],
+            median=[box["median"] for box in boxes],
+            q3=[box["q3"] for box in boxes],
+            lowerfence=[box["lowerfence"] for box in boxes],
+            upperfence=[box["upperfence"] for box in boxes],
+            offsetgroup=response,
+            legendgroup=response,
+            marker_color=color,
+            boxpoints=False
+        ))
+        fig.add_trace(go.Scatter(
+            name=response,
+            x=[box["population"] for box in boxes for _ in box["outliers"]],
+            y=[value for box in boxes for value in box["outliers"]],
+            text=[sample for box in boxes for sample in box["outlier_samples"]],
+            mode="markers",
+            offsetgroup=response,
+            legendgroup=response,
+            showlegend=False,
+            marker=dict(color=color, size=4),
+            hovertemplate="%{text}: %{y}<extra></extra>"
+        ))
+        labelled = [box for box in boxes if box["n_outliers"]]
+        fig.add_trace(go.Scatter(
+            name=response,
+            x=[box["population"] for box in labelled],
+            y=[max([box["upperfence"], *box["outliers"]]) for box in labelled],
+            text=[outlier_label(box) for box in labelled],
+            mode="text",
+            textposition="top center",
+            textfont=dict(size=9),
+            offsetgroup=response,
+            legendgroup=response,
+            showlegend=False,
+            hoverinfo="skip"
+        ))
+
+    fig.update_layout(
         title="Relative Frequencies by Response",
-        labels={
-            "percentage": "Relative Frequency",
-            "population": "Cell Population"
-        }
+        xaxis_title="Cell Population",
+        yaxis_title="Relative Frequency",
+        legend_title="response",
+        boxmode="group",
+        scattermode="group"
     )
-    fig.update_layout(boxmode="group")
     return fig
 
+@app.callback(
+    Output("frequency-table", "data"),
+    Output("frequency-table", "page_count"),
+    Input("frequency-table", "page_current"),
+    Input("frequency-table", "page_size"),
+    Input("frequency-table", "sort_by"),
+    Input("frequency-table", "filter_query"),
+    Input("data-version", "data")
+)
+def update_frequency_table(page_current, page_size, sort_by, filter_query,
+                           version):
+    try:
+        return load_frequency_page(
+            filter_query, sort_by, page_current or 0, page_size
+        )
+    except ValueError:
+        # Unparseable filter: show nothing rather than everything
+        return [], 1
+
 # -------------------------
 # Run app
 # -------------------------
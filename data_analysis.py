@@ -1,99 +1,215 @@
-import sqlite3
-import matplotlib.pyplot as plt
+import argparse
+import hashlib
+import json
+import os
+import sys
+from array import array
+from math import nan as NAN
+import numpy as np
+from PIL import Image
 from scipy.stats import mannwhitneyu
 from collections import defaultdict
 
+from figures import (
+    BOX_MODES,
+    RENDER_VERSION,
+    SKETCH_MIN_SAMPLES,
+    cached_box_statistics,
+    default_box_mode,
+    load_box_statistics,
+    render_response_boxplot,
+)
+from instrumentation import add_profile_argument, configure, instrument, staged
+import parquet_backend
+from queries import (
+    AVG_B_CELLS_MALE_RESPONDERS_SQL,
+    BASELINE_COHORT,
+    RESPONSE_COHORT,
+    RESPONSE_FREQUENCIES_SQL,
+    RESPONSE_GROUP_SIZES_SQL,
+    cohort_summary,
+)
+from resampling import print_resampling_results, resampling_tests
+from result_cache import cached
+from storage import open_storage, stream
+from summaries import available as summaries_available, mean_count
+
+# Rows per fetch when streaming response data
+FETCH_CHUNK_SIZE = 10_000
+
+# array('d') item size
+BYTES_PER_VALUE = 8
+
+BYTES_PER_MB = 1_000_000
+
+
+def _value_count(data):
+    return sum(len(values) for groups in data.values()
+               for values in groups.values())
+
+
+@staged("data_analysis.fetch_response_data", rows=_value_count)
+def fetch_response_data(conn, chunk_size=FETCH_CHUNK_SIZE, max_bytes=None):
+    """
+    Streams the responder/non-responder frequencies into one preallocated
+    array('d') per (population, response) group, fetching chunk_size rows
+    at a time, so memory is ~8 bytes per value rather than a Python float
+    object each. Missing percentages are stored as NaN.
 
-DB_FILE = "cell_counts.db"
-
+    Raises MemoryError before fetching anything if the arrays would need
+    more than max_bytes.
 
-def fetch_response_data(conn):
-    """
     Returns:
         dict[cell_population] = {
-            "yes": [percentages],
-            "no":  [percentages]
+            "yes": array('d') of percentages,
+            "no":  array('d') of percentages
         }
     """
     cursor = conn.cursor()
 
-    cursor.execute("""
-        SELECT
-            f.population,
-            c.response,
-            f.percentage
-        FROM cell_population_frequencies f
-        JOIN cell_counts_csv c
-          ON f.sample = c.sample
-        WHERE
-            c.treatment = 'miraclib'
-            AND c.sample_type = 'PBMC'
-            AND c.response IN ('yes', 'no')
-    """)
-
-    data = defaultdict(lambda: {"yes": [], "no": []})
-
-    for population, response, percentage in cursor.fetchall():
-        data[population][response].append(percentage)
+    names = dict(cursor.execute("SELECT id, name FROM populations"))
+    sizes = sorted(
+        (names[population_id], response, n)
+        for population_id, response, n
+        in cursor.execute(RESPONSE_GROUP_SIZES_SQL)
+    )
+    needed = sum(n for _, _, n in sizes) * BYTES_PER_VALUE
+    if max_bytes is not None and needed > max_bytes:
+        raise MemoryError(
+            f"Response data needs {needed:,} bytes, over the "
+            f"{max_bytes:,} byte limit"
+        )
+
+    data = defaultdict(lambda: {"yes": array("d"), "no": array("d")})
+    filled = defaultdict(int)
+    for population, response, n in sizes:
+        data[population][response] = array("d", bytes(BYTES_PER_VALUE * n))
+
+    for rows in stream(conn, RESPONSE_FREQUENCIES_SQL, chunk_size=chunk_size):
+        for population, response, percentage in rows:
+            values = data[population][response]
+            key = (population, response)
+            position = filled[key]
+            value = NAN if percentage is None else percentage
+
+            # Rows committed between the two queries still fit
+            if position < len(values):
+                values[position] = value
+            else:
+                values.append(value)
+            filled[key] = position + 1
+
+    # ...and groups that shrank in between are trimmed
+    for population, groups in data.items():
+        for response, values in groups.items():
+            del values[filled[(population, response)]:]
 
     return data
 
 
-def plot_boxplots(data):
-    populations = sorted(data.keys())
+def megabytes(text):
+    return int(float(text) * BYTES_PER_MB)
 
-    responder_data = [data[p]["yes"] for p in populations]
-    non_responder_data = [data[p]["no"] for p in populations]
 
-    fig, ax = plt.subplots(figsize=(10, 6))
+def add_max_memory_argument(parser):
+    parser.add_argument(
+        "--max-memory",
+        type=megabytes,
+        metavar="MB",
+        help="stop before reading the responder frequencies if they would "
+             "take more than MB megabytes of memory (default: no limit)"
+    )
 
-    positions_yes = [i * 2 for i in range(len(populations))]
-    positions_no = [i * 2 + 0.8 for i in range(len(populations))]
 
-    ax.boxplot(
-        responder_data,
-        positions=positions_yes,
-        widths=0.6,
-        patch_artist=True,
-        boxprops=dict(facecolor="lightblue"),
-        medianprops=dict(color="black")
-    )
+def load_response_data(conn, backend="sqlite", max_bytes=None):
+    """
+    fetch_response_data, or its columnar counterpart when the "parquet"
+    backend is selected and its export is of the current data.
+    """
+    if backend == "parquet":
+        if parquet_backend.available(conn):
+            return parquet_backend.fetch_response_data(max_bytes=max_bytes)
+        print(
+            "Parquet export missing or out of date, reading from SQLite "
+            "(rebuild it with database_setup.py --parquet)",
+            file=sys.stderr
+        )
+    return fetch_response_data(conn, max_bytes=max_bytes)
 
-    ax.boxplot(
-        non_responder_data,
-        positions=positions_no,
-        widths=0.6,
-        patch_artist=True,
-        boxprops=dict(facecolor="salmon"),
-        medianprops=dict(color="black")
-    )
 
-    ax.set_xticks([i * 2 + 0.4 for i in range(len(populations))])
-    ax.set_xticklabels(populations, rotation=45)
-    ax.set_ylabel("Relative Frequency")
-    ax.set_title("Immune Cell Relative Frequencies\nResponders vs Non-Responders (PBMC, Miraclib)")
-
-    ax.legend(
-        handles=[
-            plt.Line2D([0], [0], color="lightblue", lw=6, label="Responders"),
-            plt.Line2D([0], [0], color="salmon", lw=6, label="Non-Responders"),
-        ],
-        loc="upper right"
+BOXPLOT_FILE = "responders_vs_nonresponders_cell_pops.png"
+
+
+def box_statistics_digest(box_stats):
+    """
+    SHA-256 of the plotted statistics and the renderer version, stored in
+    the PNG so an unchanged plot is not redrawn.
+    """
+    return hashlib.sha256(
+        json.dumps(
+            {"data": box_stats, "render_version": RENDER_VERSION},
+            sort_keys=True
+        ).encode()
+    ).hexdigest()
+
+
+def _plotted_digest(path):
+    try:
+        with Image.open(path) as image:
+            return image.text.get("InputDigest")
+    except (FileNotFoundError, OSError):
+        return None
+
+
+@staged("data_analysis.plot_boxplots")
+def plot_boxplots(box_stats, path=BOXPLOT_FILE, force=False):
+    """
+    Draws the responder/non-responder boxplots from box plot statistics
+    (figures.load_box_statistics) to path, unless it already holds a plot
+    of exactly these statistics (and force is not set).
+
+    Returns whether the plot was drawn.
+    """
+    digest = box_statistics_digest(box_stats)
+    if not force and _plotted_digest(path) == digest:
+        return False
+
+    render_response_boxplot(
+        box_stats,
+        "Immune Cell Relative Frequencies\n"
+        "Responders vs Non-Responders (PBMC, Miraclib)",
+        path,
+        dpi=300,
+        metadata={"InputDigest": digest}
     )
+    return True
 
-    plt.tight_layout()
-    fig.savefig("responders_vs_nonresponders_cell_pops.png", dpi=300)
-    plt.close(fig)
+def _present(values):
+    values = np.asarray(values, dtype=np.float64)
+    return values[~np.isnan(values)]
 
-def statistical_tests(data):
-    print("\nStatistical comparison (Mann–Whitney U test)")
-    print("------------------------------------------------")
 
-    significant = []
+@staged("data_analysis.mann_whitney_results", rows=len)
+def mann_whitney_results(data):
+    """
+    Mann–Whitney U test and summary statistics for each population.
+    Missing (NaN) percentages are dropped; populations with fewer than 3
+    samples left in either group are skipped.
+
+    Returns:
+        dict[cell_population] = {
+            "u": U statistic,
+            "p": two-sided p-value,
+            "yes": {"n", "mean", "median", "q1", "q3"},
+            "no":  {"n", "mean", "median", "q1", "q3"}
+        }
+    """
+    results = {}
 
     for population, groups in data.items():
-        responders = groups["yes"]
-        non_responders = groups["no"]
+        responders, non_responders = (
+            _present(groups[response]) for response in ("yes", "no")
+        )
 
         if len(responders) < 3 or len(non_responders) < 3:
             continue  # not enough data
@@ -102,6 +218,54 @@ def statistical_tests(data):
             responders, non_responders, alternative="two-sided"
         )
 
+        results[population] = {
+            "u": float(stat),
+            "p": float(p_value),
+            "yes": summary_statistics(responders),
+            "no": summary_statistics(non_responders),
+        }
+
+    return results
+
+
+def summary_statistics(values):
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    return {
+        "n": len(values),
+        "mean": float(np.mean(values)),
+        "median": float(median),
+        "q1": float(q1),
+        "q3": float(q3),
+    }
+
+
+@staged("data_analysis.response_test_results")
+def response_test_results(conn, use_cache=True, backend="sqlite",
+                          max_bytes=None):
+    """
+    mann_whitney_results for the responder comparison, served from the
+    analysis cache while the data generation is unchanged.
+    """
+    return cached(
+        conn,
+        "mann_whitney",
+        RESPONSE_COHORT,
+        lambda: mann_whitney_results(
+            load_response_data(conn, backend, max_bytes)
+        ),
+        enabled=use_cache
+    )
+
+
+def print_test_results(results):
+    print("\nStatistical comparison (Mann–Whitney U test)")
+    print("------------------------------------------------")
+
+    significant = []
+
+    for population, result in results.items():
+        p_value = result["p"]
+
         print(f"{population:<15} p = {p_value:.4g}")
 
         if p_value < 0.05:
@@ -113,107 +277,162 @@ def statistical_tests(data):
             print(f" - {pop}")
     else:
         print(" None")
-import sqlite3
 
-DB_FILE = "cell_counts.db"
 
+def statistical_tests(data):
+    print_test_results(mann_whitney_results(data))
 
-def baseline_melanoma_pbmc_summary(conn):
-    cursor = conn.cursor()
+
+@staged("data_analysis.response_resampling_results")
+def response_resampling_results(conn, data=None, use_cache=True, workers=1,
+                                backend="sqlite", max_bytes=None):
+    """
+    resampling_tests for the responder comparison with the default
+    numbers of resamples and seed, which makes the result cacheable.
+    """
+    return cached(
+        conn,
+        "resampling",
+        RESPONSE_COHORT,
+        lambda: resampling_tests(
+            load_response_data(conn, backend, max_bytes)
+            if data is None else data,
+            workers=workers
+        ),
+        enabled=use_cache
+    )
+
+
+@staged("data_analysis.baseline_melanoma_pbmc_summary")
+def baseline_melanoma_pbmc_summary(conn, use_cache=True):
+    summary = cached(
+        conn,
+        "cohort_summary",
+        BASELINE_COHORT,
+        lambda: cohort_summary(conn, **BASELINE_COHORT),
+        enabled=use_cache
+    )
 
     print("\nBaseline melanoma PBMC samples (miraclib)")
     print("========================================")
 
     # A. Total samples
-    cursor.execute("""
-        SELECT COUNT(*)
-        FROM cell_counts_csv
-        WHERE
-            condition = 'melanoma'
-            AND treatment = 'miraclib'
-            AND sample_type = 'PBMC'
-            AND time_from_treatment_start = 0
-    """)
-    total_samples = cursor.fetchone()[0]
-    print(f"Total baseline PBMC samples: {total_samples}")
+    print(f"Total baseline PBMC samples: {summary['total']}")
 
     # B. Samples per project
     print("\nSamples per project:")
-    cursor.execute("""
-        SELECT project, COUNT(*) AS n
-        FROM cell_counts_csv
-        WHERE
-            condition = 'melanoma'
-            AND treatment = 'miraclib'
-            AND sample_type = 'PBMC'
-            AND time_from_treatment_start = 0
-        GROUP BY project
-    """)
-    for project, n in cursor.fetchall():
+    for project, n in summary["project"].items():
         print(f"  {project}: {n}")
 
     # C. Subjects by response
     print("\nSubjects by response:")
-    cursor.execute("""
-        SELECT response, COUNT(DISTINCT subject) AS n
-        FROM cell_counts_csv
-        WHERE
-            condition = 'melanoma'
-            AND treatment = 'miraclib'
-            AND sample_type = 'PBMC'
-            AND time_from_treatment_start = 0
-        GROUP BY response
-    """)
-    for response, n in cursor.fetchall():
+    for response, n in summary["response"].items():
         print(f"  {response}: {n}")
 
     # D. Subjects by sex
     print("\nSubjects by sex:")
-    cursor.execute("""
-        SELECT sex, COUNT(DISTINCT subject) AS n
-        FROM cell_counts_csv
-        WHERE
-            condition = 'melanoma'
-            AND treatment = 'miraclib'
-            AND sample_type = 'PBMC'
-            AND time_from_treatment_start = 0
-        GROUP BY sex
-    """)
-    for sex, n in cursor.fetchall():
+    for sex, n in summary["sex"].items():
         print(f"  {sex}: {n}")
 
-def avg_b_cells_male_responders_baseline():
+@staged("data_analysis.avg_b_cells_male_responders_baseline")
+def avg_b_cells_male_responders_baseline(use_cache=True):
     """
     Considering melanoma males, compute the average number of B cells
     for responders at baseline (time_from_treatment_start = 0),
     using PBMC samples treated with miraclib.
     """
 
-    with sqlite3.connect(DB_FILE) as conn:
-        cursor = conn.cursor()
+    cohort = {"condition": "melanoma", "sex": "M", "response": "yes",
+              "timepoint": 0}
 
-        cursor.execute("""
-            SELECT
-                AVG(b_cell) AS avg_b_cells
-            FROM cell_counts_csv
-            WHERE
-                condition = 'melanoma'
-                AND sex = 'M'
-                AND response = 'yes'
-                AND time_from_treatment_start = 0
-                AND b_cell IS NOT NULL
-        """)
+    with instrument(open_storage().connect()) as conn:
+        def average():
+            # A handful of pre-aggregated rows when the database has them
+            if summaries_available(conn):
+                return mean_count(conn, "b_cell", **cohort)
+            return conn.execute(AVG_B_CELLS_MALE_RESPONDERS_SQL).fetchone()[0]
 
-        result = cursor.fetchone()
-        return result[0]
+        return cached(conn, "avg_b_cells", cohort, average, enabled=use_cache)
 
 def main():
-    with sqlite3.connect(DB_FILE) as conn:
-        data = fetch_response_data(conn)
-        baseline_melanoma_pbmc_summary(conn)
-    statistical_tests(data)
-    plot_boxplots(data)
-    avg_b = avg_b_cells_male_responders_baseline()
+    parser = argparse.ArgumentParser(
+        description="Responder vs non-responder analysis of the cell count "
+                    "database ($CELL_COUNTS_DATABASE, default cell_counts.db)."
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="recompute results even if they are cached for the current data"
+    )
+    parser.add_argument(
+        "--no-plot",
+        action="store_true",
+        help="skip rendering the boxplots"
+    )
+    parser.add_argument(
+        "--resample",
+        action="store_true",
+        help="add permutation p-values and bootstrap confidence intervals "
+             "for the median differences"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="processes used by --resample (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--backend",
+        choices=parquet_backend.BACKENDS,
+        default=parquet_backend.default_backend(),
+        help="where the raw frequencies are read from; parquet needs an "
+             "up-to-date database_setup.py --parquet export "
+             "(default: %(default)s)"
+    )
+    parser.add_argument(
+        "--box-mode",
+        choices=BOX_MODES,
+        default=default_box_mode(),
+        help="draw the boxplots from every sample (exact), from the "
+             "cohort summaries' quantile sketches, without individual "
+             "outliers (sketch), or from the sketches only for cohorts of "
+             f"more than {SKETCH_MIN_SAMPLES:,} samples (auto) "
+             "(default: %(default)s)"
+    )
+    add_max_memory_argument(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    configure(args.profile)
+    use_cache = not args.no_cache
+
+    try:
+        with instrument(open_storage().connect()) as conn:
+            baseline_melanoma_pbmc_summary(conn, use_cache)
+            results = response_test_results(
+                conn, use_cache, args.backend, args.max_memory
+            )
+            box_stats = None
+            if not args.no_plot:
+                box_stats = (
+                    cached_box_statistics(conn, RESPONSE_COHORT, args.box_mode)
+                    if use_cache else
+                    load_box_statistics(conn, RESPONSE_COHORT, args.box_mode)
+                )
+            resampled = (
+                response_resampling_results(
+                    conn, None, use_cache, args.workers, args.backend,
+                    args.max_memory
+                )
+                if args.resample else None
+            )
+    except MemoryError as error:
+        sys.exit(f"{error} (see --max-memory)")
+    print_test_results(results)
+    if resampled is not None:
+        print_resampling_results(resampled)
+    if box_stats is not None:
+        plot_boxplots(box_stats)
+    avg_b = avg_b_cells_male_responders_baseline(use_cache)
 
     if avg_b is None:
         print(
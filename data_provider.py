@@ -0,0 +1,170 @@
+"""
+Lazily loaded, in-memory cached data for the dashboard.
+
+Nothing is read until it is first asked for. Every entry remembers the
+data version it was loaded at and is reloaded on its next access once the
+version moves, so an ingest shows up without restarting the dashboard,
+while entries nobody asks for again are never recomputed. The version is
+the data generation database_setup bumps on every ingest, or PRAGMA
+data_version for SQLite databases that do not track one.
+
+Queries run on a per-process pool of read-only connections (autocommit
+ones on PostgreSQL, see storage.py), so the dashboard can be served by a
+multi-process WSGI server (see wsgi.py).
+"""
+import os
+import queue
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from instrumentation import instrument, stage
+from result_cache import data_generation
+from storage import open_storage
+
+# Entries kept; the least recently used one is dropped beyond this
+MAX_ENTRIES = 256
+
+# Entries are reloaded after this long even if the version did not move
+TTL_SECONDS = 600
+
+# The version marker is re-read at most this often by get()
+POLL_SECONDS = 5
+
+# Idle connections kept open per process
+POOL_SIZE = 8
+
+
+class ConnectionPool:
+    """
+    Reuses read-only connections within a process. Connections are never
+    shared across a fork: a child process starts with an empty pool.
+    """
+
+    def __init__(self, storage, size=POOL_SIZE):
+        self.storage = storage
+        self.size = size
+        self._pid = None
+        self._idle = None
+
+    def _reset_after_fork(self):
+        if self._pid != os.getpid():
+            self._pid = os.getpid()
+            self._idle = queue.LifoQueue()
+
+    @contextmanager
+    def connection(self):
+        self._reset_after_fork()
+        idle = self._idle
+
+        try:
+            conn = idle.get_nowait()
+        except queue.Empty:
+            conn = instrument(self.storage.connect_reader())
+
+        try:
+            yield conn
+        finally:
+            if idle is self._idle and idle.qsize() < self.size:
+                idle.put(conn)
+            else:
+                conn.close()
+
+
+class DataProvider:
+    def __init__(self, database=None, max_entries=MAX_ENTRIES,
+                 ttl=TTL_SECONDS, poll_interval=POLL_SECONDS,
+                 pool_size=POOL_SIZE):
+        """
+        database is a SQLite file or postgresql:// URL (default:
+        storage.database_url()).
+        """
+        self.storage = open_storage(database)
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.poll_interval = poll_interval
+        self.pool = ConnectionPool(self.storage, pool_size)
+
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._marker_conn = None
+        self._marker_pid = None
+        self._version = None
+        self._polled_at = None
+
+    def connect(self):
+        """
+        Context manager lending a pooled read-only connection.
+        """
+        return self.pool.connection()
+
+    def poll(self):
+        """
+        Re-reads the data version and returns it.
+        """
+        with self._lock:
+            # data_version only moves for commits made by *other*
+            # connections, so it needs one connection that stays open
+            # (one per process)
+            if self._marker_pid != os.getpid():
+                self._marker_conn = instrument(self.storage.connect_reader())
+                self._marker_pid = os.getpid()
+
+            generation = data_generation(self._marker_conn)
+            if generation or self.storage.kind != "sqlite":
+                version = ("generation", generation)
+            else:
+                version = (
+                    "data_version",
+                    self._marker_conn.execute(
+                        "PRAGMA data_version"
+                    ).fetchone()[0]
+                )
+
+            self._version = version
+            self._polled_at = time.monotonic()
+            return version
+
+    def version(self):
+        """
+        The data version, re-polled if the last poll is older than
+        poll_interval.
+        """
+        if (self._polled_at is None
+                or time.monotonic() - self._polled_at >= self.poll_interval):
+            return self.poll()
+        return self._version
+
+    def get(self, key, loader):
+        """
+        Returns loader(conn) for key, from memory while it is current.
+        """
+        version = self.version()
+        now = time.monotonic()
+
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                entry_version, loaded_at, value = entry
+                if entry_version == version and now - loaded_at < self.ttl:
+                    self._entries.move_to_end(key)
+                    return value
+
+        # Loaded outside the lock so one slow query does not block the
+        # other entries; concurrent misses of the same key both load it
+        name = key[0] if isinstance(key, tuple) else key
+        with self.connect() as conn, stage(f"data_provider.load.{name}"):
+            value = loader(conn)
+
+        with self._lock:
+            self._entries[key] = (version, now, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
@@ -1,9 +1,74 @@
+import argparse
+import glob
+import hashlib
+import json
+import os
+import shutil
 import sqlite3
 import csv
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import contextmanager
+from itertools import groupby, islice, repeat
+from operator import itemgetter
+from urllib.parse import quote
+
+from instrumentation import (
+    add_profile_argument,
+    configure,
+    instrument,
+    stage,
+    staged,
+)
+from result_cache import data_generation
+from storage import database_url, open_storage
+from summaries import (
+    affected_groups,
+    build_summaries,
+    has_sketches,
+    refresh_summaries,
+)
 
-DB_FILE = "cell_counts.db"
 CSV_FILE = "cell-count.csv"
 
+CSV_COLUMNS = (
+    "project", "subject", "condition", "age", "sex", "treatment",
+    "response", "sample", "sample_type", "time_from_treatment_start",
+    "b_cell", "cd8_t_cell", "cd4_t_cell", "nk_cell", "monocyte",
+)
+
+# Rows buffered per executemany call during bulk loads
+BATCH_SIZE = 50_000
+
+# Samples per (samples x populations) block in the NumPy frequency engine
+NUMPY_CHUNK_SIZE = 200_000
+
+# Bound parameters per "IN (...)" lookup, below SQLITE_MAX_VARIABLE_NUMBER
+LOOKUP_CHUNK = 900
+
+# Parquet export: one dataset per query below, hive-partitioned by these
+# columns, written in record batches of PARQUET_BATCH_SIZE rows
+PARQUET_DIR = "parquet"
+PARQUET_PARTITIONS = ("project", "treatment")
+PARQUET_BATCH_SIZE = 100_000
+
+# Connection settings used only for the duration of a full rebuild, which
+# starts from nothing and is simply rerun on failure, so durability is
+# traded for speed; cache_size is negative, i.e. in KiB (~256 MB).
+BULK_LOAD_PRAGMAS = {
+    "journal_mode": "MEMORY",
+    "synchronous": "OFF",
+    "cache_size": -256_000,
+}
+
+# Settings for appends, which write to the accumulated database while
+# readers may be connected: the journal stays in WAL mode (leaving it
+# needs an exclusive lock) and a crash cannot corrupt earlier loads
+APPEND_PRAGMAS = {
+    "synchronous": "NORMAL",
+    "cache_size": -256_000,
+}
+
 def initialize_db(conn):
     cursor = conn.cursor()
     # Drop table if it already exists
@@ -12,9 +77,17 @@ def initialize_db(conn):
     cursor.execute("DROP TABLE IF EXISTS treatments")
     cursor.execute("DROP TABLE IF EXISTS samples")
     cursor.execute("DROP TABLE IF EXISTS cell_counts")
+    cursor.execute("DROP TABLE IF EXISTS load_manifest")
+    cursor.execute("DROP TABLE IF EXISTS population_frequencies")
+    cursor.execute("DROP TABLE IF EXISTS populations")
+    cursor.execute("DROP TABLE IF EXISTS cohort_summaries")
 
+    create_schema(conn)
 
 
+def create_schema(conn):
+    cursor = conn.cursor()
+
     cursor.executescript("""
     PRAGMA foreign_keys = ON;
 
@@ -60,98 +133,426 @@ def initialize_db(conn):
         monocyte REAL,
         FOREIGN KEY (sample_id) REFERENCES samples(id)
     );
+
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_samples_sample_code
+        ON samples(sample_code);
+    CREATE INDEX IF NOT EXISTS idx_samples_subject_id
+        ON samples(subject_id);
+
+    -- One row per ingested CSV file, used by --append to skip files that
+    -- were already loaded
+    CREATE TABLE IF NOT EXISTS load_manifest (
+        id INTEGER PRIMARY KEY,
+        file_name TEXT NOT NULL,
+        file_hash TEXT UNIQUE NOT NULL,
+        row_count INTEGER,
+        loaded_at TEXT DEFAULT CURRENT_TIMESTAMP
+    );
+
+    -- Single-row content version, bumped by every ingest that changes
+    -- data; analysis caches are keyed by it. Survives full rebuilds.
+    CREATE TABLE IF NOT EXISTS data_generation (
+        id INTEGER PRIMARY KEY CHECK (id = 1),
+        generation INTEGER NOT NULL
+    );
     """)
 
     conn.commit()
-def load_csv(conn, csv_file):
+
+
+def _to_int(value):
+    return int(value) if value else None
+
+
+def _to_float(value):
+    return float(value) if value else None
+
+
+@contextmanager
+def bulk_load_pragmas(conn, pragmas=BULK_LOAD_PRAGMAS):
+    """
+    Temporarily applies `pragmas` (by default, relaxed durability and a
+    larger page cache) for a bulk load, restoring the connection's
+    previous settings afterwards.
+    """
     cursor = conn.cursor()
+    previous = {}
+
+    for pragma, value in pragmas.items():
+        previous[pragma] = cursor.execute(f"PRAGMA {pragma}").fetchone()[0]
+        cursor.execute(f"PRAGMA {pragma} = {value}")
+
+    try:
+        yield
+        conn.commit()
+    except BaseException:
+        conn.rollback()
+        raise
+    finally:
+        for pragma, value in previous.items():
+            cursor.execute(f"PRAGMA {pragma} = {value}")
+
+
+def _flush(cursor, samples, counts, upsert=False):
+    if upsert:
+        # Samples re-sent in a later file replace the stored values
+        cursor.executemany("""
+            INSERT INTO samples
+            (id, subject_id, treatment_id, response, sample_code,
+             sample_type, time_from_treatment_start)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+            ON CONFLICT(id) DO UPDATE SET
+                subject_id = excluded.subject_id,
+                treatment_id = excluded.treatment_id,
+                response = excluded.response,
+                sample_type = excluded.sample_type,
+                time_from_treatment_start = excluded.time_from_treatment_start
+        """, samples)
+
+        cursor.executemany("""
+            INSERT OR REPLACE INTO cell_counts
+            (sample_id, b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, counts)
+
+        cursor.executemany(
+            "INSERT OR IGNORE INTO affected_samples (sample_id) VALUES (?)",
+            ((sample[0],) for sample in samples)
+        )
+    else:
+        cursor.executemany("""
+            INSERT INTO samples
+            (id, subject_id, treatment_id, response, sample_code,
+             sample_type, time_from_treatment_start)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, samples)
+
+        cursor.executemany("""
+            INSERT INTO cell_counts
+            (sample_id, b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte)
+            VALUES (?, ?, ?, ?, ?, ?)
+        """, counts)
+
+    samples.clear()
+    counts.clear()
+
 
+def _existing_sample_ids(cursor, sample_codes):
+    """
+    Looks up the IDs of already stored samples, SQLITE_MAX_VARIABLES-safe.
+    """
+    found = {}
+    sample_codes = list(sample_codes)
+
+    for start in range(0, len(sample_codes), LOOKUP_CHUNK):
+        chunk = sample_codes[start:start + LOOKUP_CHUNK]
+        placeholders = ", ".join("?" * len(chunk))
+        found.update(cursor.execute(
+            f"SELECT sample_code, id FROM samples "
+            f"WHERE sample_code IN ({placeholders})",
+            chunk
+        ))
+
+    return found
+
+
+def _resolve_upserts(cursor, samples, counts, sample_ids, lookup=True):
+    """
+    Rewrites the staged IDs of samples that are already in the database
+    (or earlier in this load) so the flush updates them in place. Without
+    lookup, sample_ids already holds every stored sample.
+    """
+    if lookup:
+        pending = [
+            sample[4] for sample in samples if sample[4] not in sample_ids
+        ]
+        sample_ids.update(_existing_sample_ids(cursor, pending))
+
+    for i, sample in enumerate(samples):
+        staged_id = sample_ids.setdefault(sample[4], sample[0])
+        if staged_id != sample[0]:
+            samples[i] = (staged_id,) + sample[1:]
+            counts[i] = (staged_id,) + counts[i][1:]
+
+
+def iter_csv_rows(csv_file):
+    """
+    Yields the rows of a CSV export as tuples in CSV_COLUMNS order, with
+    age, time_from_treatment_start and the cell counts type-converted.
+    """
     with open(csv_file, newline="") as f:
-        reader = csv.DictReader(f)
+        reader = csv.reader(f)
+        header = next(reader)
+        pick = itemgetter(*(header.index(col) for col in CSV_COLUMNS))
 
         for row in reader:
-            # Insert project
-            cursor.execute(
-                "INSERT OR IGNORE INTO projects (name) VALUES (?)",
-                (row["project"],)
-            )
-            cursor.execute(
-                "SELECT id FROM projects WHERE name = ?",
-                (row["project"],)
+            (project, subject, condition, age, sex, treatment, response,
+             sample, sample_type, time_from_treatment_start,
+             b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte) = pick(row)
+
+            yield (
+                project, subject, condition, _to_int(age), sex, treatment,
+                response, sample, sample_type,
+                _to_float(time_from_treatment_start),
+                _to_float(b_cell),
+                _to_float(cd8_t_cell),
+                _to_float(cd4_t_cell),
+                _to_float(nk_cell),
+                _to_float(monocyte)
             )
-            project_id = cursor.fetchone()[0]
-
-            # Insert subject
-            cursor.execute("""
-                INSERT OR IGNORE INTO subjects
-                (project_id, subject_code, condition, age, sex)
-                VALUES (?, ?, ?, ?, ?)
-            """, (
-                project_id,
-                row["subject"],
-                row["condition"],
-                int(row["age"]) if row["age"] else None,
-                row["sex"]
-            ))
 
-            cursor.execute("""
-                SELECT id FROM subjects
-                WHERE project_id = ? AND subject_code = ?
-            """, (project_id, row["subject"]))
-            subject_id = cursor.fetchone()[0]
 
-            # Insert treatment
-            cursor.execute(
-                "INSERT OR IGNORE INTO treatments (name) VALUES (?)",
-                (row["treatment"],)
-            )
-            cursor.execute(
-                "SELECT id FROM treatments WHERE name = ?",
-                (row["treatment"],)
+def parse_csv(csv_file):
+    """
+    Parses a whole CSV export; run in ingest worker processes.
+    """
+    return list(iter_csv_rows(csv_file))
+
+
+def load_csv(conn, csv_file, batch_size=BATCH_SIZE, upsert=False):
+    """
+    Streams a CSV export into the normalized tables, see load_rows.
+    """
+    return load_rows(conn, iter_csv_rows(csv_file), batch_size, upsert)
+
+
+@staged("database_setup.load_rows", rows=int)
+def load_rows(conn, rows, batch_size=BATCH_SIZE, upsert=False,
+              sample_ids=None):
+    """
+    Loads parsed CSV rows into the normalized tables in a single
+    transaction. This is the only writer; parsing may happen elsewhere.
+
+    Project, subject and treatment IDs are resolved from in-memory
+    dictionaries (only unseen keys touch the database) and samples and
+    cell counts are written with executemany in batches of batch_size.
+
+    With upsert=True, existing subjects and samples are updated instead
+    of duplicated (the last row of a sample wins) and every loaded sample
+    ID is recorded in the temporary affected_samples table for
+    refresh_derived_tables.
+
+    A rebuild into an empty database passes the same sample_ids dict
+    (sample code -> ID) to each of its loads: re-sent samples are then
+    resolved from it without querying, under the bulk-load pragmas.
+
+    Returns the number of rows loaded.
+    """
+    cursor = conn.cursor()
+
+    project_ids = dict(cursor.execute("SELECT name, id FROM projects"))
+    treatment_ids = dict(cursor.execute("SELECT name, id FROM treatments"))
+    subject_ids = {
+        (project_id, subject_code): subject_id
+        for subject_id, project_id, subject_code in cursor.execute(
+            "SELECT id, project_id, subject_code FROM subjects"
+        )
+    }
+    sample_id = cursor.execute(
+        "SELECT COALESCE(MAX(id), 0) FROM samples"
+    ).fetchone()[0]
+
+    samples = []
+    counts = []
+    # Sample code -> ID, only needed to detect re-sent samples
+    rebuilding = sample_ids is not None
+    if not rebuilding:
+        sample_ids = {}
+    updated_subjects = set()
+    row_count = 0
+
+    pragmas = APPEND_PRAGMAS if upsert and not rebuilding else BULK_LOAD_PRAGMAS
+    with bulk_load_pragmas(conn, pragmas):
+        cursor.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS affected_samples (
+                sample_id INTEGER PRIMARY KEY
             )
-            treatment_id = cursor.fetchone()[0]
-
-            # Insert sample
-            cursor.execute("""
-                INSERT INTO samples
-                (subject_id, treatment_id, response, sample_code,
-                 sample_type, time_from_treatment_start)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
+        """)
+
+        for (project, subject, condition, age, sex, treatment, response,
+             sample, sample_type, time_from_treatment_start,
+             b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte) in rows:
+            row_count += 1
+
+            # Resolve project
+            project_id = project_ids.get(project)
+            if project_id is None:
+                cursor.execute(
+                    "INSERT INTO projects (name) VALUES (?)", (project,)
+                )
+                project_id = project_ids[project] = cursor.lastrowid
+
+            # Resolve subject (first occurrence wins, as before)
+            subject_key = (project_id, subject)
+            subject_id = subject_ids.get(subject_key)
+            if subject_id is None:
+                cursor.execute("""
+                    INSERT INTO subjects
+                    (project_id, subject_code, condition, age, sex)
+                    VALUES (?, ?, ?, ?, ?)
+                """, (project_id, subject, condition, age, sex))
+                subject_id = subject_ids[subject_key] = cursor.lastrowid
+                updated_subjects.add(subject_id)
+            elif upsert and subject_id not in updated_subjects:
+                cursor.execute("""
+                    UPDATE subjects SET condition = ?, age = ?, sex = ?
+                    WHERE id = ?
+                """, (condition, age, sex, subject_id))
+                # Demographics are denormalized into cell_counts_csv, so
+                # the subject's earlier samples need refreshing too
+                cursor.execute("""
+                    INSERT OR IGNORE INTO affected_samples (sample_id)
+                    SELECT id FROM samples WHERE subject_id = ?
+                """, (subject_id,))
+                updated_subjects.add(subject_id)
+
+            # Resolve treatment
+            treatment_id = treatment_ids.get(treatment)
+            if treatment_id is None:
+                cursor.execute(
+                    "INSERT INTO treatments (name) VALUES (?)", (treatment,)
+                )
+                treatment_id = treatment_ids[treatment] = cursor.lastrowid
+
+            # Stage sample and cell counts
+            sample_id += 1
+            samples.append((
+                sample_id,
                 subject_id,
                 treatment_id,
-                row["response"],
-                row["sample"],
-                row["sample_type"],
-                float(row["time_from_treatment_start"])
-                if row["time_from_treatment_start"] else None
+                response,
+                sample,
+                sample_type,
+                time_from_treatment_start
+            ))
+            counts.append((
+                sample_id, b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte
             ))
 
-            sample_id = cursor.lastrowid
+            if len(samples) >= batch_size:
+                if upsert:
+                    _resolve_upserts(cursor, samples, counts, sample_ids,
+                                     lookup=not rebuilding)
+                _flush(cursor, samples, counts, upsert)
 
-            # Insert cell counts
-            cursor.execute("""
-                INSERT INTO cell_counts
-                (sample_id, b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte)
-                VALUES (?, ?, ?, ?, ?, ?)
-            """, (
-                sample_id,
-                float(row["b_cell"]) if row["b_cell"] else None,
-                float(row["cd8_t_cell"]) if row["cd8_t_cell"] else None,
-                float(row["cd4_t_cell"]) if row["cd4_t_cell"] else None,
-                float(row["nk_cell"]) if row["nk_cell"] else None,
-                float(row["monocyte"]) if row["monocyte"] else None
-            ))
+        if upsert:
+            _resolve_upserts(cursor, samples, counts, sample_ids,
+                             lookup=not rebuilding)
+        _flush(cursor, samples, counts, upsert)
 
-    conn.commit()
+    return row_count
 
-def wide_table(conn):
-    cursor = conn.cursor()
 
-    cursor.execute("DROP TABLE IF EXISTS cell_counts_csv")
+def expand_inputs(inputs):
+    """
+    Expands CSV file paths, directories (all *.csv inside) and glob
+    patterns into a sorted, de-duplicated list of CSV files.
+    """
+    csv_files = []
 
+    for path in inputs:
+        if os.path.isdir(path):
+            matches = sorted(glob.glob(os.path.join(path, "*.csv")))
+        elif glob.has_magic(path):
+            matches = sorted(glob.glob(path))
+        else:
+            matches = [path]
+
+        for match in matches:
+            if match not in csv_files:
+                csv_files.append(match)
+
+    return csv_files
+
+
+def parsed_files(csv_files, workers=1):
+    """
+    Yields the parsed rows of each CSV file, in order.
+
+    With more than one worker the files are parsed and type-converted in
+    a process pool, at most `workers` files ahead of the consumer, so the
+    caller stays the single SQLite writer.
+    """
+    if workers <= 1 or len(csv_files) <= 1:
+        for csv_file in csv_files:
+            yield iter_csv_rows(csv_file)
+        return
+
+    pending = iter(csv_files)
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        window = deque(
+            pool.submit(parse_csv, csv_file)
+            for csv_file in islice(pending, workers)
+        )
+        while window:
+            rows = window.popleft().result()
+            next_file = next(pending, None)
+            if next_file is not None:
+                window.append(pool.submit(parse_csv, next_file))
+            yield rows
+
+# cell_counts_csv rows derived from the normalized tables; {where}
+# restricts the samples that are (re)built
+WIDE_SELECT = """
+    SELECT
+        s.id,
+        p.name,
+        sub.subject_code,
+        sub.condition,
+        sub.age,
+        sub.sex,
+        t.name,
+        s.response,
+        s.sample_code,
+        s.sample_type,
+        s.time_from_treatment_start,
+        c.b_cell,
+        c.cd8_t_cell,
+        c.cd4_t_cell,
+        c.nk_cell,
+        c.monocyte
+    FROM samples s
+    JOIN subjects sub ON sub.id = s.subject_id
+    JOIN projects p ON p.id = sub.project_id
+    LEFT JOIN treatments t ON t.id = s.treatment_id
+    JOIN cell_counts c ON c.sample_id = s.id
+    {where}
+    ORDER BY s.id
+"""
+
+
+# Secondary indexes on the derived tables, created by create_indexes. The
+# cohort indexes lead with the equality filters used by queries.py and
+# carry the grouped/aggregated columns so those queries never touch the
+# table itself. Joins to population_frequencies use its primary key.
+INDEXES = {
+    "idx_cell_counts_csv_sample":
+        "cell_counts_csv(sample)",
+    "idx_cell_counts_csv_cohort":
+        "cell_counts_csv(condition, treatment, sample_type, "
+        "time_from_treatment_start, project, response, sex, subject)",
+    "idx_cell_counts_csv_treatment_response":
+        "cell_counts_csv(treatment, sample_type, response, sex, sample)",
+    "idx_cell_counts_csv_demographics":
+        "cell_counts_csv(condition, sex, response, "
+        "time_from_treatment_start, b_cell)",
+    # Partial, so only queries restricted to responders and non-responders
+    # (the grid of batch_stats) pick it
+    "idx_cell_counts_csv_response":
+        "cell_counts_csv(response, treatment, condition, sample_type, "
+        "time_from_treatment_start) WHERE response IN ('yes', 'no')",
+    # The only index on population_frequencies: being WITHOUT ROWID, it
+    # also holds the key, so it copies the whole table. Population
+    # filters are read from it; a sort on percentage alone sorts every row
+    "idx_population_frequencies_population":
+        "population_frequencies(population_id, percentage)",
+}
+
+
+def _create_wide_table(cursor):
     cursor.execute("""
     CREATE TABLE cell_counts_csv (
+        sample_id INTEGER PRIMARY KEY,
         project TEXT,
         subject TEXT,
         condition TEXT,
@@ -170,102 +571,636 @@ def wide_table(conn):
     )
     """)
 
-    with open("cell-count.csv", newline="") as f:
-        reader = csv.reader(f)
-        next(reader)  # skip header
 
-        for row in reader:
-            cursor.execute("""
-                INSERT INTO cell_counts_csv VALUES (
-                    ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?
-                )
-            """, (
-                row[0], row[1], row[2],
-                int(row[3]) if row[3] else None,
-                row[4], row[5], row[6], row[7], row[8],
-                float(row[9]) if row[9] else None,
-                float(row[10]) if row[10] else None,
-                float(row[11]) if row[11] else None,
-                float(row[12]) if row[12] else None,
-                float(row[13]) if row[13] else None,
-                float(row[14]) if row[14] else None
-            ))
+@staged("database_setup.wide_table")
+def wide_table(conn):
+    """
+    Materializes cell_counts_csv from the normalized tables with a single
+    INSERT ... SELECT, so the CSV is only parsed once (by load_csv).
+    """
+    cursor = conn.cursor()
+
+    cursor.execute("DROP TABLE IF EXISTS cell_counts_csv")
+    _create_wide_table(cursor)
+    cursor.execute(
+        "INSERT INTO cell_counts_csv " + WIDE_SELECT.format(where="")
+    )
 
     conn.commit()
 
 
-def relative_cell_pops(conn):
-    cursor = conn.cursor()
+def cell_populations(conn):
+    """
+    Cell population columns of cell_counts, in schema order.
+    """
+    return [
+        column[1]
+        for column in conn.execute("PRAGMA table_info(cell_counts)")
+        if column[1] != "sample_id"
+    ]
 
-    # Drop table if it already exists
-    cursor.execute("DROP TABLE IF EXISTS cell_population_frequencies")
 
-    # Create and populate the table
-    cursor.execute("""
-    CREATE TABLE cell_population_frequencies AS
-    WITH totals AS (
-        SELECT
-            sample,
-            (b_cell + cd8_t_cell + cd4_t_cell + nk_cell + monocyte) AS total_count,
-            b_cell,
-            cd8_t_cell,
-            cd4_t_cell,
-            nk_cell,
-            monocyte
-        FROM cell_counts_csv
+def sync_populations(conn):
+    """
+    Makes the populations table list every cell_counts column and returns
+    {population name: population_id}.
+    """
+    conn.executemany(
+        "INSERT OR IGNORE INTO populations (name) VALUES (?)",
+        ((population,) for population in cell_populations(conn))
     )
-    SELECT
-        sample,
-        total_count,
-        'b_cell' AS population,
-        b_cell AS count,
-        (b_cell / total_count) AS percentage
-    FROM totals
+    return dict(conn.execute("SELECT name, id FROM populations"))
 
-    UNION ALL
 
+def frequencies_select(population_ids, where=""):
+    """
+    Relative frequencies derived from cell_counts as (sample_id,
+    population_id, percentage) rows, one UNION ALL branch per population;
+    `where` restricts the samples that are (re)computed.
+    """
+    populations = list(population_ids)
+    branches = [
+        f"""
     SELECT
-        sample,
-        total_count,
-        'cd8_t_cell',
-        cd8_t_cell,
-        (cd8_t_cell / total_count)
+        sample_id,
+        {population_ids[population]} AS population_id,
+        ({population} / NULLIF(total_count, 0)) AS percentage
     FROM totals
+"""
+        for population in populations
+    ]
 
-    UNION ALL
+    return f"""
+    WITH totals AS (
+        SELECT
+            sample_id,
+            ({" + ".join(populations)}) AS total_count,
+            {", ".join(populations)}
+        FROM cell_counts
+        {where}
+    )
+""" + "\n    UNION ALL\n".join(branches)
 
-    SELECT
-        sample,
-        total_count,
-        'cd4_t_cell',
-        cd4_t_cell,
-        (cd4_t_cell / total_count)
-    FROM totals
 
-    UNION ALL
+def _drop_relation(cursor, name):
+    """
+    Drops a table or view, whichever `name` currently is.
+    """
+    row = cursor.execute(
+        "SELECT type FROM sqlite_master WHERE name = ?", (name,)
+    ).fetchone()
+    if row:
+        cursor.execute(f"DROP {row[0].upper()} {name}")
 
-    SELECT
-        sample,
-        total_count,
-        'nk_cell',
-        nk_cell,
-        (nk_cell / total_count)
-    FROM totals
 
-    UNION ALL
+def _create_frequency_tables(conn):
+    """
+    Creates the compact frequency store and, on top of it, the
+    cell_population_frequencies view in the original long-format shape.
+
+    Only percentages are stored; counts and totals are read back from
+    cell_counts by the view.
+    """
+    cursor = conn.cursor()
+
+    cursor.executescript("""
+    CREATE TABLE IF NOT EXISTS populations (
+        id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL
+    );
 
+    CREATE TABLE IF NOT EXISTS population_frequencies (
+        sample_id INTEGER NOT NULL,
+        population_id INTEGER NOT NULL,
+        percentage REAL,
+        PRIMARY KEY (sample_id, population_id)
+    ) WITHOUT ROWID;
+    """)
+    sync_populations(conn)
+
+    populations = cell_populations(conn)
+    count_by_name = " ".join(
+        f"WHEN '{population}' THEN c.{population}"
+        for population in populations
+    )
+    _drop_relation(cursor, "cell_population_frequencies")
+    cursor.execute(f"""
+    CREATE VIEW cell_population_frequencies AS
     SELECT
-        sample,
-        total_count,
-        'monocyte',
-        monocyte,
-        (monocyte / total_count)
-    FROM totals
+        s.sample_code AS sample,
+        ({" + ".join("c." + p for p in populations)}) AS total_count,
+        p.name AS population,
+        CASE p.name {count_by_name} END AS count,
+        f.percentage,
+        f.sample_id,
+        f.population_id
+    FROM population_frequencies f
+    JOIN samples s ON s.id = f.sample_id
+    JOIN cell_counts c ON c.sample_id = f.sample_id
+    JOIN populations p ON p.id = f.population_id
+    """)
+
+
+def _insert_frequencies_sql(conn, affected_only=False):
+    where = ""
+    if affected_only:
+        where = "WHERE sample_id IN (SELECT sample_id FROM affected_samples)"
+
+    conn.execute(
+        "INSERT INTO population_frequencies "
+        + frequencies_select(sync_populations(conn), where)
+    )
+
+
+def _insert_frequencies_numpy(conn, affected_only=False,
+                              chunk_size=NUMPY_CHUNK_SIZE):
+    """
+    Computes totals and percentages over (samples x populations) blocks of
+    cell_counts with NumPy and writes them back with executemany.
+    """
+    import numpy as np
+
+    population_ids = sync_populations(conn)
+    populations = list(population_ids)
+    where = ""
+    if affected_only:
+        where = "WHERE sample_id IN (SELECT sample_id FROM affected_samples)"
+
+    reader = conn.cursor()
+    writer = conn.cursor()
+    reader.execute(f"""
+        SELECT sample_id, {", ".join(populations)}
+        FROM cell_counts
+        {where}
+        ORDER BY sample_id
     """)
 
+    while True:
+        rows = reader.fetchmany(chunk_size)
+        if not rows:
+            break
+
+        sample_ids = [row[0] for row in rows]
+        # None becomes NaN, which SQLite stores back as NULL, matching the
+        # NULL propagation of the SQL engine
+        counts = np.array([row[1:] for row in rows], dtype=np.float64)
+        totals = counts.sum(axis=1)
+
+        with np.errstate(divide="ignore", invalid="ignore"):
+            percentages = counts / totals[:, np.newaxis]
+        percentages[~np.isfinite(percentages)] = np.nan
+
+        for j, population in enumerate(populations):
+            writer.executemany(
+                "INSERT INTO population_frequencies VALUES (?, ?, ?)",
+                zip(
+                    sample_ids,
+                    repeat(population_ids[population]),
+                    percentages[:, j].tolist()
+                )
+            )
+
+
+FREQUENCY_ENGINES = {
+    "sql": _insert_frequencies_sql,
+    "numpy": _insert_frequencies_numpy,
+}
+
+
+@staged("database_setup.relative_cell_pops")
+def relative_cell_pops(conn, engine="sql"):
+    """
+    Rebuilds the population_frequencies store (and the
+    cell_population_frequencies view over it) with the given engine:
+    "sql" (set-based INSERT ... SELECT) or "numpy" (vectorized, chunked).
+    """
+    cursor = conn.cursor()
+
+    # Drop table if it already exists
+    cursor.execute("DROP TABLE IF EXISTS population_frequencies")
+
+    # Create and populate the table
+    _create_frequency_tables(conn)
+    FREQUENCY_ENGINES[engine](conn)
+
     conn.commit()
     return cursor
 
+
+def _table_exists(conn, name):
+    return conn.execute(
+        "SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = ?",
+        (name,)
+    ).fetchone() is not None
+
+
+def _has_column(conn, table, column):
+    return any(
+        row[1] == column
+        for row in conn.execute(f"PRAGMA table_info({table})")
+    )
+
+
+@staged("database_setup.create_indexes")
+def create_indexes(conn, analyze=True):
+    """
+    Creates the managed secondary indexes (after bulk loads, so inserts
+    don't pay for index maintenance) and refreshes planner statistics,
+    either fully (ANALYZE) or only where they went stale (PRAGMA optimize).
+    """
+    cursor = conn.cursor()
+
+    for name, definition in INDEXES.items():
+        cursor.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+    cursor.execute("ANALYZE" if analyze else "PRAGMA optimize")
+
+    conn.commit()
+
+
+@staged("database_setup.refresh_derived_tables")
+def refresh_derived_tables(conn, engine="sql"):
+    """
+    Updates cell_counts_csv, population_frequencies and the cohort
+    summaries for just the samples recorded in affected_samples by an
+    upserting load_csv.
+    """
+    cursor = conn.cursor()
+
+    # Empty database, or one built before the derived tables were keyed
+    # by sample_id: derive everything once
+    if not (_table_exists(conn, "cell_counts_csv")
+            and _has_column(conn, "cell_counts_csv", "sample_id")
+            and _table_exists(conn, "population_frequencies")):
+        wide_table(conn)
+        relative_cell_pops(conn, engine)
+        create_indexes(conn)
+        build_summaries(conn)
+        cursor.execute("DELETE FROM affected_samples")
+        conn.commit()
+        return
+
+    _create_frequency_tables(conn)
+
+    # Summaries from before they carried (binary) quantile sketches are
+    # rebuilt
+    if (_table_exists(conn, "cohort_summaries")
+            and not has_sketches(conn)):
+        cursor.execute("DROP TABLE cohort_summaries")
+
+    # Summary groups the affected samples leave...
+    groups = affected_groups(conn)
+
+    cursor.execute("""
+        DELETE FROM cell_counts_csv
+        WHERE sample_id IN (SELECT sample_id FROM affected_samples)
+    """)
+    cursor.execute(
+        "INSERT INTO cell_counts_csv "
+        + WIDE_SELECT.format(
+            where="WHERE s.id IN (SELECT sample_id FROM affected_samples)"
+        )
+    )
+
+    cursor.execute("""
+        DELETE FROM population_frequencies
+        WHERE sample_id IN (SELECT sample_id FROM affected_samples)
+    """)
+    FREQUENCY_ENGINES[engine](conn, affected_only=True)
+
+    # ...and join
+    refresh_summaries(conn, groups | affected_groups(conn))
+
+    cursor.execute("DELETE FROM affected_samples")
+    create_indexes(conn, analyze=False)
+
+
+def file_hash(path):
+    digest = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def record_load(conn, csv_file, digest, row_count):
+    conn.execute("""
+        INSERT INTO load_manifest (file_name, file_hash, row_count)
+        VALUES (?, ?, ?)
+    """, (os.path.basename(csv_file), digest, row_count))
+    conn.commit()
+
+
+def bump_generation(conn):
+    """
+    Advances the data generation and drops analysis results cached for
+    older generations. Returns the new generation.
+    """
+    conn.execute("""
+        INSERT INTO data_generation (id, generation) VALUES (1, 1)
+        ON CONFLICT(id) DO UPDATE SET generation = generation + 1
+    """)
+    generation = conn.execute(
+        "SELECT generation FROM data_generation"
+    ).fetchone()[0]
+
+    if _table_exists(conn, "analysis_cache"):
+        conn.execute(
+            "DELETE FROM analysis_cache WHERE generation < ?", (generation,)
+        )
+
+    conn.commit()
+    return generation
+
+
+def _database_file(conn):
+    """
+    Path of the file behind a SQLite connection's main database ("" for
+    an in-memory one).
+    """
+    for _, name, path in conn.execute("PRAGMA database_list"):
+        if name == "main":
+            return path or ""
+    return ""
+
+
+@staged("database_setup.ingest", rows=int)
+def ingest(conn, csv_files, append=False, workers=1, engine="sql"):
+    """
+    Loads CSV files into the database, parsing them with `workers`
+    processes and writing from this one.
+
+    Without append the database is rebuilt from csv_files: into a new
+    temporary file, which is then copied over the database in one
+    transaction (SQLite's backup API, so connected readers keep their
+    snapshot), leaving the previous database intact if anything fails.
+    With append, only files whose content hash is not yet in
+    load_manifest are ingested. In both modes, a sample sent again
+    (within or across files) keeps the values of its last row. Appends
+    upsert subjects and samples and refresh the derived tables for the
+    affected samples only.
+
+    `engine` selects how cell_population_frequencies is computed, see
+    relative_cell_pops.
+
+    Returns the number of files loaded.
+    """
+    path = _database_file(conn)
+    if append or not path:
+        return _load(conn, csv_files, append, workers, engine)
+
+    temporary = f"{path}.rebuild-{os.getpid()}"
+    if os.path.exists(temporary):
+        os.remove(temporary)
+
+    # Carried over, so caches keyed by it are still invalidated
+    generation = data_generation(conn)
+
+    build = instrument(sqlite3.connect(temporary))
+    try:
+        if generation:
+            create_schema(build)
+            build.execute(
+                "INSERT INTO data_generation (id, generation) VALUES (1, ?)",
+                (generation,)
+            )
+        loaded = _load(build, csv_files, append, workers, engine)
+        build.commit()
+        conn.commit()
+        with stage("database_setup.install_rebuild"):
+            build.backup(conn)
+    finally:
+        build.close()
+        for leftover in (temporary, temporary + "-journal"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+    _use_wal(conn)
+    return loaded
+
+
+def _use_wal(conn):
+    # Lets the dashboard's read-only connections keep reading while a
+    # later ingest writes. Persistent, so set once per database file:
+    # switching needs an exclusive lock, which open readers would refuse
+    if conn.execute("PRAGMA journal_mode").fetchone()[0] != "wal":
+        conn.execute("PRAGMA journal_mode = WAL")
+
+
+def _load(conn, csv_files, append, workers, engine):
+    if append:
+        create_schema(conn)
+    else:
+        initialize_db(conn)
+
+    pending = []
+    seen = set()
+    for csv_file in csv_files:
+        digest = file_hash(csv_file)
+        already_loaded = digest in seen or conn.execute(
+            "SELECT 1 FROM load_manifest WHERE file_hash = ?", (digest,)
+        ).fetchone()
+
+        if already_loaded:
+            print(f"Skipping {csv_file} (already loaded)")
+            continue
+
+        seen.add(digest)
+        pending.append((csv_file, digest))
+
+    loaded = []
+    files = [csv_file for csv_file, _ in pending]
+    # Every sample of a rebuild, so re-sent ones are resolved in memory
+    sample_ids = None if append else {}
+    for (csv_file, digest), rows in zip(pending, parsed_files(files, workers)):
+        row_count = load_rows(conn, rows, upsert=True, sample_ids=sample_ids)
+        print(f"Loaded {row_count} rows from {csv_file}")
+        loaded.append((csv_file, digest, row_count))
+
+    if not append:
+        wide_table(conn)
+        relative_cell_pops(conn, engine)
+        create_indexes(conn)
+        build_summaries(conn)
+    elif loaded:
+        refresh_derived_tables(conn, engine)
+
+    # Recorded last so an interrupted append is simply redone next time
+    for csv_file, digest, row_count in loaded:
+        record_load(conn, csv_file, digest, row_count)
+
+    if loaded or not append:
+        bump_generation(conn)
+
+    if append:
+        _use_wal(conn)
+    else:
+        # Rebuilt samples were never derived incrementally
+        conn.execute("DROP TABLE IF EXISTS temp.affected_samples")
+
+    return len(loaded)
+
+
+# -------------------------
+# Parquet export
+# -------------------------
+
+# Each dataset starts with the PARQUET_PARTITIONS columns, which name the
+# directory rows are written to rather than being stored, and is ordered
+# by them (so every partition is written in one run) and then by the
+# columns analyses filter on, so row-group statistics skip most row groups
+PARQUET_EXPORTS = {
+    "samples": """
+        SELECT
+            project, treatment, subject, condition, age, sex, response,
+            sample, sample_type, time_from_treatment_start,
+            b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte
+        FROM cell_counts_csv
+        ORDER BY project, treatment, sample_type, sample_id
+    """,
+    "frequencies": """
+        SELECT
+            c.project, c.treatment, c.condition, c.sample_type,
+            c.time_from_treatment_start, c.response, c.sex, c.subject,
+            c.sample, p.name AS population, f.percentage
+        FROM cell_counts_csv c
+        JOIN population_frequencies f ON f.sample_id = c.sample_id
+        JOIN populations p ON p.id = f.population_id
+        ORDER BY c.project, c.treatment, c.sample_type, c.response,
+                 c.sample_id, f.population_id
+    """,
+}
+
+PARQUET_INTEGER_COLUMNS = {"age"}
+PARQUET_STRING_COLUMNS = {
+    "project", "treatment", "subject", "condition", "sex", "response",
+    "sample", "sample_type", "population",
+}
+
+
+def _import_pyarrow():
+    try:
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError as error:
+        raise ImportError(
+            "The Parquet export needs pyarrow (pip install pyarrow)"
+        ) from error
+    return pyarrow
+
+
+def _partition_directory(values):
+    """
+    Hive-style partition path, e.g. project=prj1/treatment=miraclib.
+    """
+    return os.path.join(*(
+        f"{column}="
+        + ("__HIVE_DEFAULT_PARTITION__" if value is None
+           else quote(str(value), safe=""))
+        for column, value in zip(PARQUET_PARTITIONS, values)
+    ))
+
+
+def _write_parquet_dataset(pa, cursor, path, batch_size):
+    """
+    Streams a PARQUET_EXPORTS query into one Parquet file per partition,
+    a row group per batch_size rows, on this thread (the connection
+    cannot be handed to pyarrow's writer threads).
+    """
+    n_keys = len(PARQUET_PARTITIONS)
+    columns = [column for column, *_ in cursor.description][n_keys:]
+    schema = pa.schema([
+        (column, pa.int64() if column in PARQUET_INTEGER_COLUMNS
+         else pa.string() if column in PARQUET_STRING_COLUMNS
+         else pa.float64())
+        for column in columns
+    ])
+    partition_key = itemgetter(*range(n_keys))
+
+    writer = None
+    current = None
+    try:
+        for rows in iter(lambda: cursor.fetchmany(batch_size), []):
+            for key, run in groupby(rows, key=partition_key):
+                if key != current:
+                    if writer is not None:
+                        writer.close()
+                    directory = os.path.join(path, _partition_directory(key))
+                    os.makedirs(directory, exist_ok=True)
+                    writer = pa.parquet.ParquetWriter(
+                        os.path.join(directory, "part-0.parquet"), schema
+                    )
+                    current = key
+
+                values = list(zip(*(row[n_keys:] for row in run)))
+                writer.write_batch(pa.RecordBatch.from_arrays(
+                    [pa.array(column, type=field.type)
+                     for column, field in zip(values, schema)],
+                    schema=schema
+                ))
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+def load_parquet_manifest(parquet_dir=PARQUET_DIR):
+    """
+    {"generation": data generation exported, "datasets": {name: directory}}
+    of the last export, or None.
+    """
+    try:
+        with open(os.path.join(parquet_dir, "manifest.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return None
+
+
+@staged("database_setup.export_parquet")
+def export_parquet(conn, parquet_dir=PARQUET_DIR,
+                   batch_size=PARQUET_BATCH_SIZE):
+    """
+    Writes the wide sample table and the long-format frequencies (with
+    their cohort columns) to Parquet datasets partitioned by
+    PARQUET_PARTITIONS, for the columnar backend in parquet_backend.py.
+
+    Each export goes to new directories named after the data generation;
+    manifest.json is switched to them last, and older exports are removed
+    afterwards, so readers always see a complete export.
+
+    Returns the manifest.
+    """
+    pa = _import_pyarrow()
+
+    row = conn.execute("SELECT generation FROM data_generation").fetchone()
+    generation = row[0] if row else 0
+    os.makedirs(parquet_dir, exist_ok=True)
+
+    datasets = {}
+    for name, sql in PARQUET_EXPORTS.items():
+        directory = f"{name}-g{generation}"
+        path = os.path.join(parquet_dir, directory)
+        temporary = f"{path}.{os.getpid()}.tmp"
+        shutil.rmtree(temporary, ignore_errors=True)
+
+        _write_parquet_dataset(pa, conn.execute(sql), temporary, batch_size)
+        shutil.rmtree(path, ignore_errors=True)
+        os.replace(temporary, path)
+        datasets[name] = directory
+
+    manifest = {"generation": generation, "datasets": datasets}
+    manifest_path = os.path.join(parquet_dir, "manifest.json")
+    with open(manifest_path + ".tmp", "w") as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(manifest_path + ".tmp", manifest_path)
+
+    current = set(datasets.values())
+    for entry in os.listdir(parquet_dir):
+        path = os.path.join(parquet_dir, entry)
+        if os.path.isdir(path) and entry not in current:
+            shutil.rmtree(path, ignore_errors=True)
+
+    return manifest
+
+
 def print_relative_cell_summary(conn, limit=20):
     cursor = conn.cursor()
     cursor.execute("""
@@ -273,11 +1208,14 @@ def print_relative_cell_summary(conn, limit=20):
             sample,
             population,
             count,
-            ROUND(percentage, 2) AS percentage
+            percentage
         FROM cell_population_frequencies
+        WHERE sample IN (
+            SELECT sample_code FROM samples ORDER BY sample_code LIMIT ?
+        )
         ORDER BY sample, population
         LIMIT ?
-    """, (limit,))
+    """, (limit, limit))
 
     rows = cursor.fetchall()
 
@@ -288,11 +1226,71 @@ def print_relative_cell_summary(conn, limit=20):
         print(f"{sample:<15} {population:<15} {count:>8} {pct:>7.2f}")
 
 def main():
-    with sqlite3.connect(DB_FILE, timeout=30) as conn:
-        initialize_db(conn)
-        load_csv(conn, CSV_FILE)
-        wide_row = wide_table(conn)
-        relative_cell_pops(conn)
+    parser = argparse.ArgumentParser(
+        description="Build the cell count database from CSV exports."
+    )
+    parser.add_argument(
+        "inputs",
+        nargs="*",
+        default=[CSV_FILE],
+        metavar="PATH",
+        help="CSV files, directories of CSV files or glob patterns "
+             "(default: %(default)s)"
+    )
+    parser.add_argument(
+        "--append",
+        action="store_true",
+        help="ingest only new files into the existing database instead "
+             "of rebuilding it"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="processes used to parse CSV files (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--database",
+        default=database_url(),
+        metavar="URL",
+        help="SQLite file or postgresql:// URL to build "
+             "(default: %(default)s, or $CELL_COUNTS_DATABASE)"
+    )
+    parser.add_argument(
+        "--parquet",
+        nargs="?",
+        const=PARQUET_DIR,
+        metavar="DIR",
+        help="also export the data to Parquet for the columnar backend "
+             f"(default directory: {PARQUET_DIR}; needs pyarrow)"
+    )
+    parser.add_argument(
+        "--frequency-engine",
+        choices=sorted(FREQUENCY_ENGINES),
+        default="sql",
+        help="how relative frequencies are computed (default: %(default)s)"
+    )
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    configure(args.profile)
+
+    csv_files = expand_inputs(args.inputs)
+    if not csv_files:
+        parser.error("no CSV files matched " + " ".join(args.inputs))
+
+    storage = open_storage(args.database)
+    with instrument(storage.connect()) as conn:
+        storage.ingest(
+            conn,
+            csv_files,
+            append=args.append,
+            workers=args.workers,
+            engine=args.frequency_engine
+        )
+        if args.parquet:
+            manifest = export_parquet(conn, args.parquet)
+            print(f"Exported generation {manifest['generation']} "
+                  f"to {args.parquet}/")
         print_relative_cell_summary(conn)
 
 
@@ -0,0 +1,470 @@
+"""
+Standard figures drawn from precomputed statistics, and an export command
+that renders them for every cohort into a content-addressed cache.
+
+Each figure is stored under the SHA-256 of its inputs (the statistics it
+is drawn from plus the renderer version), and figure_cache/index.json maps
+figure names such as "response_boxplot/miraclib/melanoma/PBMC" to those
+digests. A figure whose inputs did not change already exists and is not
+rendered again, so re-exporting after an ingest only redraws the cohorts
+the new data touched. The dashboard serves the files at /figures/<name>.png.
+
+    python figures.py                 # render new and changed figures
+    python figures.py --workers 8 --prune
+"""
+import argparse
+import hashlib
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from instrumentation import add_profile_argument, configure, instrument, staged
+from parquet_backend import available, default_backend, response_samples_frame
+from queries import cohort_summary, response_samples_query
+from result_cache import cached
+from storage import open_storage, read_frame
+from summaries import (
+    available as summaries_available,
+    cohort_size,
+    summary_box_statistics,
+)
+
+BOX_MODE_ENV_VAR = "CELL_COUNTS_BOX_MODE"
+BOX_MODES = ("exact", "sketch", "auto")
+
+# In auto mode, cohorts with more samples than this are drawn from the
+# summaries' quantile sketches
+SKETCH_MIN_SAMPLES = 100_000
+
+FIGURE_DIR = "figure_cache"
+
+# Part of every figure's digest: bump it when the rendering code changes
+# so every figure is redrawn on the next export
+RENDER_VERSION = 2
+
+DPI = 150
+
+# Outliers kept per box; the most extreme ones are kept
+MAX_OUTLIERS = 50
+
+RESPONSE_COLORS = {"yes": "lightblue", "no": "salmon"}
+
+
+# -------------------------
+# Statistics
+# -------------------------
+
+def box_statistics(values, samples, max_outliers=MAX_OUTLIERS):
+    """
+    Tukey box plot statistics of one group: quartiles, whiskers at the
+    most extreme values within 1.5 IQR of the box, and up to
+    max_outliers of the values beyond them (the farthest out first).
+    """
+    values = np.asarray(values, dtype=np.float64)
+    samples = np.asarray(samples, dtype=object)
+    q1, median, q3 = np.percentile(values, [25, 50, 75])
+    low, high = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+
+    inside = (values >= low) & (values <= high)
+    outliers = np.flatnonzero(~inside)
+    outliers = outliers[
+        np.argsort(-np.abs(values[outliers] - median), kind="stable")
+    ][:max_outliers]
+
+    return {
+        "n": int(values.size),
+        "q1": float(q1),
+        "median": float(median),
+        "q3": float(q3),
+        "lowerfence": float(values[inside].min()),
+        "upperfence": float(values[inside].max()),
+        "n_outliers": int((~inside).sum()),
+        "outliers": values[outliers].tolist(),
+        "outlier_samples": samples[outliers].tolist(),
+    }
+
+
+def response_box_statistics(df):
+    """
+    box_statistics per (population, response) of response_samples_query
+    rows.
+    """
+    df = df.dropna(subset=["percentage"])
+    return [
+        {"population": population, "response": response,
+         **box_statistics(group["percentage"], group["sample"])}
+        for (population, response), group
+        in df.groupby(["population", "response"], sort=True)
+    ]
+
+
+def load_response_samples(conn, cohort, backend=None):
+    """
+    response_samples_query rows of a cohort, read from the Parquet export
+    instead when the parquet backend (CELL_COUNTS_BACKEND) is selected and
+    the export is current.
+    """
+    if (backend or default_backend()) == "parquet" and available(conn):
+        return response_samples_frame(**cohort)
+    sql, params = response_samples_query(**cohort)
+    return read_frame(conn, sql, params)
+
+
+def default_box_mode():
+    mode = os.environ.get(BOX_MODE_ENV_VAR, "exact")
+    if mode not in BOX_MODES:
+        raise ValueError(
+            f"{BOX_MODE_ENV_VAR} must be one of {', '.join(BOX_MODES)}, "
+            f"not {mode!r}"
+        )
+    return mode
+
+
+def load_box_statistics(conn, cohort, mode=None):
+    """
+    Box plot statistics of a cohort (CELL_COUNTS_BOX_MODE by default).
+
+    exact (the default) computes them from the samples. sketch merges them
+    from the quantile sketches of the cohort summaries, when the database
+    has them: quartiles to within the sketches' rank error, outliers
+    counted but not listed. auto does the same for cohorts of more than
+    SKETCH_MIN_SAMPLES samples only.
+    """
+    mode = mode or default_box_mode()
+    if mode != "exact" and summaries_available(conn) and (
+            mode == "sketch"
+            or cohort_size(conn, **cohort) > SKETCH_MIN_SAMPLES):
+        return summary_box_statistics(conn, **cohort)
+    return response_box_statistics(load_response_samples(conn, cohort))
+
+
+def cached_box_statistics(conn, cohort, mode=None):
+    mode = mode or default_box_mode()
+    return cached(
+        conn,
+        f"{mode}_box_statistics",
+        cohort,
+        lambda: load_box_statistics(conn, cohort, mode)
+    )
+
+
+def outlier_label(box):
+    """
+    How many of a box's outliers there are and how many are drawn, e.g.
+    "12 outliers" or "50 of 80 outliers shown" ("" without outliers).
+    """
+    n, shown = box["n_outliers"], len(box["outliers"])
+    if not n:
+        return ""
+    if shown < n:
+        return f"{shown} of {n} outliers shown"
+    return f"{n} outlier" + "s" * (n != 1)
+
+
+def cached_cohort_summary(conn, cohort):
+    return cached(
+        conn,
+        "cohort_summary",
+        cohort,
+        lambda: cohort_summary(conn, **cohort)
+    )
+
+
+# -------------------------
+# Rendering
+# -------------------------
+
+def render_response_boxplot(box_stats, title, path, dpi=DPI, metadata=None):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    populations = sorted({box["population"] for box in box_stats})
+    fig, ax = plt.subplots(figsize=(10, 6))
+
+    for offset, (response, color) in enumerate(RESPONSE_COLORS.items()):
+        boxes = {
+            box["population"]: box for box in box_stats
+            if box["response"] == response
+        }
+        positions = [
+            i * 2 + offset * 0.8
+            for i, population in enumerate(populations)
+            if population in boxes
+        ]
+        if not positions:
+            continue
+
+        drawn = [boxes[population] for population in populations
+                 if population in boxes]
+        ax.bxp(
+            [
+                {
+                    "med": box["median"],
+                    "q1": box["q1"],
+                    "q3": box["q3"],
+                    "whislo": box["lowerfence"],
+                    "whishi": box["upperfence"],
+                    "fliers": box["outliers"],
+                }
+                for box in drawn
+            ],
+            positions=positions,
+            widths=0.6,
+            patch_artist=True,
+            boxprops=dict(facecolor=color),
+            medianprops=dict(color="black")
+        )
+        for position, box in zip(positions, drawn):
+            if box["n_outliers"]:
+                ax.annotate(
+                    outlier_label(box),
+                    (position, max([box["upperfence"], *box["outliers"]])),
+                    xytext=(0, 4),
+                    textcoords="offset points",
+                    ha="center",
+                    va="bottom",
+                    rotation=90,
+                    fontsize=7
+                )
+
+    # Headroom for the outlier labels
+    ax.margins(y=0.15)
+    ax.set_xticks([i * 2 + 0.4 for i in range(len(populations))])
+    ax.set_xticklabels(populations, rotation=45)
+    ax.set_ylabel("Relative Frequency")
+    ax.set_title(title)
+    ax.legend(
+        handles=[
+            plt.Line2D([0], [0], color=RESPONSE_COLORS["yes"], lw=6,
+                       label="Responders"),
+            plt.Line2D([0], [0], color=RESPONSE_COLORS["no"], lw=6,
+                       label="Non-Responders"),
+        ],
+        loc="upper right"
+    )
+
+    plt.tight_layout()
+    fig.savefig(path, dpi=dpi, format="png", metadata=metadata)
+    plt.close(fig)
+
+
+def render_baseline_summary(summary, title, path):
+    import matplotlib
+    matplotlib.use("Agg")
+    import matplotlib.pyplot as plt
+
+    fig, axes = plt.subplots(1, 3, figsize=(12, 4))
+
+    for ax, (key, label) in zip(axes, (
+        ("project", "Samples per Project"),
+        ("response", "Subjects by Response"),
+        ("sex", "Subjects by Sex"),
+    )):
+        counts = summary[key]
+        ax.bar([str(name) for name in counts], list(counts.values()))
+        ax.set_title(label)
+
+    fig.suptitle(title)
+    plt.tight_layout()
+    fig.savefig(path, dpi=DPI, format="png")
+    plt.close(fig)
+
+
+RENDERERS = {
+    "response_boxplot": render_response_boxplot,
+    "baseline_summary": render_baseline_summary,
+}
+
+
+# -------------------------
+# Export
+# -------------------------
+
+def export_cohorts(conn):
+    """
+    Every (treatment, condition, sample_type) combination in the data.
+    """
+    return [
+        {"treatment": treatment, "condition": condition,
+         "sample_type": sample_type}
+        for treatment, condition, sample_type in conn.execute("""
+            SELECT DISTINCT treatment, condition, sample_type
+            FROM cell_counts_csv
+            ORDER BY treatment, condition, sample_type
+        """)
+    ]
+
+
+def figure_inputs(conn):
+    """
+    Yields (name, kind, title, data) for every standard figure of every
+    cohort that has data for it.
+    """
+    for cohort in export_cohorts(conn):
+        label = "/".join(str(cohort[key]) for key in
+                         ("treatment", "condition", "sample_type"))
+        description = ", ".join(str(value) for value in cohort.values())
+
+        box_stats = cached_box_statistics(conn, cohort)
+        if box_stats:
+            yield (
+                f"response_boxplot/{label}",
+                "response_boxplot",
+                f"Responders vs Non-Responders ({description})",
+                box_stats,
+            )
+
+        summary = cached_cohort_summary(conn, {**cohort, "timepoint": 0})
+        if summary["total"]:
+            yield (
+                f"baseline_summary/{label}",
+                "baseline_summary",
+                f"Baseline summary ({description}, time 0)",
+                summary,
+            )
+
+
+def input_digest(kind, title, data):
+    payload = json.dumps(
+        {"kind": kind, "title": title, "data": data,
+         "render_version": RENDER_VERSION, "dpi": DPI},
+        sort_keys=True
+    )
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+def object_path(figure_dir, digest):
+    return os.path.join(figure_dir, "objects", digest[:2], digest + ".png")
+
+
+def load_index(figure_dir=FIGURE_DIR):
+    """
+    {figure name: digest} of the last export (empty before the first).
+    """
+    try:
+        with open(os.path.join(figure_dir, "index.json")) as f:
+            return json.load(f)
+    except FileNotFoundError:
+        return {}
+
+
+def _write_index(figure_dir, index):
+    path = os.path.join(figure_dir, "index.json")
+    temporary = f"{path}.{os.getpid()}.tmp"
+    with open(temporary, "w") as f:
+        json.dump(index, f, indent=2, sort_keys=True)
+    os.replace(temporary, path)
+
+
+def _render(task):
+    kind, title, data, path = task
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Rendered aside and moved into place, so readers never see a
+    # partially written figure
+    temporary = f"{path}.{os.getpid()}.tmp"
+    RENDERERS[kind](data, title, temporary)
+    os.replace(temporary, path)
+    return path
+
+
+@staged("figures.export_figures")
+def export_figures(conn, figure_dir=FIGURE_DIR, workers=1, force=False,
+                   prune=False):
+    """
+    Renders every standard figure whose inputs changed since it was last
+    rendered (all of them with force), in `workers` processes, and
+    updates the index.
+
+    With prune, objects no longer referenced by the index are deleted.
+
+    Returns {"rendered": [names], "unchanged": [names], "removed": [names]}.
+    """
+    previous = load_index(figure_dir)
+    index = {}
+    tasks = []
+    unchanged = []
+
+    for name, kind, title, data in figure_inputs(conn):
+        digest = input_digest(kind, title, data)
+        index[name] = digest
+        path = object_path(figure_dir, digest)
+
+        if force or not os.path.exists(path):
+            tasks.append((name, (kind, title, data, path)))
+        else:
+            unchanged.append(name)
+
+    if workers <= 1 or len(tasks) <= 1:
+        for _, task in tasks:
+            _render(task)
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            list(pool.map(_render, [task for _, task in tasks]))
+
+    os.makedirs(figure_dir, exist_ok=True)
+    _write_index(figure_dir, index)
+
+    if prune:
+        referenced = {object_path(figure_dir, digest)
+                      for digest in index.values()}
+        objects = os.path.join(figure_dir, "objects")
+        for root, _, files in os.walk(objects):
+            for file_name in files:
+                path = os.path.join(root, file_name)
+                if path not in referenced:
+                    os.remove(path)
+
+    return {
+        "rendered": [name for name, _ in tasks],
+        "unchanged": unchanged,
+        "removed": sorted(set(previous) - set(index)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--figure-dir", default=FIGURE_DIR)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="processes used to render figures (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="render every figure even if its inputs did not change"
+    )
+    parser.add_argument(
+        "--prune",
+        action="store_true",
+        help="delete rendered figures that are no longer in the index"
+    )
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    configure(args.profile)
+
+    with instrument(open_storage().connect()) as conn:
+        report = export_figures(
+            conn,
+            figure_dir=args.figure_dir,
+            workers=args.workers,
+            force=args.force,
+            prune=args.prune
+        )
+
+    print(
+        f"{len(report['rendered'])} figures rendered, "
+        f"{len(report['unchanged'])} unchanged, "
+        f"{len(report['removed'])} removed from the index"
+    )
+    for name in report["rendered"]:
+        print(f"  {name}")
+
+
+if __name__ == "__main__":
+    main()
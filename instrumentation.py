@@ -0,0 +1,277 @@
+"""
+Opt-in timing and profiling of the pipeline stages.
+
+Enabled by the CELL_COUNTS_PROFILE environment variable or the --profile
+flag of each entry point, every stage logs one JSON line with its wall and
+CPU time, row count, peak memory, and the SQLite statements it ran:
+
+    CELL_COUNTS_PROFILE=1 python database_setup.py
+    python data_analysis.py --profile analysis.prof   # plus a cProfile dump
+
+Lines go to stderr, or are appended to the file named by
+CELL_COUNTS_PROFILE_LOG. When disabled, stage() hands back a shared no-op
+context manager and instrument() leaves connections untouched, so the
+instrumented code pays a function call and nothing else.
+
+Stages nest (a stage's figures include its children's) and are tracked per
+thread; work in ingest or resampling worker processes is not seen.
+"""
+import atexit
+import cProfile
+import datetime
+import functools
+import json
+import os
+import sys
+import threading
+import time
+import tracemalloc
+
+ENV_VAR = "CELL_COUNTS_PROFILE"
+LOG_ENV_VAR = "CELL_COUNTS_PROFILE_LOG"
+
+# SQLite virtual machine instructions between progress handler calls
+PROGRESS_STEPS = 10_000
+
+# Most expensive statements listed per stage
+TOP_STATEMENTS = 5
+
+# Statements are grouped by their first characters (whitespace collapsed)
+STATEMENT_KEY_LENGTH = 200
+
+_enabled = False
+_log_file = None
+_local = threading.local()
+_log_lock = threading.Lock()
+
+
+class _NullStage:
+    """
+    What stage() returns while instrumentation is off.
+    """
+    rows = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        return False
+
+    def __setattr__(self, name, value):
+        pass
+
+
+_NULL_STAGE = _NullStage()
+
+
+def enabled():
+    return _enabled
+
+
+def configure(profile=None):
+    """
+    Turns instrumentation on if profile is set (the value of a --profile
+    flag) or CELL_COUNTS_PROFILE is set to anything but "0". A profile
+    value other than True is a path the cProfile stats of the whole run
+    are dumped to at exit.
+    """
+    global _enabled, _log_file
+
+    if not profile and os.environ.get(ENV_VAR, "0") in ("", "0"):
+        return
+
+    if not _enabled:
+        _enabled = True
+        log_path = os.environ.get(LOG_ENV_VAR)
+        _log_file = open(log_path, "a") if log_path else sys.stderr
+        tracemalloc.start()
+
+    if isinstance(profile, str):
+        profiler = cProfile.Profile()
+        profiler.enable()
+        atexit.register(_dump_profile, profiler, profile)
+
+
+def add_profile_argument(parser):
+    parser.add_argument(
+        "--profile",
+        nargs="?",
+        const=True,
+        metavar="PROF_FILE",
+        help=f"log per-stage timings as JSON to stderr (as {ENV_VAR}=1 "
+             "does), and dump cProfile stats to PROF_FILE if given"
+    )
+
+
+def _dump_profile(profiler, path):
+    profiler.disable()
+    profiler.dump_stats(path)
+    emit({"event": "profile", "path": os.path.abspath(path)})
+
+
+def emit(record):
+    """
+    Writes one JSON log line (only while instrumentation is on).
+    """
+    if not _enabled:
+        return
+    record = {
+        "time": datetime.datetime.now().isoformat(timespec="milliseconds"),
+        "pid": os.getpid(),
+        **record,
+    }
+    line = json.dumps(record, default=str)
+    with _log_lock:
+        _log_file.write(line + "\n")
+        _log_file.flush()
+
+
+def _stack():
+    if not hasattr(_local, "stack"):
+        _local.stack = []
+        _local.statement = None
+    return _local.stack
+
+
+class _Stage:
+    def __init__(self, name):
+        self.name = name
+        self.rows = None
+        self.statements = {}
+        self.sql_count = 0
+        self.sql_seconds = 0.0
+        self.vm_steps = 0
+        self.peak = 0
+
+    def __enter__(self):
+        stack = _stack()
+        current, peak = tracemalloc.get_traced_memory()
+        # reset_peak() is global: fold the peak so far into the
+        # enclosing stages before starting this one's
+        for parent in stack:
+            parent.peak = max(parent.peak, peak)
+        tracemalloc.reset_peak()
+
+        self.parent = stack[-1].name if stack else None
+        self.start_memory = current
+        self.start_cpu = time.process_time()
+        self.start_wall = time.perf_counter()
+        stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        wall = time.perf_counter() - self.start_wall
+        cpu = time.process_time() - self.start_cpu
+        _finish_statement()
+
+        stack = _stack()
+        stack.pop()
+        self.peak = max(self.peak, tracemalloc.get_traced_memory()[1])
+        for parent in stack:
+            parent.peak = max(parent.peak, self.peak)
+
+        top = sorted(
+            self.statements.items(), key=lambda item: -item[1][1]
+        )[:TOP_STATEMENTS]
+        emit({
+            "event": "stage",
+            "stage": self.name,
+            "parent": self.parent,
+            "wall_s": round(wall, 6),
+            "cpu_s": round(cpu, 6),
+            "rows": self.rows,
+            "peak_memory_bytes": max(self.peak - self.start_memory, 0),
+            "sql": {
+                "statements": self.sql_count,
+                "seconds": round(self.sql_seconds, 6),
+                "vm_steps": self.vm_steps,
+                "top": [
+                    {"sql": sql, "count": count, "seconds": round(seconds, 6)}
+                    for sql, (count, seconds) in top
+                ],
+            },
+            "error": None if exc_type is None else exc_type.__name__,
+        })
+        return False
+
+
+def stage(name):
+    """
+    Context manager timing one stage; set .rows on it to log a row count.
+    """
+    if not _enabled:
+        return _NULL_STAGE
+    return _Stage(name)
+
+
+def staged(name, rows=None):
+    """
+    Decorator running each call of a function as stage(name); rows, if
+    given, maps the function's result to the row count logged.
+    """
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not _enabled:
+                return function(*args, **kwargs)
+            with _Stage(name) as record:
+                result = function(*args, **kwargs)
+                if rows is not None:
+                    record.rows = rows(result)
+            return result
+        return wrapper
+    return decorate
+
+
+# -------------------------
+# SQLite statements
+# -------------------------
+
+def _finish_statement():
+    """
+    Charges the statement running on this thread with the time since it
+    started.
+    """
+    statement = getattr(_local, "statement", None)
+    if statement is None:
+        return
+    _local.statement = None
+
+    key, start, stages = statement
+    seconds = time.perf_counter() - start
+    for index, record in enumerate(stages):
+        record.sql_count += 1
+        record.sql_seconds += seconds
+        # Statements are listed only under the innermost stage
+        if index == len(stages) - 1:
+            count, total = record.statements.get(key, (0, 0.0))
+            record.statements[key] = (count + 1, total + seconds)
+
+
+def _trace(statement):
+    # SQLite reports when a statement starts, not when it ends, so each
+    # one is timed until the next starts (or its stage ends): this
+    # includes the Python work consuming a SELECT's rows
+    _finish_statement()
+    stack = _stack()
+    if stack:
+        key = " ".join(statement.split())[:STATEMENT_KEY_LENGTH]
+        _local.statement = (key, time.perf_counter(), list(stack))
+
+
+def _progress():
+    for record in _stack():
+        record.vm_steps += PROGRESS_STEPS
+    return 0
+
+
+def instrument(conn):
+    """
+    Installs statement tracing on a SQLite connection (while
+    instrumentation is on) and returns it. Other connections are returned
+    as they are: their stages log timings but no statements.
+    """
+    if _enabled and hasattr(conn, "set_trace_callback"):
+        conn.set_trace_callback(_trace)
+        conn.set_progress_handler(_progress, PROGRESS_STEPS)
+    return conn
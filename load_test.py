@@ -0,0 +1,345 @@
+"""
+Concurrent load test of the dashboard callbacks.
+
+Simulated users repeatedly fire the dashboard's callbacks (table pages
+with random filters and sorts, boxplots and summary figures for random
+cohorts and population subsets) and the p50/p99 latency of each is
+reported.
+
+    python load_test.py --users 32 --requests 50
+    python load_test.py --url http://127.0.0.1:8050 --users 64
+    python load_test.py --append new-batch.csv
+
+Without --url the app is exercised in-process through the WSGI test
+client, which measures the callbacks without any network or server.
+With --append, database_setup.py --append ingests the given files in a
+separate process while the users are running, as a daily load would
+while the dashboard is serving.
+"""
+import argparse
+import json
+import os
+import random
+import subprocess
+import sys
+import threading
+import time
+import urllib.request
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from instrumentation import add_profile_argument, configure
+
+POPULATIONS = ["b_cell", "cd4_t_cell", "cd8_t_cell", "monocyte", "nk_cell"]
+
+TABLE_FILTERS = [
+    "",
+    "{population} = b_cell",
+    "{percentage} > 0.3",
+    "{population} = monocyte && {percentage} < 0.1",
+    '{sample} icontains "sample001"',
+]
+
+# Cohort dropdown selections, in dashboard.COHORT_FILTERS order
+COHORTS = [
+    (["miraclib"], ["melanoma"], ["PBMC"], [], [], []),
+    (["miraclib"], [], ["PBMC"], [], [], []),
+    ([], ["carcinoma"], [], ["F"], [], [0.0]),
+    (["phauximab"], ["melanoma"], ["WB"], [], ["prj1"], []),
+    ([], [], [], ["M"], [], [7.0, 14.0]),
+]
+
+COHORT_FILTERS = [
+    "treatment", "condition", "sample_type", "sex", "project", "timepoint"
+]
+
+TABLE_SORTS = [
+    [],
+    [{"column_id": "percentage", "direction": "desc"}],
+    [{"column_id": "sample", "direction": "asc"}],
+]
+
+
+def _prop(component, prop, value=None):
+    item = {"id": component, "property": prop}
+    if value is not None:
+        item["value"] = value
+    return item
+
+
+def callback_payload(outputs, inputs, state=()):
+    """
+    Request body of a Dash callback (POST /_dash-update-component).
+    outputs/inputs/state are (component id, property[, value]) tuples.
+    """
+    output_props = [_prop(*output) for output in outputs]
+    if len(output_props) == 1:
+        output = "{id}.{property}".format(**output_props[0])
+    else:
+        output = ".." + "...".join(
+            "{id}.{property}".format(**item) for item in output_props
+        ) + ".."
+
+    return {
+        "output": output,
+        "outputs": output_props[0] if len(output_props) == 1 else output_props,
+        "inputs": [_prop(*item) for item in inputs],
+        "state": [_prop(*item) for item in state],
+        "changedPropIds": [f"{inputs[0][0]}.{inputs[0][1]}"],
+    }
+
+
+def random_request(rng, version):
+    """
+    Returns (callback name, payload) for one random user interaction.
+    """
+    kind = rng.choice(["table", "table", "boxplot", "summary"])
+    cohort = [
+        (f"cohort-{name}", "value", value)
+        for name, value in zip(COHORT_FILTERS, rng.choice(COHORTS))
+    ]
+
+    if kind == "table":
+        return "update_frequency_table", callback_payload(
+            [("frequency-table", "data"), ("frequency-table", "page_count")],
+            [
+                ("frequency-table", "page_current", rng.randrange(200)),
+                ("frequency-table", "page_size", 15),
+                ("frequency-table", "sort_by", rng.choice(TABLE_SORTS)),
+                ("frequency-table", "filter_query", rng.choice(TABLE_FILTERS)),
+                ("data-version", "data", version),
+            ]
+        )
+
+    if kind == "boxplot":
+        selected = rng.sample(POPULATIONS, rng.randint(1, len(POPULATIONS)))
+        return "update_response_boxplot", callback_payload(
+            [("response-boxplot", "figure")],
+            [
+                ("population-dropdown", "value", selected),
+                *cohort,
+                ("data-version", "data", version),
+            ]
+        )
+
+    return "update_summary_figures", callback_payload(
+        [
+            ("sex-subjects-bar", "figure"),
+            ("baseline-samples-bar", "figure"),
+            ("baseline-response-bar", "figure"),
+            ("baseline-sex-bar", "figure"),
+        ],
+        [*cohort, ("data-version", "data", version)]
+    )
+
+
+def http_sender(url):
+    endpoint = url.rstrip("/") + "/_dash-update-component"
+
+    def send(payload):
+        request = urllib.request.Request(
+            endpoint,
+            data=json.dumps(payload).encode(),
+            headers={"Content-Type": "application/json"}
+        )
+        with urllib.request.urlopen(request) as response:
+            response.read()
+            return response.status
+
+    return send
+
+
+def in_process_sender(server=None):
+    """
+    Sends callbacks through the WSGI test client of server (default: the
+    production entry point, wsgi.application), one client per thread.
+    """
+    if server is None:
+        from wsgi import application as server
+
+    local = threading.local()
+
+    def send(payload):
+        if not hasattr(local, "client"):
+            local.client = server.test_client()
+        return local.client.post(
+            "/_dash-update-component", json=payload
+        ).status_code
+
+    return send
+
+
+def run_append(csv_files, result):
+    """
+    Runs database_setup.py --append on csv_files, recording its exit
+    code, output and duration in result.
+    """
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                          "database_setup.py")
+    start = time.perf_counter()
+    process = subprocess.run(
+        [sys.executable, script, "--append", "--workers", "1", *csv_files],
+        capture_output=True,
+        text=True
+    )
+    result.update(
+        returncode=process.returncode,
+        seconds=time.perf_counter() - start,
+        stderr=process.stderr
+    )
+
+
+def run_user(send, n_requests, seed, version):
+    rng = random.Random(seed)
+    timings = defaultdict(list)
+    errors = defaultdict(int)
+
+    for _ in range(n_requests):
+        name, payload = random_request(rng, version)
+        start = time.perf_counter()
+        try:
+            status = send(payload)
+        except Exception:
+            status = None
+        elapsed = time.perf_counter() - start
+
+        if status == 200:
+            timings[name].append(elapsed)
+        else:
+            errors[name] += 1
+
+    return timings, errors
+
+
+def load_test(send, users, n_requests, seed=0, version=None,
+              append=()):
+    """
+    Runs `users` concurrent simulated users of n_requests callbacks each,
+    and an append of the CSV files in `append` (if any) alongside them.
+
+    Returns {callback name: {"n", "errors", "p50_ms", "p99_ms", "max_ms"}}
+    plus an "all" entry with the overall throughput and, with append, an
+    "append" entry with the ingest's "returncode", "seconds" and "stderr".
+    """
+    appended = {}
+    appender = None
+    if append:
+        appender = threading.Thread(
+            target=run_append, args=(list(append), appended)
+        )
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=users) as pool:
+        if appender is not None:
+            appender.start()
+        outcomes = list(pool.map(
+            lambda user: run_user(send, n_requests, seed + user, version),
+            range(users)
+        ))
+    wall = time.perf_counter() - start
+    if appender is not None:
+        appender.join()
+
+    timings = defaultdict(list)
+    errors = defaultdict(int)
+    for user_timings, user_errors in outcomes:
+        for name, values in user_timings.items():
+            timings[name].extend(values)
+        for name, n in user_errors.items():
+            errors[name] += n
+
+    def summary(values, n_errors):
+        values = np.asarray(values) * 1000.0
+        if not values.size:
+            return {"n": 0, "errors": n_errors}
+        p50, p99 = np.percentile(values, [50, 99])
+        return {
+            "n": int(values.size),
+            "errors": n_errors,
+            "p50_ms": float(p50),
+            "p99_ms": float(p99),
+            "max_ms": float(values.max()),
+        }
+
+    results = {
+        name: summary(timings[name], errors[name])
+        for name in sorted(set(timings) | set(errors))
+    }
+    results["all"] = summary(
+        [value for values in timings.values() for value in values],
+        sum(errors.values())
+    )
+    results["all"]["requests_per_second"] = (
+        (results["all"]["n"] + results["all"]["errors"]) / wall
+    )
+    if appender is not None:
+        results["append"] = appended
+    return results
+
+
+def print_results(results):
+    print(f"{'callback':<26} {'n':>6} {'errors':>6} "
+          f"{'p50 ms':>9} {'p99 ms':>9} {'max ms':>9}")
+    for name, result in results.items():
+        if name == "append":
+            continue
+        if not result["n"]:
+            print(f"{name:<26} {0:>6} {result['errors']:>6}")
+            continue
+        print(
+            f"{name:<26} {result['n']:>6} {result['errors']:>6} "
+            f"{result['p50_ms']:>9.1f} {result['p99_ms']:>9.1f} "
+            f"{result['max_ms']:>9.1f}"
+        )
+    print(f"\n{results['all']['requests_per_second']:.1f} requests/s")
+
+    append = results.get("append")
+    if append is not None:
+        outcome = "ok" if append["returncode"] == 0 else (
+            f"FAILED (exit {append['returncode']})"
+        )
+        print(f"Concurrent append: {outcome} in {append['seconds']:.1f} s")
+        if append["returncode"]:
+            print(append["stderr"].strip())
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--url",
+        help="dashboard to test, e.g. http://127.0.0.1:8050 "
+             "(default: the app in-process)"
+    )
+    parser.add_argument("--users", type=int, default=16)
+    parser.add_argument(
+        "--requests",
+        type=int,
+        default=50,
+        help="callbacks fired by each user (default: %(default)s)"
+    )
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--append",
+        nargs="+",
+        default=(),
+        metavar="CSV",
+        help="CSV files to ingest with database_setup.py --append while "
+             "the users are running"
+    )
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    configure(args.profile)
+
+    send = http_sender(args.url) if args.url else in_process_sender()
+    results = load_test(send, args.users, args.requests, args.seed,
+                        append=args.append)
+    print_results(results)
+
+    if results.get("append", {}).get("returncode"):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
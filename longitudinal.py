@@ -0,0 +1,177 @@
+"""
+Per-subject trajectories of cell population frequencies over
+time_from_treatment_start.
+
+The cohort's frequencies are read with a single query and pivoted into a
+(subject x timepoint x population) array; every subject's change from
+baseline is then compared between responders and non-responders at each
+later timepoint with batch_stats' vectorized Mann–Whitney engine.
+
+    python longitudinal.py
+"""
+import argparse
+
+import numpy as np
+import pandas as pd
+
+from batch_stats import MIN_GROUP_SIZE, benjamini_hochberg, mann_whitney_grid
+from instrumentation import add_profile_argument, configure, instrument, staged
+from queries import RESPONSE_COHORT, longitudinal_frequencies_query
+from storage import open_storage, read_frame
+
+
+@staged("longitudinal.fetch_trajectories")
+def fetch_trajectories(conn, **filters):
+    """
+    Pivots the cohort's frequencies into one array. Subjects are told
+    apart by project and subject code; samples without a timepoint are
+    left out.
+
+    Returns:
+        {
+            "projects": each subject's project, one per row of "values",
+            "subjects": subject codes, one per row of "values",
+            "responses": each subject's response (from its latest sample),
+            "timepoints": sorted timepoints,
+            "populations": population names,
+            "values": float array (subject x timepoint x population);
+                      NaN where a subject has no sample at a timepoint,
+                      the mean where it has several
+        }
+    """
+    sql, params = longitudinal_frequencies_query(**filters)
+    frame = read_frame(conn, sql, params).dropna(
+        subset=["timepoint", "population_id"]
+    )
+    names = dict(conn.execute("SELECT id, name FROM populations"))
+
+    # The same subject code may be used by several projects
+    subject_index, subjects = pd.MultiIndex.from_frame(
+        frame[["project", "subject"]]
+    ).factorize(sort=True)
+    timepoint_index, timepoints = pd.factorize(frame["timepoint"], sort=True)
+    population_index, population_ids = pd.factorize(
+        frame["population_id"], sort=True
+    )
+    shape = (len(subjects), len(timepoints), len(population_ids))
+
+    percentages = frame["percentage"].to_numpy(dtype=np.float64)
+    present = ~np.isnan(percentages)
+    cells = np.ravel_multi_index(
+        (subject_index[present], timepoint_index[present],
+         population_index[present]),
+        shape
+    )
+    size = int(np.prod(shape))
+    sums = np.bincount(cells, weights=percentages[present], minlength=size)
+    counts = np.bincount(cells, minlength=size)
+
+    with np.errstate(invalid="ignore"):
+        values = (sums / counts).reshape(shape)
+
+    responses = np.empty(len(subjects), dtype=object)
+    order = np.argsort(timepoint_index, kind="stable")
+    responses[subject_index[order]] = frame["response"].to_numpy()[order]
+
+    return {
+        "projects": np.asarray(subjects.get_level_values(0)),
+        "subjects": np.asarray(subjects.get_level_values(1)),
+        "responses": responses,
+        "timepoints": np.asarray(timepoints, dtype=np.float64),
+        "populations": [names[population_id] for population_id in population_ids],
+        "values": values,
+    }
+
+
+def baseline_deltas(values, baseline=0):
+    """
+    Change of each subject's frequencies from its value at timepoint
+    index `baseline`; NaN where either value is missing.
+    """
+    return values - values[:, baseline:baseline + 1, :]
+
+
+def _group_means(deltas, members):
+    """
+    Mean change per (timepoint, population) over the member subjects,
+    ignoring missing values, flattened like the test strata.
+    """
+    selected = deltas[members]
+    counts = np.sum(~np.isnan(selected), axis=0)
+    sums = np.nansum(selected, axis=0)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return (sums / counts).ravel()
+
+
+@staged("longitudinal.compare_trajectories", rows=len)
+def compare_trajectories(trajectories, min_group_size=MIN_GROUP_SIZE):
+    """
+    Responders vs non-responders on the change from baseline (the first
+    timepoint) at every later timepoint, for all populations at once.
+
+    Returns one row per tested (timepoint, population): mean change and
+    number of subjects in each group, the Mann–Whitney U and p-value, and
+    Benjamini–Hochberg q-values across all tested cells.
+    """
+    deltas = baseline_deltas(trajectories["values"])[:, 1:, :]
+    n_timepoints, n_populations = deltas.shape[1:]
+    n_strata = n_timepoints * n_populations
+
+    responses = trajectories["responses"]
+    responders = responses == "yes"
+    known = responders | (responses == "no")
+
+    # One stratum per (timepoint, population) cell; subjects are the
+    # observations
+    strata = np.broadcast_to(
+        np.arange(n_strata).reshape(1, n_timepoints, n_populations),
+        deltas.shape
+    )
+    groups = np.broadcast_to(responders[:, None, None], deltas.shape)
+
+    result = mann_whitney_grid(
+        strata[known].ravel(),
+        groups[known].ravel(),
+        deltas[known].ravel(),
+        n_strata=n_strata
+    )
+
+    tests = pd.DataFrame({
+        "timepoint": np.repeat(trajectories["timepoints"][1:], n_populations),
+        "population": np.tile(trajectories["populations"], n_timepoints),
+        "mean_change_yes": _group_means(deltas, responders),
+        "mean_change_no": _group_means(deltas, known & ~responders),
+        "n_yes": result["n_yes"],
+        "n_no": result["n_no"],
+        "u": result["u"],
+        "p": result["p"],
+    })
+
+    tests = tests[
+        (tests["n_yes"] >= min_group_size) & (tests["n_no"] >= min_group_size)
+    ].reset_index(drop=True)
+    tests["q"] = benjamini_hochberg(tests["p"].to_numpy())
+
+    return tests
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    configure(args.profile)
+
+    with instrument(open_storage().connect()) as conn:
+        trajectories = fetch_trajectories(conn, **RESPONSE_COHORT)
+
+    print(
+        f"{len(trajectories['subjects']):,} subjects, timepoints "
+        + ", ".join(f"{t:g}" for t in trajectories["timepoints"])
+        + " (change from baseline, responders vs non-responders)"
+    )
+    with pd.option_context("display.max_rows", None, "display.width", 200):
+        print(compare_trajectories(trajectories).to_string(index=False))
+
+
+if __name__ == "__main__":
+    main()
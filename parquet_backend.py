@@ -0,0 +1,169 @@
+"""
+Columnar analysis backend over the Parquet export of database_setup
+(python database_setup.py --parquet).
+
+Cohort filters become pyarrow dataset filters: those on the partition
+columns (project, treatment) skip whole directories, the others are
+pushed down to Parquet row-group statistics, and only the columns an
+analysis needs are read, from memory-mapped files. The responder frame is
+thus a scan of a handful of columns instead of a three-table SQL join.
+
+The export is a snapshot: it is only used while its data generation
+matches the database's, and callers fall back to SQLite otherwise (or
+when pyarrow is not installed). Select it with CELL_COUNTS_BACKEND=parquet
+or data_analysis.py --backend parquet.
+"""
+import importlib.util
+import os
+from array import array
+from collections import defaultdict
+
+import numpy as np
+
+from database_setup import PARQUET_DIR, PARQUET_PARTITIONS, load_parquet_manifest
+from queries import COHORT_COLUMNS, RESPONSE_COHORT
+from result_cache import data_generation
+
+BACKEND_ENV_VAR = "CELL_COUNTS_BACKEND"
+BACKENDS = ("sqlite", "parquet")
+
+
+def default_backend():
+    backend = os.environ.get(BACKEND_ENV_VAR, "sqlite")
+    if backend not in BACKENDS:
+        raise ValueError(
+            f"{BACKEND_ENV_VAR} must be one of {', '.join(BACKENDS)}, "
+            f"not {backend!r}"
+        )
+    return backend
+
+
+def available(conn, parquet_dir=PARQUET_DIR):
+    """
+    Whether pyarrow is installed and the export in parquet_dir is of the
+    database's current data generation.
+    """
+    # find_spec of a submodule raises if its package is missing
+    if (importlib.util.find_spec("pyarrow") is None
+            or importlib.util.find_spec("pyarrow.dataset") is None):
+        return False
+
+    manifest = load_parquet_manifest(parquet_dir)
+    return (
+        manifest is not None
+        and manifest["generation"] == data_generation(conn)
+    )
+
+
+def cohort_expression(**filters):
+    """
+    pyarrow filter expression equivalent to queries.cohort_where.
+    """
+    import pyarrow.dataset as ds
+
+    expression = None
+    for name, value in filters.items():
+        if value is None:
+            continue
+        if name not in COHORT_COLUMNS:
+            raise ValueError(f"Unknown cohort filter: {name}")
+
+        field = ds.field(COHORT_COLUMNS[name])
+        if isinstance(value, (list, tuple, set, frozenset)):
+            condition = field.isin(sorted(value))
+        else:
+            condition = field == value
+        expression = condition if expression is None else expression & condition
+
+    return expression
+
+
+def dataset(name, parquet_dir=PARQUET_DIR):
+    """
+    One exported dataset ("samples" or "frequencies"), read through
+    memory maps.
+    """
+    import pyarrow as pa
+    import pyarrow.dataset as ds
+    import pyarrow.fs
+
+    manifest = load_parquet_manifest(parquet_dir)
+    if manifest is None:
+        raise FileNotFoundError(f"No Parquet export in {parquet_dir}")
+
+    return ds.dataset(
+        os.path.join(parquet_dir, manifest["datasets"][name]),
+        format="parquet",
+        partitioning=ds.partitioning(
+            pa.schema([(column, pa.string()) for column in PARQUET_PARTITIONS]),
+            flavor="hive"
+        ),
+        filesystem=pa.fs.LocalFileSystem(use_mmap=True)
+    )
+
+
+def read_frequencies(columns, parquet_dir=PARQUET_DIR, **filters):
+    """
+    The given columns of the exported frequencies of a cohort, as a
+    pyarrow Table.
+    """
+    return dataset("frequencies", parquet_dir).to_table(
+        columns=list(columns), filter=cohort_expression(**filters)
+    )
+
+
+def response_samples_frame(parquet_dir=PARQUET_DIR, **filters):
+    """
+    Columnar counterpart of queries.response_samples_query: one row per
+    (sample, population) of the cohort's samples with a known response.
+    """
+    filters.setdefault("response", ("no", "yes"))
+    return read_frequencies(
+        ("sample", "population", "percentage", "response"),
+        parquet_dir,
+        **filters
+    ).to_pandas()
+
+
+def fetch_response_data(parquet_dir=PARQUET_DIR, cohort=RESPONSE_COHORT,
+                        max_bytes=None):
+    """
+    Columnar counterpart of data_analysis.fetch_response_data: a scan of
+    the population, response and percentage columns, split into one
+    array('d') per (population, response) group.
+
+    Raises MemoryError before reading anything if the arrays would need
+    more than max_bytes.
+    """
+    import pyarrow.compute as pc
+
+    if max_bytes is not None:
+        needed = dataset("frequencies", parquet_dir).count_rows(
+            filter=cohort_expression(**cohort)
+        ) * array("d").itemsize
+        if needed > max_bytes:
+            raise MemoryError(
+                f"Response data needs {needed:,} bytes, over the "
+                f"{max_bytes:,} byte limit"
+            )
+
+    table = read_frequencies(
+        ("population", "response", "percentage"), parquet_dir, **cohort
+    )
+
+    populations = pc.dictionary_encode(table["population"]).combine_chunks()
+    responses = pc.dictionary_encode(table["response"]).combine_chunks()
+    population_codes = populations.indices.to_numpy()
+    response_codes = responses.indices.to_numpy()
+    # Null percentages come out as NaN, as from the SQLite backend
+    percentages = table["percentage"].to_numpy().astype(np.float64)
+
+    data = defaultdict(lambda: {"yes": array("d"), "no": array("d")})
+    for i, population in enumerate(populations.dictionary.to_pylist()):
+        for j, response in enumerate(responses.dictionary.to_pylist()):
+            selected = (population_codes == i) & (response_codes == j)
+            data[population][response] = array(
+                "d", percentages[selected].tobytes()
+            )
+
+    return dict(sorted(data.items()))
@@ -0,0 +1,536 @@
+"""
+SQL and cohort filters shared by data_analysis.py and dashboard.py, plus a
+query-plan check that every shipped query is served by an index.
+
+Run `python queries.py` after building a SQLite database (the one named by
+CELL_COUNTS_DATABASE, or cell_counts.db); it prints the plan of each query
+and exits non-zero if any of them falls back to a full scan. The same
+check runs as part of the test suite (tests/test_query_plans.py).
+"""
+import re
+import sys
+from collections import defaultdict
+
+from instrumentation import configure, instrument
+from storage import open_storage
+
+
+# -------------------------
+# Shipped queries
+# -------------------------
+
+RESPONSE_FREQUENCIES_SQL = """
+    SELECT
+        p.name AS population,
+        c.response,
+        f.percentage
+    FROM cell_counts_csv c
+    JOIN population_frequencies f
+      ON f.sample_id = c.sample_id
+    JOIN populations p
+      ON p.id = f.population_id
+    WHERE
+        c.treatment = 'miraclib'
+        AND c.sample_type = 'PBMC'
+        AND c.response IN ('yes', 'no')
+"""
+
+RESPONSE_GROUP_SIZES_SQL = """
+    SELECT
+        f.population_id,
+        c.response,
+        COUNT(*) AS n
+    FROM cell_counts_csv c
+    JOIN population_frequencies f
+      ON f.sample_id = c.sample_id
+    WHERE
+        c.treatment = 'miraclib'
+        AND c.sample_type = 'PBMC'
+        AND c.response IN ('yes', 'no')
+    GROUP BY f.population_id, c.response
+"""
+
+# Every responder/non-responder frequency with the columns that define a
+# comparison stratum, for batch_stats
+GRID_FREQUENCIES_SQL = """
+    SELECT
+        c.treatment,
+        c.condition,
+        c.sample_type,
+        c.time_from_treatment_start AS timepoint,
+        p.name AS population,
+        c.response,
+        f.percentage
+    FROM cell_counts_csv c
+    JOIN population_frequencies f
+      ON f.sample_id = c.sample_id
+    JOIN populations p
+      ON p.id = f.population_id
+    WHERE
+        c.response IN ('yes', 'no')
+"""
+
+AVG_B_CELLS_MALE_RESPONDERS_SQL = """
+    SELECT
+        AVG(b_cell) AS avg_b_cells
+    FROM cell_counts_csv
+    WHERE
+        condition = 'melanoma'
+        AND sex = 'M'
+        AND response = 'yes'
+        AND time_from_treatment_start = 0
+        AND b_cell IS NOT NULL
+"""
+
+
+# -------------------------
+# Cohort filters
+# -------------------------
+
+# Filter name -> cell_counts_csv column
+COHORT_COLUMNS = {
+    "project": "project",
+    "condition": "condition",
+    "treatment": "treatment",
+    "sample_type": "sample_type",
+    "timepoint": "time_from_treatment_start",
+    "sex": "sex",
+    "response": "response",
+}
+
+# PBMC samples treated with miraclib with a known response, the cohort
+# of RESPONSE_FREQUENCIES_SQL
+RESPONSE_COHORT = {
+    "treatment": "miraclib",
+    "sample_type": "PBMC",
+    "response": ("no", "yes"),
+}
+
+# Baseline melanoma PBMC samples treated with miraclib
+BASELINE_COHORT = {
+    "condition": "melanoma",
+    "treatment": "miraclib",
+    "sample_type": "PBMC",
+    "timepoint": 0,
+}
+
+# Melanoma PBMC samples treated with miraclib, at any timepoint
+MELANOMA_PBMC_COHORT = {
+    "condition": "melanoma",
+    "treatment": "miraclib",
+    "sample_type": "PBMC",
+}
+
+
+def cohort_where(alias="", **filters):
+    """
+    Builds a parameterized WHERE clause over cell_counts_csv from cohort
+    filters (see COHORT_COLUMNS). A filter value may be a single value or
+    a list/tuple of allowed values; None means "any".
+
+    Returns (clause, params); the clause is empty when nothing is filtered.
+    """
+    prefix = f"{alias}." if alias else ""
+    conditions = []
+    params = []
+
+    for name, value in filters.items():
+        if value is None:
+            continue
+        if name not in COHORT_COLUMNS:
+            raise ValueError(f"Unknown cohort filter: {name}")
+
+        column = prefix + COHORT_COLUMNS[name]
+        if isinstance(value, (list, tuple, set, frozenset)):
+            values = sorted(value)
+            conditions.append(
+                f"{column} IN ({', '.join('?' * len(values))})"
+            )
+            params.extend(values)
+        else:
+            conditions.append(f"{column} = ?")
+            params.append(value)
+
+    if not conditions:
+        return "", []
+    return "WHERE " + "\n        AND ".join(conditions), params
+
+
+def cohort_summary_query(**filters):
+    """
+    One grouped query returning a row per (project, response, sex,
+    subject) in the cohort with its sample count; everything
+    cohort_summary reports is derived from these rows.
+    """
+    where, params = cohort_where(**filters)
+    sql = f"""
+    SELECT project, response, sex, subject, COUNT(*) AS n
+    FROM cell_counts_csv
+    {where}
+    GROUP BY project, response, sex, subject
+    """
+    return sql, params
+
+
+def cohort_summary(conn, **filters):
+    """
+    Counts for a cohort in a single pass over cell_counts_csv.
+
+    Returns:
+        {
+            "total": number of samples,
+            "project": {project: number of samples},
+            "response": {response: number of distinct subjects},
+            "sex": {sex: number of distinct subjects}
+        }
+    """
+    sql, params = cohort_summary_query(**filters)
+
+    total = 0
+    project_counts = defaultdict(int)
+    response_subjects = defaultdict(set)
+    sex_subjects = defaultdict(set)
+
+    for project, response, sex, subject, n in conn.execute(sql, params):
+        total += n
+        project_counts[project] += n
+        response_subjects[response].add(subject)
+        sex_subjects[sex].add(subject)
+
+    return {
+        "total": total,
+        "project": dict(sorted(project_counts.items())),
+        "response": {
+            response: len(subjects)
+            for response, subjects in sorted(response_subjects.items())
+        },
+        "sex": {
+            sex: len(subjects)
+            for sex, subjects in sorted(sex_subjects.items())
+        },
+    }
+
+
+def cohort_values(conn, name):
+    """
+    Distinct values of a cohort filter column, sorted.
+    """
+    column = COHORT_COLUMNS[name]
+    return [
+        value for (value,) in conn.execute(f"""
+            SELECT DISTINCT {column}
+            FROM cell_counts_csv
+            WHERE {column} IS NOT NULL
+            ORDER BY {column}
+        """)
+    ]
+
+
+def response_samples_query(**filters):
+    """
+    One row per (sample, population) in the cohort for samples with a
+    known response; the dashboard's boxplot data.
+    """
+    filters.setdefault("response", ("no", "yes"))
+    where, params = cohort_where("c", **filters)
+    sql = f"""
+    SELECT
+        c.sample,
+        p.name AS population,
+        f.percentage,
+        c.response,
+        c.sex
+    FROM cell_counts_csv c
+    JOIN population_frequencies f
+      ON f.sample_id = c.sample_id
+    JOIN populations p
+      ON p.id = f.population_id
+    {where}
+    """
+    return sql, params
+
+
+def longitudinal_frequencies_query(**filters):
+    """
+    One row per (sample, population) in the cohort with the sample's
+    project, subject, response and timepoint, for longitudinal.py.
+    """
+    where, params = cohort_where("c", **filters)
+    sql = f"""
+    SELECT
+        c.project,
+        c.subject,
+        c.response,
+        c.time_from_treatment_start AS timepoint,
+        f.population_id,
+        f.percentage
+    FROM cell_counts_csv c
+    JOIN population_frequencies f
+      ON f.sample_id = c.sample_id
+    {where}
+    """
+    return sql, params
+
+
+# -------------------------
+# Frequency table paging
+# -------------------------
+
+# Columns of cell_population_frequencies shown by the dashboard table
+FREQUENCY_TABLE_COLUMNS = (
+    "sample", "total_count", "population", "count", "percentage"
+)
+
+# Dash DataTable filter operators -> SQL comparison
+FILTER_OPERATORS = {
+    "=": "=", "eq": "=",
+    "!=": "!=", "ne": "!=",
+    "<": "<", "lt": "<",
+    "<=": "<=", "le": "<=",
+    ">": ">", "gt": ">",
+    ">=": ">=", "ge": ">=",
+}
+
+FILTER_PART = re.compile(
+    r"^\{(?P<column>[^}]+)\}\s*(?P<case>[is]?)"
+    r"(?P<operator>contains|datestartswith|>=|<=|!=|[<>=]|eq|ne|lt|le|gt|ge)"
+    r"\s*(?P<value>.*)$"
+)
+
+
+def _filter_value(text):
+    text = text.strip()
+    if len(text) >= 2 and text[0] == text[-1] and text[0] in "'\"`":
+        return text[1:-1].replace("\\" + text[0], text[0])
+    try:
+        return float(text)
+    except ValueError:
+        return text
+
+
+def table_filter_where(filter_query):
+    """
+    Translates a Dash DataTable filter_query (parts joined by " && ",
+    e.g. '{population} = b_cell && {percentage} > 0.2') into a
+    parameterized WHERE clause over cell_population_frequencies.
+
+    Returns (clause, params). Raises ValueError for unknown columns or
+    operators.
+    """
+    conditions = []
+    params = []
+
+    for part in filter(None, (filter_query or "").split(" && ")):
+        match = FILTER_PART.match(part.strip())
+        if not match or match["column"] not in FREQUENCY_TABLE_COLUMNS:
+            raise ValueError(f"Unsupported table filter: {part}")
+
+        column = match["column"]
+        operator = match["operator"]
+        value = _filter_value(match["value"])
+
+        if operator == "contains":
+            if match["case"] == "s":
+                conditions.append(f"instr(CAST({column} AS TEXT), ?) > 0")
+                params.append(str(value))
+            else:
+                # LOWER() on both sides: LIKE is case-sensitive on
+                # PostgreSQL
+                conditions.append(f"LOWER(CAST({column} AS TEXT)) LIKE LOWER(?)")
+                params.append(f"%{value}%")
+        elif operator == "datestartswith":
+            conditions.append(f"CAST({column} AS TEXT) LIKE ?")
+            params.append(f"{value}%")
+        else:
+            conditions.append(f"{column} {FILTER_OPERATORS[operator]} ?")
+            params.append(value)
+
+    if not conditions:
+        return "", []
+    return "WHERE " + "\n        AND ".join(conditions), params
+
+
+def frequency_page_query(filter_query="", sort_by=(), page=0, page_size=15):
+    """
+    One page of cell_population_frequencies for a Dash DataTable with
+    custom paging, filtering and sorting.
+
+    sort_by is the DataTable's list of {"column_id", "direction"}; rows
+    are always ordered by (sample, population) last so pages are stable.
+    Filters on sample, population and percentage and ordering by sample
+    or population are served by indexes, and so is ordering by percentage
+    within one population.
+    """
+    where, params = table_filter_where(filter_query)
+
+    order = []
+    for sort in sort_by or ():
+        column = sort["column_id"]
+        if column not in FREQUENCY_TABLE_COLUMNS:
+            raise ValueError(f"Unknown sort column: {column}")
+        direction = "DESC" if sort["direction"] == "desc" else "ASC"
+        order.append(f"{column} {direction}")
+
+    if order and order[0].startswith("percentage "):
+        # Ties broken by the frequency's key, in the same direction: the
+        # population index ends with it, so a page of one population is
+        # read in order
+        direction = order[0].split()[1]
+        order += [f"sample_id {direction}", f"population_id {direction}"]
+    else:
+        order += ["sample", "population"]
+
+    sql = f"""
+    SELECT {", ".join(FREQUENCY_TABLE_COLUMNS)}
+    FROM cell_population_frequencies
+    {where}
+    ORDER BY {", ".join(order)}
+    LIMIT ? OFFSET ?
+    """
+    return sql, params + [page_size, page * page_size]
+
+
+def frequency_count_query(filter_query=""):
+    where, params = table_filter_where(filter_query)
+    sql = f"""
+    SELECT COUNT(*)
+    FROM cell_population_frequencies
+    {where}
+    """
+    return sql, params
+
+
+BY_PERCENTAGE = [{"column_id": "percentage", "direction": "desc"}]
+
+# Every shipped query, with its parameters, for check_query_plans. The
+# frequency table is listed with the filters and sorts its indexes serve;
+# filters on count or total_count (computed by the view), "contains"
+# filters and the unfiltered row count read every row. Percentages are
+# indexed per population only, so a percentage filter or sort across all
+# populations sorts its matches (about 20 ms for 50,000 rows).
+SHIPPED_QUERIES = {
+    "response_frequencies": (RESPONSE_FREQUENCIES_SQL, ()),
+    "response_group_sizes": (RESPONSE_GROUP_SIZES_SQL, ()),
+    "grid_frequencies": (GRID_FREQUENCIES_SQL, ()),
+    "response_samples": response_samples_query(**RESPONSE_COHORT),
+    "baseline_summary": cohort_summary_query(**BASELINE_COHORT),
+    "melanoma_pbmc_summary": cohort_summary_query(**MELANOMA_PBMC_COHORT),
+    "avg_b_cells_male_responders": (AVG_B_CELLS_MALE_RESPONDERS_SQL, ()),
+    "longitudinal_frequencies": longitudinal_frequencies_query(
+        **RESPONSE_COHORT
+    ),
+    "frequency_page": frequency_page_query(),
+    "frequency_page_by_population": frequency_page_query(
+        sort_by=[{"column_id": "population", "direction": "asc"}]
+    ),
+    "frequency_page_population": frequency_page_query(
+        "{population} = b_cell", BY_PERCENTAGE
+    ),
+    "frequency_page_sample": frequency_page_query("{sample} = sample00000"),
+    "frequency_page_percentage": frequency_page_query(
+        "{population} = b_cell && {percentage} > 0.2", BY_PERCENTAGE
+    ),
+    "frequency_count_population": frequency_count_query(
+        "{population} = b_cell"
+    ),
+    "frequency_count_sample": frequency_count_query("{sample} = sample00000"),
+    "frequency_count_percentage": frequency_count_query(
+        "{population} = b_cell && {percentage} > 0.2"
+    ),
+}
+
+
+def shipped_queries():
+    """
+    SHIPPED_QUERIES plus the cohort summary statements of summaries.py
+    (which imports this module, so they cannot be listed above).
+    """
+    from summaries import (
+        cohort_size_query,
+        group_delete_query,
+        merged_summaries_query,
+    )
+
+    return {
+        **SHIPPED_QUERIES,
+        "summaries_response": merged_summaries_query(**RESPONSE_COHORT),
+        "summaries_melanoma_pbmc": merged_summaries_query(
+            **MELANOMA_PBMC_COHORT
+        ),
+        "summaries_avg_b_cells": merged_summaries_query(
+            condition="melanoma", sex="M", response="yes", timepoint=0
+        ),
+        "summaries_cohort_size": cohort_size_query(**RESPONSE_COHORT),
+        "summaries_group_delete": group_delete_query(
+            ("prj1", "miraclib", "melanoma", "PBMC", 0.0, "yes", "M")
+        ),
+    }
+
+
+# -------------------------
+# Query-plan check
+# -------------------------
+
+def query_plan(conn, sql, params=()):
+    """
+    Returns the EXPLAIN QUERY PLAN detail lines of a query.
+    """
+    return [
+        row[3] for row in conn.execute("EXPLAIN QUERY PLAN " + sql, params)
+    ]
+
+
+def full_scan(sql, plan):
+    """
+    Whether a query plan reads a whole table or index. A SCAN is allowed
+    only in a LIMITed query that needs no sort of its full result: the
+    rows are then read in ORDER BY order and the scan stops after the
+    page.
+    """
+    ordered_page = (
+        re.search(r"\bLIMIT\b", sql)
+        and "USE TEMP B-TREE FOR ORDER BY" not in plan
+    )
+    return not ordered_page and any(step.startswith("SCAN") for step in plan)
+
+
+def check_query_plans(conn, queries=None):
+    """
+    Returns {query name: plan} for every query whose plan is a
+    full_scan (an empty dict means every query uses an index).
+    """
+    queries = shipped_queries() if queries is None else queries
+    failures = {}
+
+    for name, (sql, params) in queries.items():
+        plan = query_plan(conn, sql, params)
+        if full_scan(sql, plan):
+            failures[name] = plan
+
+    return failures
+
+
+def main():
+    configure()
+
+    storage = open_storage()
+    if storage.kind != "sqlite":
+        sys.exit("The query-plan check runs on SQLite databases only.")
+
+    with instrument(storage.connect()) as conn:
+        for name, (sql, params) in shipped_queries().items():
+            print(name)
+            for step in query_plan(conn, sql, params):
+                print(f"  {step}")
+
+        failures = check_query_plans(conn)
+
+    if failures:
+        print("\nQueries falling back to a full scan: " + ", ".join(failures))
+        sys.exit(1)
+
+    print("\nAll shipped queries use indexes.")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,282 @@
+"""
+Permutation p-values and bootstrap confidence intervals for the difference
+in median frequency between responders and non-responders.
+
+Each population's resamples are split into fixed-size blocks that run in a
+process pool. Every block draws from its own child of one SeedSequence, so
+results depend only on the seed and the numbers of resamples, never on the
+number of workers.
+
+    python resampling.py --permutations 100000 --workers 8
+"""
+import argparse
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+from instrumentation import add_profile_argument, configure, instrument, staged
+from storage import open_storage
+
+N_PERMUTATIONS = 10_000
+N_BOOTSTRAP = 10_000
+SEED = 0
+
+# Resamples per pool task; fixed so the block -> seed mapping, and hence
+# the results, do not depend on the number of workers
+BLOCK_SIZE = 5_000
+
+# Resamples drawn at once within a block (rows of the resample matrix)
+CHUNK_SIZE = 1_000
+
+CONFIDENCE = 0.95
+
+
+def _median_ranks(n):
+    """
+    0-based ranks of the order statistics averaged into the median.
+    """
+    return (n - 1) // 2, n // 2
+
+
+def median_difference(yes, no):
+    return float(np.median(yes) - np.median(no))
+
+
+def permutation_block(pooled, n_yes, n_resamples, seed_sequence):
+    """
+    Median differences (first n_yes vs the rest) for n_resamples random
+    relabelings of the sorted pooled values.
+
+    Each relabeling assigns the n_yes smallest of n random keys to the
+    responders (float64 keys practically never tie); because pooled is
+    sorted, each group's median is found from the position of its k-th
+    member (a cumulative count) instead of sorting the values themselves.
+    """
+    rng = np.random.default_rng(seed_sequence)
+    n = pooled.size
+    yes_ranks = _median_ranks(n_yes)
+    no_ranks = _median_ranks(n - n_yes)
+    count_dtype = np.int16 if n < np.iinfo(np.int16).max else np.int32
+    positions = np.arange(1, n + 1, dtype=count_dtype)
+
+    statistics = np.empty(n_resamples)
+    for start in range(0, n_resamples, CHUNK_SIZE):
+        size = min(CHUNK_SIZE, n_resamples - start)
+
+        keys = rng.random((size, n))
+        cutoff = np.partition(keys, n_yes - 1, axis=1)[:, n_yes - 1:n_yes]
+        is_yes = keys <= cutoff
+
+        yes_seen = np.cumsum(is_yes, axis=1, dtype=count_dtype)
+        no_seen = positions - yes_seen
+
+        yes_median = sum(
+            pooled[np.argmax(yes_seen > rank, axis=1)] for rank in yes_ranks
+        ) / 2.0
+        no_median = sum(
+            pooled[np.argmax(no_seen > rank, axis=1)] for rank in no_ranks
+        ) / 2.0
+
+        statistics[start:start + size] = yes_median - no_median
+
+    return statistics
+
+
+def bootstrap_block(yes, no, n_resamples, seed_sequence):
+    """
+    Median differences for n_resamples bootstrap resamples of each
+    (sorted) group. Resampled indices are partitioned rather than the
+    values, since index order is value order.
+    """
+    rng = np.random.default_rng(seed_sequence)
+
+    statistics = np.empty(n_resamples)
+    for start in range(0, n_resamples, CHUNK_SIZE):
+        size = min(CHUNK_SIZE, n_resamples - start)
+
+        medians = []
+        for values in (yes, no):
+            ranks = list(_median_ranks(values.size))
+            indices = np.partition(
+                rng.integers(
+                    0, values.size, (size, values.size), dtype=np.int32
+                ),
+                ranks,
+                axis=1
+            )
+            medians.append(
+                (values[indices[:, ranks[0]]] + values[indices[:, ranks[1]]])
+                / 2.0
+            )
+
+        statistics[start:start + size] = medians[0] - medians[1]
+
+    return statistics
+
+
+def _run_block(task):
+    kind, yes, no, n_resamples, seed_sequence = task
+    if kind == "permutation":
+        return permutation_block(
+            np.sort(np.concatenate([yes, no])), yes.size, n_resamples,
+            seed_sequence
+        )
+    return bootstrap_block(yes, no, n_resamples, seed_sequence)
+
+
+def _blocks(n_resamples):
+    return [
+        min(BLOCK_SIZE, n_resamples - start)
+        for start in range(0, n_resamples, BLOCK_SIZE)
+    ]
+
+
+@staged("resampling.resampling_tests", rows=len)
+def resampling_tests(data, n_permutations=N_PERMUTATIONS,
+                     n_bootstrap=N_BOOTSTRAP, seed=SEED, workers=1,
+                     confidence=CONFIDENCE):
+    """
+    Permutation test and bootstrap confidence interval of the median
+    difference (responders - non-responders) for each population of data,
+    shaped like data_analysis.fetch_response_data (NaNs are dropped).
+    Populations with fewer than 3 samples in either group are skipped.
+
+    Returns:
+        dict[cell_population] = {
+            "median_difference": observed median(yes) - median(no),
+            "p": two-sided permutation p-value, (b + 1) / (n + 1),
+            "ci_low", "ci_high": percentile bootstrap interval,
+            "n_permutations", "n_bootstrap"
+        }
+    """
+    groups = {}
+    for population in sorted(data):
+        yes, no = (
+            np.sort(np.asarray(data[population][response], dtype=np.float64))
+            for response in ("yes", "no")
+        )
+        yes, no = yes[~np.isnan(yes)], no[~np.isnan(no)]
+        if yes.size >= 3 and no.size >= 3:
+            groups[population] = (yes, no)
+
+    # Seeds are handed out in population order before anything runs
+    root = np.random.SeedSequence(seed)
+    tasks = []
+    for (population, (yes, no)), population_seed in zip(
+        groups.items(), root.spawn(len(groups))
+    ):
+        permutation_seed, bootstrap_seed = population_seed.spawn(2)
+        for kind, n_resamples, kind_seed in (
+            ("permutation", n_permutations, permutation_seed),
+            ("bootstrap", n_bootstrap, bootstrap_seed),
+        ):
+            sizes = _blocks(n_resamples)
+            for size, block_seed in zip(sizes, kind_seed.spawn(len(sizes))):
+                tasks.append(
+                    (population, (kind, yes, no, size, block_seed))
+                )
+
+    if workers <= 1 or len(tasks) <= 1:
+        outputs = [_run_block(task) for _, task in tasks]
+    else:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            outputs = list(pool.map(_run_block, [task for _, task in tasks]))
+
+    statistics = {
+        population: {"permutation": [], "bootstrap": []}
+        for population in groups
+    }
+    for (population, task), output in zip(tasks, outputs):
+        statistics[population][task[0]].append(output)
+
+    tail = (1.0 - confidence) / 2.0 * 100.0
+    results = {}
+    for population, (yes, no) in groups.items():
+        observed = median_difference(yes, no)
+        permuted = np.concatenate(
+            statistics[population]["permutation"] or [np.empty(0)]
+        )
+        bootstrapped = np.concatenate(
+            statistics[population]["bootstrap"] or [np.empty(0)]
+        )
+
+        # Tolerance so relabelings tied with the observed split count
+        extreme = np.abs(permuted) >= abs(observed) * (1 - 1e-12)
+        ci_low, ci_high = (
+            np.percentile(bootstrapped, [tail, 100.0 - tail])
+            if bootstrapped.size else (np.nan, np.nan)
+        )
+
+        results[population] = {
+            "median_difference": observed,
+            "p": float((extreme.sum() + 1) / (permuted.size + 1)),
+            "ci_low": float(ci_low),
+            "ci_high": float(ci_high),
+            "n_permutations": int(permuted.size),
+            "n_bootstrap": int(bootstrapped.size),
+        }
+
+    return results
+
+
+def print_resampling_results(results, confidence=CONFIDENCE):
+    print("\nResampling (median difference, responders - non-responders)")
+    print("------------------------------------------------------------")
+
+    for population, result in results.items():
+        print(
+            f"{population:<15} diff = {result['median_difference']:+.4f}  "
+            f"{confidence:.0%} CI [{result['ci_low']:+.4f}, "
+            f"{result['ci_high']:+.4f}]  "
+            f"p = {result['p']:.4g} "
+            f"({result['n_permutations']:,} permutations)"
+        )
+
+
+def main():
+    from data_analysis import add_max_memory_argument, fetch_response_data
+
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--permutations",
+        type=int,
+        default=N_PERMUTATIONS,
+        help="permutations per population (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--bootstrap",
+        type=int,
+        default=N_BOOTSTRAP,
+        help="bootstrap resamples per population (default: %(default)s)"
+    )
+    parser.add_argument("--seed", type=int, default=SEED)
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=os.cpu_count() or 1,
+        help="processes to spread resampling over (default: %(default)s)"
+    )
+    add_max_memory_argument(parser)
+    add_profile_argument(parser)
+    args = parser.parse_args()
+    configure(args.profile)
+
+    try:
+        with instrument(open_storage().connect()) as conn:
+            data = fetch_response_data(conn, max_bytes=args.max_memory)
+    except MemoryError as error:
+        sys.exit(f"{error} (see --max-memory)")
+
+    print_resampling_results(resampling_tests(
+        data,
+        n_permutations=args.permutations,
+        n_bootstrap=args.bootstrap,
+        seed=args.seed,
+        workers=args.workers
+    ))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+"""
+Persistent cache of analysis results stored in the database itself.
+
+Entries are keyed by the kind of result and the cohort filter it was
+computed for, and are only valid for the data generation they were
+computed at. database_setup bumps that generation on every ingest that
+changes data, so results are recomputed exactly once after new data lands.
+"""
+import json
+
+from storage import DATABASE_ERRORS, reset_after_error
+
+CACHE_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS analysis_cache (
+        kind TEXT NOT NULL,
+        cohort_key TEXT NOT NULL,
+        generation INTEGER NOT NULL,
+        result TEXT NOT NULL,
+        created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+        PRIMARY KEY (kind, cohort_key)
+    )
+"""
+
+
+def data_generation(conn):
+    """
+    Current data generation, or 0 if the database does not track one.
+    """
+    try:
+        row = conn.execute("SELECT generation FROM data_generation").fetchone()
+    except DATABASE_ERRORS:
+        reset_after_error(conn)
+        return 0
+    return row[0] if row else 0
+
+
+def cohort_key(cohort):
+    """
+    Canonical JSON form of a cohort filter dict.
+    """
+    return json.dumps(cohort, sort_keys=True, default=sorted)
+
+
+def cached(conn, kind, cohort, compute, enabled=True):
+    """
+    Returns the result of compute() for (kind, cohort), from the cache if
+    it was stored at the current data generation.
+
+    Results must be JSON-serializable; they are always returned in their
+    JSON round-tripped form so hits and misses look the same. Databases
+    without a data generation are never cached.
+
+    On a read-only connection (the dashboard's pool) cached results are
+    still served, but misses are only computed, not stored.
+    """
+    generation = data_generation(conn)
+    if not enabled or generation == 0:
+        return compute()
+
+    key = cohort_key(cohort)
+    try:
+        row = conn.execute("""
+            SELECT generation, result
+            FROM analysis_cache
+            WHERE kind = ? AND cohort_key = ?
+        """, (kind, key)).fetchone()
+    except DATABASE_ERRORS:
+        reset_after_error(conn)
+        row = None  # no analysis_cache table yet
+
+    if row and row[0] == generation:
+        return json.loads(row[1])
+
+    payload = json.dumps(compute())
+    try:
+        conn.execute(CACHE_SCHEMA)
+        conn.execute("""
+            INSERT INTO analysis_cache (kind, cohort_key, generation, result)
+            VALUES (?, ?, ?, ?)
+            ON CONFLICT(kind, cohort_key) DO UPDATE SET
+                generation = excluded.generation,
+                result = excluded.result,
+                created_at = CURRENT_TIMESTAMP
+        """, (kind, key, generation, payload))
+        conn.commit()
+    except DATABASE_ERRORS:
+        # Read-only or busy database: return the result uncached
+        conn.rollback()
+
+    return json.loads(payload)
@@ -0,0 +1,215 @@
+"""
+Mergeable quantile sketches (KLL) for approximate distribution queries.
+
+A KLL sketch keeps a bounded sample of the values it has seen in levels
+of compactors: an item at level h stands for 2**h values. When a level
+outgrows its capacity it is sorted and every other item is promoted to
+the next level. Memory is O(k) whatever the number of values, sketches
+of disjoint sets merge into a sketch of their union with the same
+guarantees, and any quantile is answered to within a rank error of
+roughly 1% of the count for the default k = 200 (the error shrinks as
+1/k; see Karnin, Lang & Liberty, "Optimal Quantile Approximation in
+Streams"). Until a sketch first compacts it holds every value, and its
+quantiles are exact.
+
+Compactions alternate between keeping the even and odd items instead of
+flipping a coin, so building or merging the same data always yields the
+same sketch. The exact count, minimum and maximum are kept alongside.
+"""
+import numpy as np
+
+# Size parameter: the top level holds up to k items
+DEFAULT_K = 200
+
+# Each level holds CAPACITY_RATIO times as many items as the one above it
+CAPACITY_RATIO = 2 / 3
+
+
+class KLLSketch:
+    def __init__(self, k=DEFAULT_K):
+        self.k = k
+        self.n = 0
+        self.min = None
+        self.max = None
+        self.levels = [np.empty(0)]
+        self.compactions = [0]
+
+    def __len__(self):
+        return self.n
+
+    def __repr__(self):
+        return f"KLLSketch(k={self.k}, n={self.n}, retained={self.retained})"
+
+    @property
+    def retained(self):
+        return sum(level.size for level in self.levels)
+
+    def _capacity(self, level):
+        depth = len(self.levels) - level - 1
+        return max(int(np.ceil(self.k * CAPACITY_RATIO ** depth)), 2)
+
+    def _compress(self):
+        level = 0
+        while level < len(self.levels):
+            items = self.levels[level]
+            if items.size > self._capacity(level):
+                if level + 1 == len(self.levels):
+                    self.levels.append(np.empty(0))
+                    self.compactions.append(0)
+
+                items = np.sort(items)
+                # An odd item out stays behind, so no weight is lost
+                kept = items[items.size - items.size % 2:]
+                offset = self.compactions[level] % 2
+                self.compactions[level] += 1
+
+                promoted = items[offset:items.size - kept.size:2]
+                self.levels[level] = kept
+                self.levels[level + 1] = np.concatenate(
+                    (self.levels[level + 1], promoted)
+                )
+            level += 1
+
+    def update(self, values):
+        """
+        Adds values (NaN and None are skipped) and returns the sketch.
+        """
+        values = np.asarray(values, dtype=np.float64).ravel()
+        values = values[~np.isnan(values)]
+        if not values.size:
+            return self
+
+        self.n += int(values.size)
+        low, high = float(values.min()), float(values.max())
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+
+        self.levels[0] = np.concatenate((self.levels[0], values))
+        self._compress()
+        return self
+
+    def merge(self, other):
+        """
+        Folds another sketch (of the same k) into this one and returns it.
+        """
+        if other.k != self.k:
+            raise ValueError(f"Cannot merge sketches with k={self.k} and "
+                             f"k={other.k}")
+        if not other.n:
+            return self
+
+        self.n += other.n
+        self.min = other.min if self.min is None else min(self.min, other.min)
+        self.max = other.max if self.max is None else max(self.max, other.max)
+
+        while len(self.levels) < len(other.levels):
+            self.levels.append(np.empty(0))
+            self.compactions.append(0)
+        for level, items in enumerate(other.levels):
+            self.levels[level] = np.concatenate((self.levels[level], items))
+            self.compactions[level] += other.compactions[level]
+
+        self._compress()
+        return self
+
+    def _weighted(self):
+        """
+        Retained items in ascending order and their cumulative weights.
+        """
+        items = np.concatenate(self.levels)
+        weights = np.concatenate([
+            np.full(level.size, 2 ** h, dtype=np.int64)
+            for h, level in enumerate(self.levels)
+        ])
+        order = np.argsort(items, kind="stable")
+        return items[order], np.cumsum(weights[order])
+
+    def quantile(self, q):
+        """
+        Approximate q-quantile (the exact min and max at q = 0 and 1).
+        """
+        return self.quantiles([q])[0]
+
+    def quantiles(self, qs):
+        qs = np.asarray(qs, dtype=np.float64)
+        if not self.n:
+            raise ValueError("Empty sketch")
+        if not any(level.size for level in self.levels[1:]):
+            # Nothing compacted yet: the sketch holds every value, exactly
+            return [float(v) for v in np.percentile(self.levels[0], qs * 100)]
+        items, cumulative = self._weighted()
+
+        results = []
+        for q in qs:
+            if q <= 0:
+                results.append(self.min)
+            elif q >= 1:
+                results.append(self.max)
+            else:
+                index = int(np.searchsorted(cumulative, q * self.n))
+                results.append(float(items[min(index, items.size - 1)]))
+        return results
+
+    def rank(self, value):
+        """
+        Approximate number of values <= value.
+        """
+        if not self.n:
+            return 0
+        items, cumulative = self._weighted()
+        index = int(np.searchsorted(items, value, side="right"))
+        return int(cumulative[index - 1]) if index else 0
+
+    def items(self):
+        """
+        The retained items, ascending: each is one of the values added.
+        """
+        return self._weighted()[0]
+
+    def to_bytes(self):
+        """
+        Packs the sketch as little-endian float64s: k, n, min and max (NaN
+        while empty), the number of levels, the compaction count and size
+        of each level, then the items of every level.
+        """
+        header = [
+            self.k,
+            self.n,
+            np.nan if self.min is None else self.min,
+            np.nan if self.max is None else self.max,
+            len(self.levels),
+            *self.compactions,
+            *(level.size for level in self.levels),
+        ]
+        return np.concatenate(
+            (np.asarray(header, dtype="<f8"), *self.levels)
+        ).astype("<f8").tobytes()
+
+    @classmethod
+    def from_bytes(cls, data):
+        values = np.frombuffer(data, dtype="<f8")
+        k, n, low, high, depth = values[:5]
+        depth = int(depth)
+        sketch = cls(int(k))
+        sketch.n = int(n)
+        sketch.min = None if np.isnan(low) else float(low)
+        sketch.max = None if np.isnan(high) else float(high)
+        sketch.compactions = [int(c) for c in values[5:5 + depth]]
+
+        sizes = values[5 + depth:5 + 2 * depth].astype(np.int64)
+        bounds = 5 + 2 * depth + np.concatenate(([0], np.cumsum(sizes)))
+        sketch.levels = [
+            values[start:end].astype(np.float64)
+            for start, end in zip(bounds[:-1], bounds[1:])
+        ]
+        return sketch
+
+
+def merge_all(sketches, k=DEFAULT_K):
+    """
+    One sketch of the union of the given sketches' values.
+    """
+    merged = KLLSketch(k)
+    for sketch in sketches:
+        merged.merge(sketch)
+    return merged
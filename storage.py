@@ -0,0 +1,711 @@
+"""
+Where the cell count database lives: a SQLite file (the default) or a
+PostgreSQL database, chosen by CELL_COUNTS_DATABASE (or --database):
+
+    CELL_COUNTS_DATABASE=cell_counts.db                       # SQLite
+    CELL_COUNTS_DATABASE=postgresql://user@host/cell_counts   # PostgreSQL
+
+Both backends hand out DB-API connections that accept the qmark ("?")
+SQL used throughout the repo, so queries.py and the analysis code run
+unchanged on either. On PostgreSQL (psycopg 3, an optional dependency)
+CSV files are bulk loaded with COPY and merged into the normalized tables
+with set-based upserts, streaming reads go through server-side cursors,
+and any number of processes can ingest and read concurrently.
+"""
+import importlib.util
+import os
+import re
+import sqlite3
+from urllib.parse import quote
+
+import pandas as pd
+
+from instrumentation import staged
+
+DATABASE_ENV_VAR = "CELL_COUNTS_DATABASE"
+DB_FILE = "cell_counts.db"
+
+# Rows per fetch when streaming query results
+STREAM_CHUNK_SIZE = 10_000
+
+
+def database_url(default=DB_FILE):
+    return os.environ.get(DATABASE_ENV_VAR) or default
+
+
+def open_storage(url=None):
+    """
+    The storage backend for a database URL or SQLite file path (default:
+    database_url()).
+    """
+    url = url or database_url()
+    if url.startswith(("postgresql://", "postgres://")):
+        return PostgresStorage(url)
+    if url.startswith("sqlite:///"):
+        url = url[len("sqlite:///"):]
+    return SQLiteStorage(url)
+
+
+def stream(conn, sql, params=(), chunk_size=STREAM_CHUNK_SIZE):
+    """
+    Yields the rows of a query in lists of up to chunk_size rows, without
+    holding the whole result in memory on either side.
+    """
+    if isinstance(conn, PostgresConnection):
+        yield from conn.stream(sql, params, chunk_size)
+        return
+
+    cursor = conn.execute(sql, params)
+    for rows in iter(lambda: cursor.fetchmany(chunk_size), []):
+        yield rows
+
+
+def table_exists(conn, name):
+    if isinstance(conn, PostgresConnection):
+        sql = "SELECT to_regclass(?) IS NOT NULL"
+    else:
+        sql = "SELECT COUNT(*) > 0 FROM sqlite_master WHERE name = ?"
+    return bool(conn.execute(sql, (name,)).fetchone()[0])
+
+
+def column_type(conn, table, column):
+    """
+    Declared type of a column, lower-cased, or None if there is no such
+    column.
+    """
+    if isinstance(conn, PostgresConnection):
+        sql = """
+            SELECT data_type FROM information_schema.columns
+            WHERE table_name = ? AND column_name = ?
+        """
+    else:
+        sql = "SELECT type FROM pragma_table_info(?) WHERE name = ?"
+    row = conn.execute(sql, (table, column)).fetchone()
+    return row[0].lower() if row else None
+
+
+def read_frame(conn, sql, params=()):
+    """
+    pd.read_sql_query for either backend.
+    """
+    if isinstance(conn, sqlite3.Connection):
+        return pd.read_sql_query(sql, conn, params=params)
+
+    cursor = conn.execute(sql, params)
+    return pd.DataFrame.from_records(
+        cursor.fetchall(),
+        columns=[column[0] for column in cursor.description],
+        coerce_float=True
+    )
+
+
+# -------------------------
+# SQLite
+# -------------------------
+
+class SQLiteStorage:
+    kind = "sqlite"
+
+    def __init__(self, path=DB_FILE):
+        self.path = path
+
+    def __repr__(self):
+        return f"SQLiteStorage({self.path!r})"
+
+    def connect(self, timeout=30):
+        return sqlite3.connect(self.path, timeout=timeout)
+
+    def connect_reader(self):
+        """
+        A read-only connection usable from any thread. In WAL mode (which
+        database_setup leaves the database in) readers never block, nor
+        are blocked by, an ingest.
+        """
+        path = quote(os.path.abspath(self.path))
+        return sqlite3.connect(
+            f"file:{path}?mode=ro", uri=True, check_same_thread=False
+        )
+
+    def ingest(self, conn, csv_files, append=False, workers=1, engine="sql"):
+        from database_setup import ingest
+        return ingest(conn, csv_files, append, workers, engine)
+
+
+# -------------------------
+# PostgreSQL
+# -------------------------
+
+def _import_psycopg():
+    try:
+        import psycopg
+    except ImportError as error:
+        raise ImportError(
+            "PostgreSQL storage needs psycopg 3 (pip install 'psycopg[binary]')"
+        ) from error
+    return psycopg
+
+
+def _postgres_errors():
+    if importlib.util.find_spec("psycopg") is None:
+        return ()
+    psycopg = _import_psycopg()
+    # Missing tables, read-only transactions, lock timeouts
+    return (psycopg.ProgrammingError, psycopg.InternalError,
+            psycopg.OperationalError)
+
+
+# What a statement raises on either backend when the database cannot run
+# it in its current state, for code that falls back instead (see
+# reset_after_error)
+DATABASE_ERRORS = (sqlite3.OperationalError,) + _postgres_errors()
+
+
+def reset_after_error(conn):
+    """
+    Makes conn usable again after one of DATABASE_ERRORS. A failed
+    statement aborts the whole transaction on PostgreSQL; on SQLite it
+    does not, and nothing is rolled back.
+    """
+    if isinstance(conn, PostgresConnection):
+        conn.rollback()
+
+
+# Quoted string literals and identifiers, whose "?" are not placeholders
+# (a doubled quote inside one splits it in two, which is still quoted)
+QUOTED_SQL = re.compile(r"""('[^']*'|"[^"]*")""")
+
+
+def _format_sql(sql, params):
+    """
+    qmark SQL and parameters -> psycopg's format style. Without
+    parameters the SQL is sent as is (psycopg then ignores "%").
+    """
+    if not params:
+        return sql, None
+    # Odd parts are quoted; psycopg reads "%" everywhere, "?" only outside
+    parts = QUOTED_SQL.split(sql.replace("%", "%%"))
+    sql = "".join(
+        part if quoted % 2 else part.replace("?", "%s")
+        for quoted, part in enumerate(parts)
+    )
+    return sql, list(params)
+
+
+class _PostgresCursor:
+    def __init__(self, cursor):
+        self._cursor = cursor
+
+    def execute(self, sql, params=()):
+        self._cursor.execute(*_format_sql(sql, params))
+        return self
+
+    def executemany(self, sql, seq_of_params):
+        seq_of_params = [list(params) for params in seq_of_params]
+        if seq_of_params:
+            self._cursor.executemany(
+                _format_sql(sql, seq_of_params[0])[0], seq_of_params
+            )
+        return self
+
+    def __iter__(self):
+        return iter(self._cursor)
+
+    def __getattr__(self, name):
+        return getattr(self._cursor, name)
+
+
+class PostgresConnection:
+    """
+    A psycopg connection behaving like a sqlite3 one for the code in this
+    repo: qmark parameters, execute() on the connection, and a context
+    manager that commits (or rolls back) and closes.
+    """
+
+    def __init__(self, raw):
+        self.raw = raw
+
+    def cursor(self):
+        return _PostgresCursor(self.raw.cursor())
+
+    def execute(self, sql, params=()):
+        return self.cursor().execute(sql, params)
+
+    def executemany(self, sql, seq_of_params):
+        return self.cursor().executemany(sql, seq_of_params)
+
+    def commit(self):
+        self.raw.commit()
+
+    def rollback(self):
+        self.raw.rollback()
+
+    def close(self):
+        self.raw.close()
+
+    def stream(self, sql, params=(), chunk_size=STREAM_CHUNK_SIZE):
+        """
+        Server-side (named) cursor: the server holds the result and hands
+        it out chunk_size rows at a time.
+        """
+        with self.raw.transaction(), self.raw.cursor(
+            name=f"stream_{id(self):x}"
+        ) as cursor:
+            cursor.itersize = chunk_size
+            cursor.execute(*_format_sql(sql, params))
+            for rows in iter(lambda: cursor.fetchmany(chunk_size), []):
+                yield rows
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, traceback):
+        try:
+            if exc_type is None:
+                self.raw.commit()
+            else:
+                self.raw.rollback()
+        finally:
+            self.raw.close()
+        return False
+
+
+# Types follow the SQLite schema (REAL -> DOUBLE PRECISION, INTEGER
+# PRIMARY KEY -> identity). data_generation and analysis_cache survive
+# rebuilds, as in SQLite. instr() is defined for queries.table_filter_where.
+POSTGRES_SCHEMA = """
+CREATE TABLE IF NOT EXISTS projects (
+    id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS subjects (
+    id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    project_id BIGINT NOT NULL REFERENCES projects(id),
+    subject_code TEXT NOT NULL,
+    condition TEXT,
+    age INTEGER,
+    sex TEXT,
+    UNIQUE (project_id, subject_code)
+);
+
+CREATE TABLE IF NOT EXISTS treatments (
+    id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS samples (
+    id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    subject_id BIGINT NOT NULL REFERENCES subjects(id),
+    treatment_id BIGINT REFERENCES treatments(id),
+    response TEXT,
+    sample_code TEXT UNIQUE,
+    sample_type TEXT,
+    time_from_treatment_start DOUBLE PRECISION
+);
+CREATE INDEX IF NOT EXISTS idx_samples_subject_id ON samples(subject_id);
+
+CREATE TABLE IF NOT EXISTS cell_counts (
+    sample_id BIGINT PRIMARY KEY REFERENCES samples(id),
+    b_cell DOUBLE PRECISION,
+    cd8_t_cell DOUBLE PRECISION,
+    cd4_t_cell DOUBLE PRECISION,
+    nk_cell DOUBLE PRECISION,
+    monocyte DOUBLE PRECISION
+);
+
+CREATE TABLE IF NOT EXISTS populations (
+    id INTEGER GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    name TEXT UNIQUE NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS population_frequencies (
+    sample_id BIGINT NOT NULL,
+    population_id INTEGER NOT NULL,
+    percentage DOUBLE PRECISION,
+    PRIMARY KEY (sample_id, population_id)
+);
+
+CREATE TABLE IF NOT EXISTS cell_counts_csv (
+    sample_id BIGINT PRIMARY KEY,
+    project TEXT,
+    subject TEXT,
+    condition TEXT,
+    age INTEGER,
+    sex TEXT,
+    treatment TEXT,
+    response TEXT,
+    sample TEXT,
+    sample_type TEXT,
+    time_from_treatment_start DOUBLE PRECISION,
+    b_cell DOUBLE PRECISION,
+    cd8_t_cell DOUBLE PRECISION,
+    cd4_t_cell DOUBLE PRECISION,
+    nk_cell DOUBLE PRECISION,
+    monocyte DOUBLE PRECISION
+);
+
+CREATE TABLE IF NOT EXISTS load_manifest (
+    id BIGINT GENERATED BY DEFAULT AS IDENTITY PRIMARY KEY,
+    file_name TEXT NOT NULL,
+    file_hash TEXT UNIQUE NOT NULL,
+    row_count INTEGER,
+    loaded_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE TABLE IF NOT EXISTS data_generation (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    generation BIGINT NOT NULL
+);
+
+CREATE TABLE IF NOT EXISTS analysis_cache (
+    kind TEXT NOT NULL,
+    cohort_key TEXT NOT NULL,
+    generation BIGINT NOT NULL,
+    result TEXT NOT NULL,
+    created_at TIMESTAMPTZ DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (kind, cohort_key)
+);
+
+CREATE TABLE IF NOT EXISTS cohort_summaries (
+    project TEXT,
+    treatment TEXT,
+    condition TEXT,
+    sample_type TEXT,
+    time_from_treatment_start DOUBLE PRECISION,
+    response TEXT,
+    sex TEXT,
+    population_id INTEGER NOT NULL,
+    n INTEGER NOT NULL,
+    percentage_sum DOUBLE PRECISION,
+    percentage_sum_squares DOUBLE PRECISION,
+    percentage_min DOUBLE PRECISION,
+    percentage_max DOUBLE PRECISION,
+    count_n INTEGER NOT NULL,
+    count_sum DOUBLE PRECISION,
+    sketch BYTEA NOT NULL
+);
+
+CREATE UNIQUE INDEX IF NOT EXISTS idx_cohort_summaries_group
+ON cohort_summaries (
+    condition, treatment, sample_type, time_from_treatment_start,
+    project, response, sex, population_id
+);
+
+CREATE OR REPLACE FUNCTION instr(text, text) RETURNS INTEGER
+    AS 'SELECT strpos($1, $2)' LANGUAGE SQL IMMUTABLE;
+"""
+
+POSTGRES_DROP = """
+DROP TABLE IF EXISTS cohort_summaries, cell_counts_csv,
+    population_frequencies, populations, cell_counts, samples, subjects,
+    treatments, projects, load_manifest
+    CASCADE
+"""
+
+# One row per CSV line; `line` keeps file order for first/last-wins rules
+POSTGRES_STAGING = """
+CREATE TEMP TABLE IF NOT EXISTS csv_staging (
+    line BIGINT GENERATED ALWAYS AS IDENTITY,
+    project TEXT,
+    subject TEXT,
+    condition TEXT,
+    age INTEGER,
+    sex TEXT,
+    treatment TEXT,
+    response TEXT,
+    sample TEXT,
+    sample_type TEXT,
+    time_from_treatment_start DOUBLE PRECISION,
+    b_cell DOUBLE PRECISION,
+    cd8_t_cell DOUBLE PRECISION,
+    cd4_t_cell DOUBLE PRECISION,
+    nk_cell DOUBLE PRECISION,
+    monocyte DOUBLE PRECISION
+) ON COMMIT DROP;
+
+CREATE TEMP TABLE IF NOT EXISTS affected_samples (
+    sample_id BIGINT PRIMARY KEY
+) ON COMMIT DROP;
+"""
+
+# Empty text fields stay empty strings, as in the SQLite loader
+POSTGRES_TEXT_COLUMNS = (
+    "project", "subject", "condition", "sex", "treatment", "response",
+    "sample", "sample_type",
+)
+
+# Staged rows -> normalized tables, run once per file. A subject takes its
+# first row in the file, so a later file updates it, as in the SQLite
+# loader; a sample re-sent in the file or already stored takes its last
+# row.
+POSTGRES_MERGE = """
+INSERT INTO projects (name)
+SELECT DISTINCT project FROM csv_staging
+ON CONFLICT (name) DO NOTHING;
+
+INSERT INTO treatments (name)
+SELECT DISTINCT treatment FROM csv_staging
+ON CONFLICT (name) DO NOTHING;
+
+INSERT INTO subjects (project_id, subject_code, condition, age, sex)
+SELECT DISTINCT ON (p.id, st.subject)
+    p.id, st.subject, st.condition, st.age, st.sex
+FROM csv_staging st
+JOIN projects p ON p.name = st.project
+ORDER BY p.id, st.subject, st.line
+ON CONFLICT (project_id, subject_code) DO UPDATE SET
+    condition = excluded.condition,
+    age = excluded.age,
+    sex = excluded.sex;
+
+INSERT INTO samples
+(subject_id, treatment_id, response, sample_code, sample_type,
+ time_from_treatment_start)
+SELECT subject_id, treatment_id, response, sample, sample_type,
+       time_from_treatment_start
+FROM (
+    SELECT DISTINCT ON (st.sample)
+        st.line, sub.id AS subject_id, t.id AS treatment_id, st.response,
+        st.sample, st.sample_type, st.time_from_treatment_start
+    FROM csv_staging st
+    JOIN projects p ON p.name = st.project
+    JOIN subjects sub
+      ON sub.project_id = p.id AND sub.subject_code = st.subject
+    LEFT JOIN treatments t ON t.name = st.treatment
+    ORDER BY st.sample, st.line DESC
+) latest
+ORDER BY line
+ON CONFLICT (sample_code) DO UPDATE SET
+    subject_id = excluded.subject_id,
+    treatment_id = excluded.treatment_id,
+    response = excluded.response,
+    sample_type = excluded.sample_type,
+    time_from_treatment_start = excluded.time_from_treatment_start;
+
+INSERT INTO cell_counts
+(sample_id, b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte)
+SELECT DISTINCT ON (st.sample)
+    s.id, st.b_cell, st.cd8_t_cell, st.cd4_t_cell, st.nk_cell, st.monocyte
+FROM csv_staging st
+JOIN samples s ON s.sample_code = st.sample
+ORDER BY st.sample, st.line DESC
+ON CONFLICT (sample_id) DO UPDATE SET
+    b_cell = excluded.b_cell,
+    cd8_t_cell = excluded.cd8_t_cell,
+    cd4_t_cell = excluded.cd4_t_cell,
+    nk_cell = excluded.nk_cell,
+    monocyte = excluded.monocyte;
+
+-- Every sample of a loaded subject: demographics are denormalized into
+-- cell_counts_csv
+INSERT INTO affected_samples (sample_id)
+SELECT s.id
+FROM samples s
+JOIN subjects sub ON sub.id = s.subject_id
+JOIN projects p ON p.id = sub.project_id
+WHERE (p.name, sub.subject_code) IN (
+    SELECT project, subject FROM csv_staging
+)
+ON CONFLICT (sample_id) DO NOTHING;
+
+TRUNCATE csv_staging;
+"""
+
+class PostgresStorage:
+    kind = "postgresql"
+
+    def __init__(self, url):
+        self.url = url
+
+    def __repr__(self):
+        return f"PostgresStorage({self.url!r})"
+
+    def connect(self, timeout=30):
+        psycopg = _import_psycopg()
+        return PostgresConnection(
+            psycopg.connect(self.url, connect_timeout=timeout)
+        )
+
+    def connect_reader(self):
+        """
+        An autocommit connection, so every query sees the latest
+        committed ingest (MVCC: readers and writers never block).
+        """
+        psycopg = _import_psycopg()
+        return PostgresConnection(psycopg.connect(self.url, autocommit=True))
+
+    def _copy_csv(self, raw, csv_file):
+        """
+        COPYs a CSV export into csv_staging; returns the number of rows.
+        """
+        from database_setup import CSV_COLUMNS
+
+        with open(csv_file, newline="") as f:
+            header = f.readline().strip().split(",")
+            unknown = set(header) - set(CSV_COLUMNS)
+            if unknown:
+                raise ValueError(
+                    f"{csv_file}: unexpected columns {', '.join(sorted(unknown))}"
+                )
+            text_columns = [c for c in header if c in POSTGRES_TEXT_COLUMNS]
+
+            with raw.cursor() as cursor:
+                with cursor.copy(
+                    f"COPY csv_staging ({', '.join(header)}) FROM STDIN "
+                    "WITH (FORMAT csv"
+                    + (f", FORCE_NOT_NULL ({', '.join(text_columns)})"
+                       if text_columns else "")
+                    + ")"
+                ) as copy:
+                    for block in iter(lambda: f.read(1 << 20), ""):
+                        copy.write(block)
+                return cursor.rowcount
+
+    def _refresh_derived_tables(self, conn, full):
+        from database_setup import (
+            CSV_COLUMNS,
+            INDEXES,
+            WIDE_SELECT,
+            frequencies_select,
+        )
+        from summaries import (
+            affected_groups,
+            build_summaries,
+            has_sketches,
+            refresh_summaries,
+        )
+
+        raw = conn.raw
+
+        populations = list(CSV_COLUMNS[10:])
+        raw.execute(
+            "INSERT INTO populations (name) SELECT unnest(%s::text[]) "
+            "ON CONFLICT (name) DO NOTHING",
+            [populations]
+        )
+        population_ids = dict(raw.execute("SELECT name, id FROM populations"))
+
+        if full:
+            raw.execute("TRUNCATE cell_counts_csv, population_frequencies")
+            wide_where = frequency_where = ""
+        else:
+            # Summaries from before they carried (binary) quantile
+            # sketches are rebuilt
+            if not has_sketches(conn):
+                raw.execute("DROP TABLE IF EXISTS cohort_summaries")
+
+            groups = affected_groups(conn)
+            raw.execute("""
+                DELETE FROM cell_counts_csv
+                WHERE sample_id IN (SELECT sample_id FROM affected_samples)
+            """)
+            raw.execute("""
+                DELETE FROM population_frequencies
+                WHERE sample_id IN (SELECT sample_id FROM affected_samples)
+            """)
+            wide_where = (
+                "WHERE s.id IN (SELECT sample_id FROM affected_samples)"
+            )
+            frequency_where = (
+                "WHERE sample_id IN (SELECT sample_id FROM affected_samples)"
+            )
+
+        raw.execute(
+            "INSERT INTO cell_counts_csv " + WIDE_SELECT.format(where=wide_where)
+        )
+        raw.execute(
+            "INSERT INTO population_frequencies "
+            + frequencies_select(population_ids, frequency_where)
+        )
+
+        if full:
+            build_summaries(conn)
+        else:
+            refresh_summaries(conn, groups | affected_groups(conn))
+
+        count_by_name = " ".join(
+            f"WHEN '{population}' THEN c.{population}"
+            for population in populations
+        )
+        raw.execute(f"""
+            CREATE OR REPLACE VIEW cell_population_frequencies AS
+            SELECT
+                s.sample_code AS sample,
+                ({" + ".join("c." + p for p in populations)}) AS total_count,
+                p.name AS population,
+                CASE p.name {count_by_name} END AS count,
+                f.percentage,
+                f.sample_id,
+                f.population_id
+            FROM population_frequencies f
+            JOIN samples s ON s.id = f.sample_id
+            JOIN cell_counts c ON c.sample_id = f.sample_id
+            JOIN populations p ON p.id = f.population_id
+        """)
+
+        for name, definition in INDEXES.items():
+            raw.execute(f"CREATE INDEX IF NOT EXISTS {name} ON {definition}")
+
+    @staged("storage.postgres_ingest", rows=int)
+    def ingest(self, conn, csv_files, append=False, workers=1, engine="sql"):
+        """
+        database_setup.ingest for PostgreSQL, in one transaction: each new
+        file is COPYed into a staging table and merged with set-based
+        upserts, then the derived tables and cohort summaries are rebuilt
+        (or, when appending, refreshed for the affected samples only).
+
+        Parsing and frequency computation happen in the server, so
+        workers and engine are accepted for the same signature but not
+        used. Returns the number of files loaded.
+        """
+        from database_setup import file_hash
+
+        raw = conn.raw
+        if not append:
+            raw.execute(POSTGRES_DROP)
+        raw.execute(POSTGRES_SCHEMA)
+        raw.execute(POSTGRES_STAGING)
+
+        loaded = []
+        seen = set()
+        for csv_file in csv_files:
+            digest = file_hash(csv_file)
+            already_loaded = digest in seen or raw.execute(
+                "SELECT 1 FROM load_manifest WHERE file_hash = %s", [digest]
+            ).fetchone()
+            if already_loaded:
+                print(f"Skipping {csv_file} (already loaded)")
+                continue
+            seen.add(digest)
+
+            row_count = self._copy_csv(raw, csv_file)
+            raw.execute(POSTGRES_MERGE)
+            print(f"Loaded {row_count} rows from {csv_file}")
+            loaded.append((csv_file, digest, row_count))
+
+        if loaded or not append:
+            self._refresh_derived_tables(conn, full=not append)
+
+            for csv_file, digest, row_count in loaded:
+                raw.execute(
+                    "INSERT INTO load_manifest (file_name, file_hash, row_count) "
+                    "VALUES (%s, %s, %s)",
+                    [os.path.basename(csv_file), digest, row_count]
+                )
+
+            generation = raw.execute("""
+                INSERT INTO data_generation (id, generation) VALUES (1, 1)
+                ON CONFLICT (id) DO UPDATE
+                SET generation = data_generation.generation + 1
+                RETURNING generation
+            """).fetchone()[0]
+            raw.execute(
+                "DELETE FROM analysis_cache WHERE generation < %s",
+                [generation]
+            )
+
+        conn.commit()
+        raw.execute("ANALYZE")
+        conn.commit()
+
+        return len(loaded)
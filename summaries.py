@@ -0,0 +1,387 @@
+"""
+Pre-aggregated cohort statistics, maintained by database_setup.
+
+cohort_summaries holds one row per (project, treatment, condition,
+sample_type, timepoint, response, sex, population) with the count, sum,
+sum of squares, minimum and maximum of the relative frequencies, the
+count and sum of the raw cell counts, and a KLL quantile sketch of the
+frequencies (sketches.py). All of these merge, so any cohort filter over
+those columns is answered by merging a few rows per group instead of
+reading every sample: counts, means and variances exactly, quartiles and
+box plot whiskers to within the sketch's rank error, in memory and time
+that do not grow with the number of samples.
+
+A full build aggregates everything in one grouped query plus one pass
+over the frequencies for the sketches; an append only recomputes the
+groups its samples left or joined.
+"""
+from collections import defaultdict
+
+import numpy as np
+
+from instrumentation import staged
+from queries import cohort_where
+from sketches import KLLSketch, merge_all
+from storage import column_type, stream
+
+# Group columns, named as in cell_counts_csv (so queries.cohort_where
+# filters apply unchanged)
+SUMMARY_COLUMNS = (
+    "project", "treatment", "condition", "sample_type",
+    "time_from_treatment_start", "response", "sex",
+)
+
+# Created here for SQLite; storage.POSTGRES_SCHEMA has the PostgreSQL one
+SUMMARY_SCHEMA = """
+    CREATE TABLE IF NOT EXISTS cohort_summaries (
+        project TEXT,
+        treatment TEXT,
+        condition TEXT,
+        sample_type TEXT,
+        time_from_treatment_start REAL,
+        response TEXT,
+        sex TEXT,
+        population_id INTEGER NOT NULL,
+        n INTEGER NOT NULL,
+        percentage_sum REAL,
+        percentage_sum_squares REAL,
+        percentage_min REAL,
+        percentage_max REAL,
+        count_n INTEGER NOT NULL,
+        count_sum REAL,
+        sketch BLOB NOT NULL
+    )
+"""
+
+# One row per group and population. Columns in the order of
+# idx_cell_counts_csv_cohort, so cohort filters and the per-group deletes
+# of refresh_summaries search it instead of scanning the table
+SUMMARY_INDEX = """
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_cohort_summaries_group
+    ON cohort_summaries (
+        condition, treatment, sample_type, time_from_treatment_start,
+        project, response, sex, population_id
+    )
+"""
+
+
+# -------------------------
+# Maintenance
+# -------------------------
+
+def _population_count(conn):
+    """
+    SQL for the cell count of a population_frequencies row (aliases c, p).
+    """
+    return "CASE p.name " + " ".join(
+        f"WHEN '{population}' THEN c.{population}"
+        for (population,) in conn.execute("SELECT name FROM populations")
+    ) + " END"
+
+
+def summary_select(conn, where=""):
+    """
+    Per-(group, population) aggregates of the frequencies and cell
+    counts; `where` restricts the cell_counts_csv rows (alias c).
+    """
+    count = _population_count(conn)
+    columns = ", ".join("c." + column for column in SUMMARY_COLUMNS)
+
+    return f"""
+    SELECT
+        {columns},
+        f.population_id,
+        COUNT(f.percentage),
+        SUM(f.percentage),
+        SUM(f.percentage * f.percentage),
+        MIN(f.percentage),
+        MAX(f.percentage),
+        COUNT({count}),
+        SUM({count})
+    FROM cell_counts_csv c
+    JOIN population_frequencies f ON f.sample_id = c.sample_id
+    JOIN populations p ON p.id = f.population_id
+    {where}
+    GROUP BY {columns}, f.population_id
+    """
+
+
+def frequencies_select(where=""):
+    """
+    (group..., population_id, percentage) rows for building the sketches.
+    """
+    columns = ", ".join("c." + column for column in SUMMARY_COLUMNS)
+    return f"""
+    SELECT {columns}, f.population_id, f.percentage
+    FROM cell_counts_csv c
+    JOIN population_frequencies f ON f.sample_id = c.sample_id
+    {where}
+    """
+
+
+def _sketches(chunks):
+    """
+    {(group..., population_id): KLLSketch} of frequencies_select rows,
+    fed a chunk at a time.
+    """
+    sketches = defaultdict(KLLSketch)
+    for chunk in chunks:
+        values = defaultdict(list)
+        for *key, percentage in chunk:
+            values[tuple(key)].append(percentage)
+        for key, group in values.items():
+            sketches[key].update(np.array(group, dtype=np.float64))
+    return sketches
+
+
+def _insert(conn, where="", params=()):
+    """
+    Computes and inserts the summary rows of the cell_counts_csv rows
+    matching `where`. Returns the number of rows inserted.
+    """
+    sketches = _sketches(stream(conn, frequencies_select(where), params))
+    rows = [
+        tuple(row) + (sketches[tuple(row[:len(SUMMARY_COLUMNS) + 1])].to_bytes(),)
+        for row in conn.execute(summary_select(conn, where), params)
+    ]
+    conn.executemany(
+        f"""
+        INSERT INTO cohort_summaries (
+            {", ".join(SUMMARY_COLUMNS)}, population_id, n, percentage_sum,
+            percentage_sum_squares, percentage_min, percentage_max,
+            count_n, count_sum, sketch
+        )
+        VALUES ({", ".join("?" * (len(SUMMARY_COLUMNS) + 9))})
+        """,
+        rows
+    )
+    return len(rows)
+
+
+@staged("summaries.build_summaries", rows=int)
+def build_summaries(conn):
+    """
+    Recomputes cohort_summaries from the derived tables. Returns the
+    number of summary rows.
+    """
+    conn.execute(SUMMARY_SCHEMA)
+    conn.execute(SUMMARY_INDEX)
+    conn.execute("DELETE FROM cohort_summaries")
+    rows = _insert(conn)
+    # Planner statistics, so partial cohort filters skip-scan the index
+    conn.execute("ANALYZE cohort_summaries")
+    return rows
+
+
+def _group_where(alias, group):
+    conditions = []
+    params = []
+    for column, value in zip(SUMMARY_COLUMNS, group):
+        name = f"{alias}.{column}" if alias else column
+        if value is None:
+            conditions.append(f"{name} IS NULL")
+        else:
+            conditions.append(f"{name} = ?")
+            params.append(value)
+    return "WHERE " + " AND ".join(conditions), params
+
+
+def group_delete_query(group):
+    """
+    DELETE of the summary rows of one group (a SUMMARY_COLUMNS tuple).
+    """
+    where, params = _group_where("", group)
+    return f"DELETE FROM cohort_summaries {where}", params
+
+
+def affected_groups(conn):
+    """
+    Summary groups of the samples in affected_samples, as stored in
+    cell_counts_csv right now: call before and after refreshing those
+    samples to get the groups they leave and join.
+    """
+    return set(conn.execute(f"""
+        SELECT DISTINCT {", ".join(SUMMARY_COLUMNS)}
+        FROM cell_counts_csv
+        WHERE sample_id IN (SELECT sample_id FROM affected_samples)
+    """))
+
+
+@staged("summaries.refresh_summaries", rows=int)
+def refresh_summaries(conn, groups):
+    """
+    Recomputes the summary rows of the given groups only (everything if
+    the table is missing or empty). Returns the number of summary rows
+    written.
+    """
+    if not available(conn):
+        return build_summaries(conn)
+    conn.execute(SUMMARY_INDEX)
+
+    written = 0
+    for group in sorted(groups, key=repr):
+        conn.execute(*group_delete_query(group))
+
+        written += _insert(conn, *_group_where("c", group))
+    return written
+
+
+def has_sketches(conn):
+    """
+    Whether cohort_summaries exists with sketches in the current (packed
+    binary) format. Older databases stored none, or stored them as JSON.
+    """
+    return column_type(conn, "cohort_summaries", "sketch") in ("blob", "bytea")
+
+
+def available(conn):
+    """
+    Whether the database has (non-empty) cohort summaries with sketches.
+    """
+    return has_sketches(conn) and conn.execute(
+        "SELECT 1 FROM cohort_summaries LIMIT 1"
+    ).fetchone() is not None
+
+
+# -------------------------
+# Queries
+# -------------------------
+
+def merged_summaries_query(**filters):
+    """
+    The summary rows of a cohort (see queries.COHORT_COLUMNS), with their
+    population names.
+    """
+    where, params = cohort_where("s", **filters)
+    sql = f"""
+    SELECT
+        p.name, s.response, s.n, s.percentage_sum,
+        s.percentage_sum_squares, s.count_n, s.count_sum, s.sketch
+    FROM cohort_summaries s
+    JOIN populations p ON p.id = s.population_id
+    {where}
+    """
+    return sql, params
+
+
+def merged_summaries(conn, **filters):
+    """
+    The summary rows of a cohort (see queries.COHORT_COLUMNS) merged per
+    (population, response).
+
+    Returns:
+        {(population, response): {
+            "n", "mean", "variance", "min", "max",
+            "count_n", "count_sum": non-null cell counts and their sum,
+            "sketch": KLLSketch of the frequencies
+        }}
+    """
+    merged = defaultdict(lambda: {
+        "n": 0, "sum": 0.0, "squares": 0.0, "count_n": 0, "count_sum": 0.0,
+        "sketches": [],
+    })
+
+    for (population, response, n, total, squares, count_n, count_sum,
+         sketch) in conn.execute(*merged_summaries_query(**filters)):
+        group = merged[(population, response)]
+        group["count_n"] += count_n
+        group["count_sum"] += count_sum or 0.0
+        if n:
+            group["n"] += n
+            group["sum"] += total
+            group["squares"] += squares
+            group["sketches"].append(KLLSketch.from_bytes(sketch))
+
+    for group in merged.values():
+        n = group["n"]
+        total = group.pop("sum")
+        squares = group.pop("squares")
+        group["sketch"] = sketch = merge_all(group.pop("sketches"))
+        group["min"], group["max"] = sketch.min, sketch.max
+        group["mean"] = total / n if n else None
+        group["variance"] = (
+            max(squares - total * total / n, 0.0) / (n - 1) if n > 1 else None
+        )
+
+    return dict(sorted(merged.items()))
+
+
+def sketch_box_statistics(sketch):
+    """
+    Tukey box plot statistics (as figures.box_statistics) from a sketch:
+    quartiles and the outlier count to within its rank error, whiskers
+    at retained values (exact values while the sketch is uncompacted).
+    Individual outliers are not listed.
+    """
+    q1, median, q3 = sketch.quantiles([0.25, 0.5, 0.75])
+    low, high = q1 - 1.5 * (q3 - q1), q3 + 1.5 * (q3 - q1)
+
+    items = sketch.items()
+    inside = items[(items >= low) & (items <= high)]
+    below = sketch.rank(np.nextafter(low, -np.inf))
+    above = sketch.n - sketch.rank(high)
+
+    return {
+        "n": sketch.n,
+        "q1": q1,
+        "median": median,
+        "q3": q3,
+        "lowerfence": sketch.min if sketch.min >= low else float(inside[0]),
+        "upperfence": sketch.max if sketch.max <= high else float(inside[-1]),
+        "n_outliers": below + above,
+        "outliers": [],
+        "outlier_samples": [],
+    }
+
+
+def summary_box_statistics(conn, **filters):
+    """
+    figures.response_box_statistics from the summaries: approximate box
+    plot statistics per (population, response) of the cohort's samples
+    with a known response, without individual outliers.
+    """
+    filters.setdefault("response", ("no", "yes"))
+    return [
+        {"population": population, "response": response,
+         **sketch_box_statistics(group["sketch"])}
+        for (population, response), group
+        in merged_summaries(conn, **filters).items()
+        if group["n"]
+    ]
+
+
+def cohort_size_query(**filters):
+    filters.setdefault("response", ("no", "yes"))
+    where, params = cohort_where("s", **filters)
+    sql = f"""
+    SELECT MAX(n) FROM (
+        SELECT SUM(s.n) AS n
+        FROM cohort_summaries s
+        {where}
+        GROUP BY s.population_id
+    ) sizes
+    """
+    return sql, params
+
+
+def cohort_size(conn, **filters):
+    """
+    Number of samples with a known response in a cohort, from the
+    summaries (those of summary_box_statistics' largest box set).
+    """
+    row = conn.execute(*cohort_size_query(**filters)).fetchone()
+    return row[0] or 0
+
+
+def mean_count(conn, population, **filters):
+    """
+    Average cell count of a population over a cohort's samples (None if
+    none has a count), exact.
+    """
+    groups = [
+        group for (name, _), group in merged_summaries(conn, **filters).items()
+        if name == population
+    ]
+    count_n = sum(group["count_n"] for group in groups)
+    count_sum = sum(group["count_sum"] for group in groups)
+    return count_sum / count_n if count_n else None
@@ -0,0 +1,40 @@
+import csv
+import os
+import sys
+
+import pytest
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO_DIR)
+
+CSV_FILE = os.path.join(REPO_DIR, "cell-count.csv")
+
+
+@pytest.fixture(scope="session")
+def csv_rows():
+    """
+    (header, rows) of the shipped cell-count.csv.
+    """
+    with open(CSV_FILE, newline="") as f:
+        reader = csv.reader(f)
+        header = next(reader)
+        return header, list(reader)
+
+
+@pytest.fixture
+def write_csv(tmp_path, csv_rows):
+    """
+    Writes rows (of cell-count.csv, by default) to a CSV file under
+    tmp_path and returns its path.
+    """
+    header, _ = csv_rows
+
+    def write(name, rows):
+        path = tmp_path / name
+        with open(path, "w", newline="") as f:
+            writer = csv.writer(f)
+            writer.writerow(header)
+            writer.writerows(rows)
+        return str(path)
+
+    return write
@@ -0,0 +1,99 @@
+import sqlite3
+
+import numpy as np
+import pytest
+from scipy.stats import false_discovery_control, mannwhitneyu
+
+from batch_stats import (
+    MIN_GROUP_SIZE,
+    STRATA,
+    benjamini_hochberg,
+    fetch_grid_data,
+    grid_tests,
+    mann_whitney_grid,
+)
+from database_setup import ingest
+
+
+def scipy_test(values, responders):
+    yes = values[responders & ~np.isnan(values)]
+    no = values[~responders & ~np.isnan(values)]
+    return mannwhitneyu(yes, no, method="asymptotic")
+
+
+def test_grid_matches_scipy():
+    rng = np.random.default_rng(0)
+    strata, responders, values = [], [], []
+
+    def add(stratum, n, draw):
+        strata.extend([stratum] * n)
+        responders.extend(rng.random(n) < 0.5)
+        values.extend(draw(n))
+
+    add(0, 40, rng.random)
+    # Heavy ties within and across groups
+    add(1, 60, lambda n: rng.integers(0, 4, n).astype(float))
+    # Stratum 2 has no observations at all
+    add(3, 25, lambda n: np.where(rng.random(n) < 0.2, np.nan, rng.random(n)))
+    add(4, 9, lambda n: np.round(rng.normal(size=n), 1))
+
+    strata, responders, values = map(np.array, (strata, responders, values))
+    # Shuffled, so the strata are not already sorted
+    order = rng.permutation(strata.size)
+    result = mann_whitney_grid(
+        strata[order], responders[order], values[order], n_strata=6
+    )
+
+    for stratum in (0, 1, 3, 4):
+        rows = strata == stratum
+        expected = scipy_test(values[rows], responders[rows])
+        assert result["u"][stratum] == pytest.approx(expected.statistic)
+        assert result["p"][stratum] == pytest.approx(expected.pvalue)
+
+    kept = ~np.isnan(values)
+    assert result["n_yes"][3] == (responders & kept & (strata == 3)).sum()
+    for empty in (2, 5):
+        assert result["n_yes"][empty] == result["n_no"][empty] == 0
+        assert np.isnan(result["p"][empty])
+
+
+def test_benjamini_hochberg_matches_scipy():
+    p_values = np.random.default_rng(1).random(50) ** 3
+    p_values[[3, 17]] = np.nan
+    q_values = benjamini_hochberg(p_values)
+
+    tested = ~np.isnan(p_values)
+    np.testing.assert_allclose(
+        q_values[tested], false_discovery_control(p_values[tested])
+    )
+    assert np.isnan(q_values[~tested]).all()
+    assert np.isnan(benjamini_hochberg([np.nan])).all()
+
+
+def test_grid_tests_on_database(tmp_path, csv_rows, write_csv):
+    _, rows = csv_rows
+    with sqlite3.connect(tmp_path / "cell_counts.db") as conn:
+        ingest(conn, [write_csv("cells.csv", rows[:1500])])
+        frame = fetch_grid_data(conn)
+    tests = grid_tests(frame)
+
+    assert len(tests)
+    assert (tests[["n_yes", "n_no"]] >= MIN_GROUP_SIZE).all(axis=None)
+    np.testing.assert_allclose(
+        tests["q"], false_discovery_control(tests["p"])
+    )
+
+    keys = list(STRATA) + ["population"]
+    groups = dict(list(frame.groupby(keys, dropna=False)))
+    for test in tests.itertuples(index=False):
+        group = groups[tuple(getattr(test, key) for key in keys)]
+        expected = scipy_test(
+            group["percentage"].to_numpy(dtype=np.float64),
+            (group["response"] == "yes").to_numpy()
+        )
+        assert (test.n_yes, test.n_no) == (
+            (group["response"] == "yes").sum(),
+            (group["response"] == "no").sum(),
+        )
+        assert test.u == pytest.approx(expected.statistic)
+        assert test.p == pytest.approx(expected.pvalue)
@@ -0,0 +1,71 @@
+import io
+import json
+import sqlite3
+
+import pytest
+
+from cohort_query import compile_query, parse_query, run_query
+from conftest import CSV_FILE
+from database_setup import ingest
+
+# Counts, sums and means of cell counts over cohort columns, which
+# cohort_summaries can answer
+SUMMARY_QUERIES = [
+    ["condition=melanoma", "sex=M", "response=yes", "t=0", "agg=mean(b_cell)"],
+    ["treatment=miraclib", "agg=count(cd4_t_cell),mean(cd4_t_cell)",
+     "by=response,sex"],
+    ["agg=sum(monocyte),count(nk_cell),avg(nk_cell)", "by=project"],
+    ["condition=melanoma,carcinoma", "response!=no", "agg=mean(b_cell)",
+     "by=sample_type,t"],
+    ["sample_type=PBMC", "t>=7", "agg=sum(cd8_t_cell)", "by=treatment",
+     "limit=1"],
+    ["project=nope", "agg=count(b_cell),mean(b_cell)"],
+]
+
+
+@pytest.fixture(scope="module")
+def conn(tmp_path_factory):
+    path = tmp_path_factory.mktemp("cohort") / "cell_counts.db"
+    with sqlite3.connect(path) as conn:
+        ingest(conn, [CSV_FILE])
+
+    conn = sqlite3.connect(path)
+    yield conn
+    conn.close()
+
+
+def query_rows(conn, terms, use_summaries):
+    out = io.StringIO()
+    run_query(conn, terms, out, "json", use_summaries)
+    return json.loads(out.getvalue())
+
+
+@pytest.mark.parametrize("terms", SUMMARY_QUERIES, ids=" ".join)
+def test_summaries_match_table(conn, terms):
+    assert "FROM cohort_summaries" in compile_query(terms)[0]
+    assert "FROM cohort_summaries" not in compile_query(terms, False)[0]
+
+    from_summaries = query_rows(conn, terms, True)
+    from_table = query_rows(conn, terms, False)
+    assert from_summaries
+    assert len(from_summaries) == len(from_table)
+    for summary_row, table_row in zip(from_summaries, from_table):
+        assert summary_row == pytest.approx(table_row)
+
+
+@pytest.mark.parametrize("terms, message", [
+    (["sex"], "Cannot parse query term"),
+    (["bogus=1"], "Unknown column: bogus"),
+    (["age>=old"], "age needs a number"),
+    (["agg=median(b_cell)"], "Unsupported aggregation"),
+    (["agg=count(b_cell"], "Unsupported aggregation"),
+    (["agg=sum()"], r"sum\(\) needs a column"),
+    (["agg=mean(bogus)"], "Unknown column: bogus"),
+    (["agg>count(*)"], "agg takes =, not >"),
+    (["by=sex"], "by= needs at least one agg="),
+    (["by=bogus", "agg=count(*)"], "Unknown column: bogus"),
+    (["limit=ten"], "limit needs an integer"),
+])
+def test_malformed_queries(terms, message):
+    with pytest.raises(ValueError, match=message):
+        parse_query(terms)
@@ -0,0 +1,45 @@
+import sqlite3
+from contextlib import contextmanager
+
+import pytest
+
+from data_provider import DataProvider
+from database_setup import ingest
+
+
+@pytest.fixture
+def dashboard(tmp_path, monkeypatch, csv_rows, write_csv):
+    import dashboard
+
+    _, rows = csv_rows
+    path = str(tmp_path / "cell_counts.db")
+    with sqlite3.connect(path) as conn:
+        ingest(conn, [write_csv("cells.csv", rows[:300])])
+
+    monkeypatch.setattr(dashboard, "provider", DataProvider(path))
+    return dashboard
+
+
+def test_callbacks_hold_one_connection(dashboard, monkeypatch):
+    pool = dashboard.provider.pool
+    connection = pool.connection
+    held = []
+    most_held = []
+
+    @contextmanager
+    def counted_connection():
+        held.append(1)
+        most_held.append(len(held))
+        try:
+            with connection() as conn:
+                yield conn
+        finally:
+            held.pop()
+
+    monkeypatch.setattr(pool, "connection", counted_connection)
+
+    # Every cohort filter unset
+    values = [None] * len(dashboard.COHORT_FILTERS)
+    assert len(dashboard.update_summary_figures(*values, None)) == 4
+    assert dashboard.update_response_boxplot(["b_cell"], *values, None)
+    assert max(most_held) == 1
@@ -0,0 +1,35 @@
+import math
+import sqlite3
+
+from data_analysis import fetch_response_data, mann_whitney_results
+from database_setup import CSV_COLUMNS, ingest
+
+
+def test_blank_count_leaves_other_samples_tested(tmp_path, csv_rows,
+                                                 write_csv):
+    _, rows = csv_rows
+    rows = [list(row) for row in rows[:600]]
+    blank = next(
+        i for i, row in enumerate(rows)
+        if row[CSV_COLUMNS.index("treatment")] == "miraclib"
+        and row[CSV_COLUMNS.index("sample_type")] == "PBMC"
+        and row[CSV_COLUMNS.index("response")] == "yes"
+    )
+    rows[blank][CSV_COLUMNS.index("b_cell")] = ""
+
+    with sqlite3.connect(tmp_path / "cell_counts.db") as conn:
+        ingest(conn, [write_csv("cells.csv", rows)])
+        data = fetch_response_data(conn)
+
+    # The sample's total is NULL, so all its percentages are missing
+    assert all(
+        sum(math.isnan(value) for value in data[population]["yes"]) == 1
+        for population in data
+    )
+
+    results = mann_whitney_results(data)
+    assert set(results) == set(data)
+    for result in results.values():
+        assert not math.isnan(result["p"])
+        assert result["yes"]["n"] == len(data["b_cell"]["yes"]) - 1
+        assert not math.isnan(result["yes"]["median"])
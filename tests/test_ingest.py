@@ -0,0 +1,112 @@
+import sqlite3
+
+import pytest
+
+from database_setup import ingest
+
+
+def connect_reader(path):
+    return sqlite3.connect(f"file:{path}?mode=ro", uri=True)
+
+
+def sample_count(conn):
+    return conn.execute("SELECT COUNT(*) FROM cell_counts_csv").fetchone()[0]
+
+
+def test_append_while_reader_connected(tmp_path, csv_rows, write_csv):
+    _, rows = csv_rows
+    path = str(tmp_path / "cell_counts.db")
+
+    with sqlite3.connect(path) as conn:
+        ingest(conn, [write_csv("first.csv", rows[:200])])
+
+    reader = connect_reader(path)
+    try:
+        assert sample_count(reader) == 200
+
+        with sqlite3.connect(path) as conn:
+            assert ingest(
+                conn, [write_csv("second.csv", rows[200:300])], append=True
+            ) == 1
+            assert conn.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+
+        assert sample_count(reader) == 300
+    finally:
+        reader.close()
+
+
+def test_provider_sees_append(tmp_path, csv_rows, write_csv):
+    from data_provider import DataProvider
+
+    _, rows = csv_rows
+    path = str(tmp_path / "cell_counts.db")
+
+    with sqlite3.connect(path) as conn:
+        ingest(conn, [write_csv("first.csv", rows[:200])])
+
+    provider = DataProvider(path, poll_interval=0)
+    assert provider.get("samples", sample_count) == 200
+
+    # The provider's pooled and version-marker connections stay open
+    with sqlite3.connect(path) as conn:
+        ingest(conn, [write_csv("second.csv", rows[200:300])], append=True)
+
+    assert provider.get("samples", sample_count) == 300
+
+
+def wide_rows(path):
+    with sqlite3.connect(path) as conn:
+        return conn.execute("""
+            SELECT project, subject, condition, age, sex, treatment, response,
+                   sample, sample_type, time_from_treatment_start,
+                   b_cell, cd8_t_cell, cd4_t_cell, nk_cell, monocyte
+            FROM cell_counts_csv
+            ORDER BY sample
+        """).fetchall()
+
+
+def test_rebuild_resent_sample_last_row_wins(tmp_path, csv_rows, write_csv):
+    header, rows = csv_rows
+    resent = list(rows[10])
+    resent[header.index("b_cell")] = "12345"
+    files = [
+        write_csv("a.csv", rows[:100]),
+        write_csv("b.csv", rows[100:150] + [resent]),
+    ]
+
+    rebuilt = str(tmp_path / "rebuilt.db")
+    with sqlite3.connect(rebuilt) as conn:
+        ingest(conn, files)
+
+    appended = str(tmp_path / "appended.db")
+    with sqlite3.connect(appended) as conn:
+        ingest(conn, files[:1])
+        ingest(conn, files[1:], append=True)
+
+    assert len(wide_rows(rebuilt)) == 150
+    assert wide_rows(rebuilt) == wide_rows(appended)
+    with sqlite3.connect(rebuilt) as conn:
+        assert conn.execute(
+            "SELECT b_cell FROM cell_counts_csv WHERE sample = ?",
+            (resent[header.index("sample")],)
+        ).fetchone() == (12345.0,)
+
+
+def test_failed_rebuild_keeps_database(tmp_path, csv_rows, write_csv):
+    _, rows = csv_rows
+    path = str(tmp_path / "cell_counts.db")
+
+    with sqlite3.connect(path) as conn:
+        ingest(conn, [write_csv("good.csv", rows[:100])])
+    before = wide_rows(path)
+
+    broken = tmp_path / "broken.csv"
+    broken.write_text("project,subject\nprj1,sbj1\n")
+
+    with sqlite3.connect(path) as conn:
+        with pytest.raises(ValueError):
+            ingest(conn, [write_csv("more.csv", rows[100:200]), str(broken)])
+
+    assert wide_rows(path) == before
+    assert sorted(p.name for p in tmp_path.iterdir()
+                  if p.name.startswith("cell_counts.db.rebuild")) == []
@@ -0,0 +1,79 @@
+import sqlite3
+
+import numpy as np
+import pytest
+from scipy.stats import mannwhitneyu
+
+from database_setup import CSV_COLUMNS, ingest
+from longitudinal import compare_trajectories, fetch_trajectories
+from queries import RESPONSE_COHORT
+
+PROJECT = CSV_COLUMNS.index("project")
+SUBJECT = CSV_COLUMNS.index("subject")
+SAMPLE = CSV_COLUMNS.index("sample")
+TIMEPOINT = CSV_COLUMNS.index("time_from_treatment_start")
+
+
+def trajectories(tmp_path, write_csv, rows):
+    with sqlite3.connect(tmp_path / "cell_counts.db") as conn:
+        ingest(conn, [write_csv("cells.csv", rows)])
+        return fetch_trajectories(conn, **RESPONSE_COHORT)
+
+
+def cohort_rows(csv_rows, n=600):
+    _, rows = csv_rows
+    return [
+        list(row) for row in rows[:n]
+        if row[CSV_COLUMNS.index("treatment")] == "miraclib"
+        and row[CSV_COLUMNS.index("sample_type")] == "PBMC"
+    ]
+
+
+def test_blank_timepoint_is_left_out(tmp_path, csv_rows, write_csv):
+    rows = cohort_rows(csv_rows)
+    expected = trajectories(tmp_path, write_csv, rows)
+
+    rows[1][TIMEPOINT] = ""
+    blanked = trajectories(tmp_path, write_csv, rows)
+
+    assert list(blanked["timepoints"]) == list(expected["timepoints"])
+    assert np.isnan(blanked["values"]).sum() > np.isnan(expected["values"]).sum()
+    assert len(compare_trajectories(blanked))
+
+
+def test_subject_codes_shared_across_projects(tmp_path, csv_rows, write_csv):
+    rows = cohort_rows(csv_rows)
+    subject = rows[0][SUBJECT]
+    copies = [
+        row[:PROJECT] + ["prj_copy"] + row[PROJECT + 1:SAMPLE]
+        + [row[SAMPLE] + "_copy"] + row[SAMPLE + 1:]
+        for row in rows if row[SUBJECT] == subject
+    ]
+    result = trajectories(tmp_path, write_csv, rows + copies)
+
+    rows_of_subject = np.flatnonzero(result["subjects"] == subject)
+    assert sorted(result["projects"][rows_of_subject]) == sorted(
+        [rows[0][PROJECT], "prj_copy"]
+    )
+    first, second = result["values"][rows_of_subject]
+    np.testing.assert_array_equal(first, second)
+
+
+def test_compare_matches_scipy(tmp_path, csv_rows, write_csv):
+    result = trajectories(tmp_path, write_csv, cohort_rows(csv_rows))
+    tests = compare_trajectories(result, min_group_size=1)
+
+    values = result["values"]
+    deltas = values[:, 1, 0] - values[:, 0, 0]
+    responses = result["responses"]
+    yes = deltas[(responses == "yes") & ~np.isnan(deltas)]
+    no = deltas[(responses == "no") & ~np.isnan(deltas)]
+    expected = mannwhitneyu(yes, no, method="asymptotic")
+
+    row = tests[
+        (tests["timepoint"] == result["timepoints"][1])
+        & (tests["population"] == result["populations"][0])
+    ].iloc[0]
+    assert (row["n_yes"], row["n_no"]) == (len(yes), len(no))
+    assert row["u"] == pytest.approx(expected.statistic)
+    assert row["p"] == pytest.approx(expected.pvalue)
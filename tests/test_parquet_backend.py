@@ -0,0 +1,66 @@
+import sqlite3
+
+import numpy as np
+import pytest
+
+import data_analysis
+import parquet_backend
+from database_setup import CSV_COLUMNS, bump_generation, export_parquet, ingest
+
+pytest.importorskip("pyarrow.dataset")
+
+
+@pytest.fixture
+def exported(tmp_path, csv_rows, write_csv):
+    """
+    A database of part of cell-count.csv, with one count left blank, and
+    its Parquet export. Returns (connection, export directory).
+    """
+    _, rows = csv_rows
+    rows = [list(row) for row in rows[:1500]]
+    rows[0][CSV_COLUMNS.index("b_cell")] = ""
+    parquet_dir = str(tmp_path / "parquet")
+
+    conn = sqlite3.connect(tmp_path / "cell_counts.db")
+    ingest(conn, [write_csv("cells.csv", rows)])
+    export_parquet(conn, parquet_dir)
+    yield conn, parquet_dir
+    conn.close()
+
+
+def test_response_data_matches_sqlite(exported):
+    conn, parquet_dir = exported
+    assert parquet_backend.available(conn, parquet_dir)
+
+    expected = data_analysis.fetch_response_data(conn)
+    result = parquet_backend.fetch_response_data(parquet_dir)
+
+    assert sorted(result) == sorted(expected)
+    for population, groups in expected.items():
+        for response in ("yes", "no"):
+            # Row order differs between the backends
+            np.testing.assert_array_equal(
+                np.sort(result[population][response]),
+                np.sort(groups[response])
+            )
+    assert np.isnan(np.concatenate(
+        [result["b_cell"]["yes"], result["b_cell"]["no"]]
+    )).sum() == 1
+
+
+def test_memory_limit(exported):
+    _, parquet_dir = exported
+    with pytest.raises(MemoryError, match="byte limit"):
+        parquet_backend.fetch_response_data(parquet_dir, max_bytes=1000)
+
+
+def test_stale_export_is_unavailable(exported, tmp_path):
+    conn, parquet_dir = exported
+    bump_generation(conn)
+    conn.commit()
+
+    assert not parquet_backend.available(conn, parquet_dir)
+    assert not parquet_backend.available(conn, str(tmp_path / "missing"))
+    # A new export catches up
+    export_parquet(conn, parquet_dir)
+    assert parquet_backend.available(conn, parquet_dir)
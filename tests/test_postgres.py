@@ -0,0 +1,145 @@
+"""
+PostgreSQL storage against a throwaway database, opted into with
+
+    CELL_COUNTS_TEST_POSTGRES=postgresql://user@host/scratch python -m pytest
+
+Every table in that database is dropped.
+"""
+import os
+import sqlite3
+
+import pytest
+
+from database_setup import CSV_COLUMNS, ingest
+from result_cache import cached, data_generation
+from storage import open_storage
+
+POSTGRES_URL = os.environ.get("CELL_COUNTS_TEST_POSTGRES")
+
+pytestmark = pytest.mark.skipif(
+    not POSTGRES_URL,
+    reason="CELL_COUNTS_TEST_POSTGRES (a throwaway database URL) not set"
+)
+
+WIDE_SQL = """
+    SELECT sample, subject, response, time_from_treatment_start, b_cell
+    FROM cell_counts_csv
+    ORDER BY sample
+"""
+
+FREQUENCIES_SQL = """
+    SELECT sample, population, count, ROUND(percentage * 1e6)
+    FROM cell_population_frequencies
+    ORDER BY sample, population
+"""
+
+DEMOGRAPHICS_SQL = """
+    SELECT sample, project, subject, condition, age, sex
+    FROM cell_counts_csv
+    ORDER BY sample
+"""
+
+SUMMARIES_SQL = """
+    SELECT condition, treatment, sample_type, time_from_treatment_start,
+           project, response, sex, population_id, n
+    FROM cohort_summaries
+    ORDER BY condition, treatment, sample_type, time_from_treatment_start,
+             project, response, sex, population_id
+"""
+
+
+@pytest.fixture
+def storage():
+    storage = open_storage(POSTGRES_URL)
+    with storage.connect() as conn:
+        conn.execute("DROP SCHEMA public CASCADE")
+        conn.execute("CREATE SCHEMA public")
+    return storage
+
+
+def rows_of(conn, sql):
+    return [tuple(row) for row in conn.execute(sql).fetchall()]
+
+
+def sqlite_database(tmp_path, csv_files):
+    path = str(tmp_path / "cell_counts.db")
+    with sqlite3.connect(path) as conn:
+        ingest(conn, csv_files)
+    return sqlite3.connect(path)
+
+
+def test_append_matches_sqlite_rebuild(tmp_path, storage, csv_rows, write_csv):
+    _, rows = csv_rows
+    first = write_csv("first.csv", rows[:200])
+    second = write_csv("second.csv", rows[200:300])
+
+    with storage.connect() as conn:
+        storage.ingest(conn, [first])
+    with storage.connect() as conn:
+        storage.ingest(conn, [second], append=True)
+
+    expected = sqlite_database(tmp_path, [first, second])
+    try:
+        with storage.connect() as conn:
+            for sql in (WIDE_SQL, FREQUENCIES_SQL, SUMMARIES_SQL):
+                assert rows_of(conn, sql) == rows_of(expected, sql)
+    finally:
+        expected.close()
+
+
+def test_later_file_updates_subject(tmp_path, storage, csv_rows, write_csv):
+    _, rows = csv_rows
+    subject = rows[0][CSV_COLUMNS.index("subject")]
+    age = CSV_COLUMNS.index("age")
+    sample = CSV_COLUMNS.index("sample")
+
+    # New samples of an already loaded subject, with a different age
+    again = []
+    for row in rows[:200]:
+        if row[CSV_COLUMNS.index("subject")] == subject:
+            row = list(row)
+            row[age] = "99"
+            row[sample] += "_again"
+            again.append(row)
+    first = write_csv("first.csv", rows[:200])
+    second = write_csv("second.csv", again)
+
+    with storage.connect() as conn:
+        storage.ingest(conn, [first, second])
+
+    expected = sqlite_database(tmp_path, [first, second])
+    try:
+        with storage.connect() as conn:
+            demographics = rows_of(conn, DEMOGRAPHICS_SQL)
+            assert demographics == rows_of(expected, DEMOGRAPHICS_SQL)
+            assert {row[4] for row in demographics if row[2] == subject} == {99}
+    finally:
+        expected.close()
+
+
+def test_quoted_question_marks(storage):
+    with storage.connect() as conn:
+        row = conn.execute(
+            "SELECT '?', 'it''s ?', ? AS \"why?\", '100%'", ("answer",)
+        ).fetchone()
+    assert tuple(row) == ("?", "it's ?", "answer", "100%")
+
+
+def test_result_cache(storage, csv_rows, write_csv):
+    _, rows = csv_rows
+    calls = []
+
+    def compute():
+        calls.append(1)
+        return {"n": len(calls)}
+
+    with storage.connect() as conn:
+        # No data_generation table yet: nothing is cached, and the
+        # failed lookup leaves the connection usable
+        assert data_generation(conn) == 0
+        assert cached(conn, "test", {}, compute) == {"n": 1}
+
+        storage.ingest(conn, [write_csv("first.csv", rows[:100])])
+        assert data_generation(conn) > 0
+        assert cached(conn, "test", {}, compute) == {"n": 2}
+        assert cached(conn, "test", {}, compute) == {"n": 2}
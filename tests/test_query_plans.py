@@ -0,0 +1,58 @@
+import sqlite3
+
+import pytest
+
+from cohort_query import compile_query
+from conftest import CSV_FILE
+from database_setup import ingest
+from queries import check_query_plans, full_scan, query_plan
+
+# Queries of the cohort_query.py docstring and README, plus listings
+COHORT_QUERIES = [
+    ["condition=melanoma", "sex=M", "response=yes", "t=0", "agg=mean(b_cell)"],
+    ["treatment=miraclib", "agg=count(*),mean(cd4_t_cell)", "by=response,sex"],
+    ["treatment=miraclib", "sample_type=PBMC", "agg=mean(b_cell)",
+     "by=response"],
+    ["project=prj1", "age>=60", "limit=20"],
+    ["condition=melanoma", "treatment=miraclib", "sample_type=PBMC",
+     "limit=20"],
+    ["condition=melanoma", "treatment=miraclib", "sample_type=PBMC"],
+    ["sample=sample00000"],
+]
+
+
+@pytest.fixture(scope="module")
+def conn(tmp_path_factory):
+    path = tmp_path_factory.mktemp("plans") / "cell_counts.db"
+    with sqlite3.connect(path) as conn:
+        ingest(conn, [CSV_FILE])
+
+    conn = sqlite3.connect(path)
+    yield conn
+    conn.close()
+
+
+def test_shipped_queries_use_indexes(conn):
+    assert check_query_plans(conn) == {}
+
+
+@pytest.mark.parametrize("use_summaries", [True, False])
+@pytest.mark.parametrize("terms", COHORT_QUERIES, ids=" ".join)
+def test_cohort_queries_use_indexes(conn, terms, use_summaries):
+    sql, params, _ = compile_query(terms, use_summaries)
+    plan = query_plan(conn, sql, params)
+    if "FROM cohort_summaries" in sql:
+        # One row per cohort group and population, however many samples
+        assert "cell_counts_csv" not in sql
+    else:
+        assert not full_scan(sql, plan), plan
+
+
+def test_check_reports_full_scans(conn):
+    queries = {
+        "unindexed": ("SELECT * FROM cell_counts_csv WHERE age > ?", (60,)),
+        "sorted_page": (
+            "SELECT * FROM cell_counts_csv ORDER BY age LIMIT 10", ()
+        ),
+    }
+    assert set(check_query_plans(conn, queries)) == set(queries)
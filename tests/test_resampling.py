@@ -0,0 +1,78 @@
+from itertools import combinations
+
+import numpy as np
+import pytest
+
+from resampling import resampling_tests
+
+# Independent Monte Carlo runs of this size agree to well within these
+N_RESAMPLES = 20_000
+P_TOLERANCE = 0.015
+TAIL_TOLERANCE = 0.01
+
+
+@pytest.fixture(scope="module")
+def data():
+    rng = np.random.default_rng(3)
+    return {
+        "small": {"yes": rng.normal(1.0, 1.0, 5), "no": rng.normal(0, 1.0, 6)},
+        "tied": {
+            "yes": np.round(rng.normal(0.5, 1.0, 30), 1),
+            "no": np.append(np.round(rng.normal(0, 1.0, 25), 1), np.nan),
+        },
+        "too_few": {"yes": [0.1, 0.2], "no": [0.3, 0.4, 0.5]},
+    }
+
+
+def test_results_do_not_depend_on_workers(data):
+    # Several blocks per population, so the pool has work to spread
+    kwargs = dict(n_permutations=12_000, n_bootstrap=7_000, seed=11)
+    assert resampling_tests(data, workers=1, **kwargs) == resampling_tests(
+        data, workers=2, **kwargs
+    )
+    assert resampling_tests(data, workers=1, **kwargs) != resampling_tests(
+        data, workers=1, **{**kwargs, "seed": 12}
+    )
+
+
+def test_matches_naive_resampling(data):
+    yes, no = (np.asarray(data["small"][response]) for response in ("yes", "no"))
+    results = resampling_tests(
+        data, n_permutations=N_RESAMPLES, n_bootstrap=N_RESAMPLES
+    )
+    assert set(results) == {"small", "tied"}
+    result = results["small"]
+
+    observed = np.median(yes) - np.median(no)
+    assert result["median_difference"] == pytest.approx(observed)
+
+    def extreme(differences):
+        return np.abs(differences) >= abs(observed) * (1 - 1e-12)
+
+    # Every relabeling of 11 values, and random ones drawn naively
+    pooled = np.concatenate([yes, no])
+    exact = np.mean([
+        extreme(np.median(pooled[list(chosen)])
+                - np.median(np.delete(pooled, chosen)))
+        for chosen in combinations(range(pooled.size), yes.size)
+    ])
+    rng = np.random.default_rng(0)
+    permuted = np.empty(N_RESAMPLES)
+    for i in range(N_RESAMPLES):
+        shuffled = rng.permutation(pooled)
+        permuted[i] = (np.median(shuffled[:yes.size])
+                       - np.median(shuffled[yes.size:]))
+    naive_p = (extreme(permuted).sum() + 1) / (N_RESAMPLES + 1)
+
+    assert result["p"] == pytest.approx(exact, abs=P_TOLERANCE)
+    assert result["p"] == pytest.approx(naive_p, abs=P_TOLERANCE)
+
+    # The interval ends cut about 2.5% of naive bootstrap medians off
+    # each tail (the distribution is discrete, so compare both sides)
+    bootstrapped = np.array([
+        np.median(rng.choice(yes, yes.size)) - np.median(rng.choice(no, no.size))
+        for _ in range(N_RESAMPLES)
+    ])
+    for end, tail in ((result["ci_low"], 0.025), (result["ci_high"], 0.975)):
+        assert np.mean(bootstrapped < end) <= tail + TAIL_TOLERANCE
+        assert np.mean(bootstrapped <= end) >= tail - TAIL_TOLERANCE
@@ -0,0 +1,83 @@
+import numpy as np
+import pytest
+
+from sketches import DEFAULT_K, KLLSketch, merge_all
+
+# The module docstring's bound: ranks within about 1% of the count
+RANK_ERROR = 0.01
+
+QUANTILES = np.linspace(0.01, 0.99, 99)
+
+
+def rank_errors(sketch, values):
+    """
+    |true rank - q * n| / n of the sketch's answer to each of QUANTILES.
+    """
+    values = np.sort(values)
+    answers = sketch.quantiles(QUANTILES)
+    ranks = np.searchsorted(values, answers, side="right")
+    return np.abs(ranks - QUANTILES * values.size) / values.size
+
+
+@pytest.fixture(scope="module")
+def values():
+    rng = np.random.default_rng(0)
+    return np.concatenate([rng.lognormal(size=60_000), rng.random(40_000)])
+
+
+def test_rank_error_within_bound(values):
+    sketch = KLLSketch()
+    for chunk in np.array_split(values, 37):
+        sketch.update(chunk)
+
+    assert sketch.n == values.size
+    assert sketch.retained < 10 * DEFAULT_K
+    assert rank_errors(sketch, values).max() <= RANK_ERROR
+    for value in np.quantile(values, [0.1, 0.5, 0.9]):
+        true_rank = np.sum(values <= value)
+        assert abs(sketch.rank(value) - true_rank) <= RANK_ERROR * values.size
+
+
+def test_merge_matches_combined(values):
+    halves = np.array_split(values, [30_000])
+    merged = KLLSketch().update(halves[0]).merge(KLLSketch().update(halves[1]))
+    combined = KLLSketch().update(values)
+
+    assert (merged.n, merged.min, merged.max) == (
+        combined.n, combined.min, combined.max
+    )
+    assert rank_errors(merged, values).max() <= RANK_ERROR
+    np.testing.assert_allclose(
+        rank_errors(merged, values), rank_errors(combined, values),
+        atol=RANK_ERROR
+    )
+
+
+def test_small_sketches_are_exact():
+    rng = np.random.default_rng(1)
+    parts = [rng.random(n) for n in (50, 70, 80)]
+    merged = merge_all(KLLSketch().update(part) for part in parts)
+
+    everything = np.concatenate(parts)
+    np.testing.assert_allclose(
+        merged.quantiles([0.25, 0.5, 0.75]),
+        np.percentile(everything, [25, 50, 75])
+    )
+    assert merged.rank(np.median(everything)) == np.sum(
+        everything <= np.median(everything)
+    )
+
+
+def test_bytes_round_trip(values):
+    for sketch in (KLLSketch(), KLLSketch().update([0.5, np.nan]),
+                   KLLSketch(k=50).update(values)):
+        restored = KLLSketch.from_bytes(sketch.to_bytes())
+        assert (restored.k, restored.n, restored.min, restored.max) == (
+            sketch.k, sketch.n, sketch.min, sketch.max
+        )
+        assert restored.compactions == sketch.compactions
+        assert len(restored.levels) == len(sketch.levels)
+        for level, expected in zip(restored.levels, sketch.levels):
+            np.testing.assert_array_equal(level, expected)
+        # Still usable as a sketch
+        restored.update([1.0]).merge(KLLSketch(sketch.k).update([2.0]))
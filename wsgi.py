@@ -0,0 +1,19 @@
+"""
+Production entry point for the dashboard, for a multi-process WSGI server:
+
+    gunicorn --workers 8 --threads 4 --preload --bind 0.0.0.0:8050 wsgi:application
+
+Each worker process reads through its own pool of read-only connections
+(data_provider.ConnectionPool) and keeps its own in-memory copy of the
+loaded data. Results shared by every page are stored in analysis_cache
+once, here, before the workers start, so no worker has to compute them.
+"""
+from contextlib import closing
+
+from dashboard import app, provider, warm_analysis_cache
+
+# The inner block commits; a SQLite connection is only closed by closing()
+with closing(provider.storage.connect()) as conn, conn:
+    warm_analysis_cache(conn)
+
+application = app.server